@@ -0,0 +1,271 @@
+import os
+import json
+import math
+import time
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Tuple
+
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+from metrics import ADMISSION_ACTIVE, ADMISSION_QUEUE_DEPTH, ADMISSION_QUEUE_WAIT, ADMISSION_REJECTED
+
+
+# Analyses running at once, waiting for a slot and how long they may wait, per endpoint class
+DEFAULT_ADMISSION_LIMITS = {
+    "analysis": {"concurrency": 32, "queue": 64, "queue_timeout_seconds": 15},
+    "stream": {"concurrency": 32, "queue": 64, "queue_timeout_seconds": 10},
+}
+# JSON overrides, e.g. {"stream": {"concurrency": 8, "queue": 0}}
+ADMISSION_LIMITS = {
+    endpoint: {**limits, **json.loads(os.getenv("GEO_ADMISSION_LIMITS", "{}")).get(endpoint, {})}
+    for endpoint, limits in DEFAULT_ADMISSION_LIMITS.items()
+}
+# "off" lets every request through, the way the app behaved before
+ADMISSION_ENABLED = os.getenv("GEO_ADMISSION", "on") != "off"
+# Requests one client may have running and waiting per endpoint class, 0 leaves only the fair share
+ADMISSION_MAX_PER_KEY = int(os.getenv("GEO_ADMISSION_MAX_PER_KEY", 0))
+# Clients are told apart by address. "on" tells them apart by X-API-Key instead, only for deployments behind a proxy
+# that authenticates the key: anyone can send a new unverified key with every request and get a fresh share
+ADMISSION_TRUST_API_KEY = os.getenv("GEO_ADMISSION_TRUST_API_KEY", "off") == "on"
+
+# Checked in order, the first prefix a request path starts with picks its class
+ENDPOINT_CLASSES = (("/stream/analyze/", "stream"), ("/analyze/", "analysis"))
+API_KEY_HEADER = b"x-api-key"
+
+REJECTION_REASONS = ("queue_full", "queue_timeout", "fair_share", "key_quota")
+MAX_RETRY_AFTER_SECONDS = 120
+# Weight of the latest request in the running average of how long requests hold their slot
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, reason: str, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.reason = reason
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class Waiter():
+    __slots__ = ("future", "key", "enqueued_at")
+
+    def __init__(self, key: str):
+        self.future = asyncio.get_running_loop().create_future()
+        self.key = key
+        self.enqueued_at = time.monotonic()
+
+
+class EndpointLimiter():
+    """
+    Slots of one endpoint class and its bounded wait queue.
+    The queue is a round robin of clients, and once it is full a client holding less than its fair share
+    (slots plus queue divided by the clients with requests in) takes the place of the newest waiter of the client
+    holding the most, so one client flooding the endpoints can't lock the others out.
+    """
+    def __init__(self, endpoint: str, concurrency: int, queue: int, queue_timeout_seconds: float, max_per_key: int = ADMISSION_MAX_PER_KEY):
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.queue_size = queue
+        self.queue_timeout = queue_timeout_seconds
+        self.max_per_key = max_per_key
+        self.active: Dict[str, int] = {}
+        self.queue: OrderedDict[str, Deque[Waiter]] = OrderedDict()
+        self.running = 0
+        self.queued = 0
+        # Until requests finish, assume each holds its slot for a whole queue timeout
+        self.service_seconds = queue_timeout_seconds
+        self.admitted = 0
+        self.rejected = dict.fromkeys(REJECTION_REASONS, 0)
+
+    def held(self, key: str) -> int:
+        return self.active.get(key, 0) + len(self.queue.get(key, ()))
+
+    def fair_share(self, key: str) -> int:
+        keys = len(self.active.keys() | self.queue.keys() | {key})
+        return max(1, math.ceil((self.concurrency + self.queue_size) / keys))
+
+    def retry_after(self) -> int:
+        "Seconds until the requests ahead are likely done, from how long requests have been holding their slots"
+        seconds = self.service_seconds * (self.queued + 1) / max(1, self.concurrency)
+        return math.ceil(min(MAX_RETRY_AFTER_SECONDS, max(1.0, seconds)))
+
+    def rejection(self, reason: str) -> AdmissionRejected:
+        self.rejected[reason] += 1
+        ADMISSION_REJECTED.inc(endpoint=self.endpoint, reason=reason)
+        if reason == "fair_share":
+            return AdmissionRejected(429, reason, "Too many requests from this client while others are waiting, retry later.", self.retry_after())
+        if reason == "key_quota":
+            return AdmissionRejected(429, reason, f"At most {self.max_per_key} requests per client at once.", self.retry_after())
+        if reason == "queue_timeout":
+            return AdmissionRejected(503, reason, f"No analysis slot freed up within {self.queue_timeout:g} seconds, retry later.", self.retry_after())
+        return AdmissionRejected(503, reason, "Too many analyses running, retry later.", self.retry_after())
+
+    def start(self, key: str):
+        self.active[key] = self.active.get(key, 0) + 1
+        self.running += 1
+        self.admitted += 1
+        ADMISSION_ACTIVE.inc(endpoint=self.endpoint)
+
+    def enqueue(self, waiter: Waiter):
+        self.queue.setdefault(waiter.key, deque()).append(waiter)
+        self.queued += 1
+        ADMISSION_QUEUE_DEPTH.inc(endpoint=self.endpoint)
+
+    def remove(self, waiter: Waiter):
+        waiters = self.queue.get(waiter.key)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self.queue[waiter.key]
+            self.queued -= 1
+            ADMISSION_QUEUE_DEPTH.dec(endpoint=self.endpoint)
+
+    def make_room(self, key: str):
+        "Called with the queue full: pushes out the heaviest key's newest waiter when that's fair, otherwise rejects"
+        share = self.fair_share(key)
+        heaviest = max(self.queue, key=self.held, default=None)
+        if heaviest is not None and heaviest != key and self.held(key) < share < self.held(heaviest):
+            pushed = self.queue[heaviest][-1]
+            self.remove(pushed)
+            pushed.future.set_exception(self.rejection("fair_share"))
+            return
+        others_waiting = any(other != key for other in self.queue)
+        raise self.rejection("fair_share" if others_waiting and self.held(key) >= share else "queue_full")
+
+    async def acquire(self, key: str):
+        "Returns once the request holds a slot, raises AdmissionRejected when it won't get one"
+        if self.max_per_key and self.held(key) >= self.max_per_key:
+            raise self.rejection("key_quota")
+        if self.running < self.concurrency and not self.queued:
+            self.start(key)
+            ADMISSION_QUEUE_WAIT.observe(0.0, endpoint=self.endpoint)
+            return
+        if self.queued >= self.queue_size:
+            self.make_room(key)
+
+        waiter = Waiter(key)
+        self.enqueue(waiter)
+        try:
+            await asyncio.wait((waiter.future,), timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            # The client went away, a slot it was just given goes to the next in line
+            if waiter.future.done() and waiter.future.exception() is None:
+                self.release(key, 0.0)
+            else:
+                self.remove(waiter)
+            raise
+        if not waiter.future.done():
+            self.remove(waiter)
+            raise self.rejection("queue_timeout")
+        # Raises when a lighter client took its place
+        waiter.future.result()
+        ADMISSION_QUEUE_WAIT.observe(time.monotonic() - waiter.enqueued_at, endpoint=self.endpoint)
+
+    def release(self, key: str, seconds: float):
+        self.active[key] -= 1
+        if not self.active[key]:
+            del self.active[key]
+        self.running -= 1
+        ADMISSION_ACTIVE.dec(endpoint=self.endpoint)
+        self.service_seconds += SERVICE_TIME_SMOOTHING * (seconds - self.service_seconds)
+        self.dispatch()
+
+    def dispatch(self):
+        while self.running < self.concurrency and self.queue:
+            key, waiters = next(iter(self.queue.items()))
+            waiter = waiters.popleft()
+            # The key goes to the back of the queue, the next key in line is served next
+            if waiters:
+                self.queue.move_to_end(key)
+            else:
+                del self.queue[key]
+            self.queued -= 1
+            ADMISSION_QUEUE_DEPTH.dec(endpoint=self.endpoint)
+            self.start(key)
+            waiter.future.set_result(None)
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "concurrency": self.concurrency,
+            "queue_size": self.queue_size,
+            "queue_timeout_seconds": self.queue_timeout,
+            "clients": len(self.active.keys() | self.queue.keys()),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "service_seconds": round(self.service_seconds, 3),
+            "retry_after": self.retry_after(),
+        }
+
+
+class AdmissionController():
+    "One limiter per endpoint class, requests to paths outside every class aren't limited"
+    def __init__(self, limits: Dict[str, dict] = ADMISSION_LIMITS, enabled: bool = ADMISSION_ENABLED, trust_api_key: bool = ADMISSION_TRUST_API_KEY):
+        self.enabled = enabled
+        self.trust_api_key = trust_api_key
+        self.limiters = {endpoint: EndpointLimiter(endpoint, **endpoint_limits) for endpoint, endpoint_limits in limits.items()}
+
+    def limiter(self, path: str) -> EndpointLimiter | None:
+        if not self.enabled:
+            return None
+        for prefix, endpoint in ENDPOINT_CLASSES:
+            if path.startswith(prefix):
+                return self.limiters.get(endpoint)
+        return None
+
+    def client_key(self, scope) -> str:
+        "The client's address, or its X-API-Key when an authenticating proxy in front vouches for it"
+        if self.trust_api_key:
+            for name, value in scope.get("headers", ()):
+                if name == API_KEY_HEADER and value:
+                    return "key:" + value.decode("latin-1")
+        # Behind a proxy, uvicorn's --proxy-headers puts the forwarded client address here
+        client: Tuple[str, int] | None = scope.get("client")
+        return "address:" + (client[0] if client else "unknown")
+
+    def stats(self):
+        return {"enabled": self.enabled, "clients_by": "api_key" if self.trust_api_key else "address", **{endpoint: limiter.stats() for endpoint, limiter in self.limiters.items()}}
+
+
+admission_controller = AdmissionController()
+
+
+def match_route(scope):
+    "Routing never runs for rejected requests, this finds their route so their metrics aren't labeled unmatched"
+    for route in scope["app"].router.routes:
+        if route.matches(scope)[0] == Match.FULL:
+            scope["route"] = route
+            return
+
+
+class AdmissionMiddleware():
+    """
+    ASGI middleware holding each analysis request until its endpoint class has a free slot, rejecting it right away
+    with a Retry-After when the queue is full or its client is over its share, and with 503 when it waited too long.
+    Slots are held until the response body is fully sent, which for the SSE endpoints is the end of the stream.
+    """
+    def __init__(self, app, controller: AdmissionController | None = None):
+        self.app = app
+        self.controller = controller or admission_controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (limiter := self.controller.limiter(scope["path"])) is None:
+            return await self.app(scope, receive, send)
+
+        key = self.controller.client_key(scope)
+        try:
+            await limiter.acquire(key)
+        except AdmissionRejected as rejection:
+            match_route(scope)
+            response = JSONResponse({"detail": rejection.detail}, status_code=rejection.status_code, headers={"Retry-After": str(rejection.retry_after)})
+            return await response(scope, receive, send)
+
+        start = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release(key, time.monotonic() - start)
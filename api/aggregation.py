@@ -0,0 +1,307 @@
+import re
+import unicodedata
+from collections import Counter
+from difflib import SequenceMatcher
+from typing import Dict, Iterable, List, Tuple
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from pydantic import BaseModel
+
+
+# Legal forms, they never tell brands apart ("Copapel LTDA" is "Copapel")
+IGNORED_NAME_TOKENS = {
+    "ltda", "ltd", "inc", "corp", "corporation", "llc", "sa", "s/a", "me", "eireli", "epp",
+    "cia", "company", "co", "the",
+}
+
+# Kinds of business and connecting words: part of the name, but two names sharing only these
+# ("Papelaria Vale" and "Papelaria Catarinense", "Distribuidora Sul" and "Comercial Sul") are different brands
+GENERIC_NAME_TOKENS = {
+    "distribuidora", "distribuidor", "distribuicao", "comercial", "comercio", "industria", "industrial",
+    "importadora", "atacado", "atacadista", "varejo", "papelaria", "loja", "lojas", "grupo", "group",
+    "servicos", "solucoes", "produtos", "materiais", "embalagens", "limpeza", "higiene", "descartaveis",
+    "representacoes", "supermercado", "mercado", "store", "shop", "services", "solutions", "products",
+    "supplies", "supply", "de", "da", "do", "das", "dos", "e", "and", "of",
+}
+
+# Domains many different companies are linked through, they can't identify a brand
+SHARED_DOMAINS = {
+    "google.com", "goo.gl", "maps.app.goo.gl", "facebook.com", "instagram.com", "linkedin.com",
+    "youtube.com", "twitter.com", "x.com", "tiktok.com", "wikipedia.org", "reclameaqui.com.br",
+    "mercadolivre.com.br", "amazon.com", "amazon.com.br", "yelp.com", "tripadvisor.com",
+    "tripadvisor.com.br", "wa.me", "whatsapp.com", "linktr.ee",
+}
+
+# Second level labels under country TLDs (copapel.com.br -> copapel.com.br, not com.br)
+GENERIC_SECOND_LEVEL = {"com", "net", "org", "gov", "edu", "co", "ind", "art", "adv"}
+
+FUZZY_MATCH_RATIO = 0.88
+# Names of a group every name joining it has to match, the first ones it got
+MAX_GROUP_EXEMPLARS = 8
+# Blocks of names that many groups share a word start or end in are too common to compare within
+MAX_BLOCK_GROUPS = 32
+
+
+class RankedCompany(BaseModel):
+    "A brand merged across spellings and keywords"
+    name: str
+    aliases: List[str]
+    domains: List[str]
+    relevantUrls: List[str]
+    times_cited: int
+    share_of_voice: float
+    keywords: Dict[str, int]
+
+
+def normalize_name(name: str) -> str:
+    folded = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode().casefold()
+    tokens = re.sub(r"[^\w\s/]", " ", folded.replace("s.a.", "sa")).split()
+    kept = [token for token in tokens if token not in IGNORED_NAME_TOKENS]
+    # A name made only of ignored words is still a name
+    return " ".join(kept or tokens)
+
+
+def registrable_domain(url: str) -> str | None:
+    try:
+        host = urlsplit(url if "://" in url else f"https://{url}").hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+
+    labels = host.removeprefix("www.").split(".")
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in GENERIC_SECOND_LEVEL:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+def owns_domain(name: str, domain: str) -> bool:
+    "The domain looks like the company's own site: its name, or a distinctive word of it, is in the domain"
+    label = domain.split(".")[0].replace("-", "")
+    compact = name.replace(" ", "")
+    return (len(label) >= 4 and label in compact) or any(len(token) >= 4 and token in label for token in distinctive_tokens(name))
+
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    query = urlencode([(key, value) for key, value in parse_qsl(parts.query) if not key.startswith("utm_")])
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower().removeprefix("www."), parts.path.rstrip("/"), query, ""))
+
+
+class UnionFind():
+    def __init__(self, size: int):
+        self.parents = list(range(size))
+
+    def find(self, item: int) -> int:
+        while self.parents[item] != item:
+            self.parents[item] = self.parents[self.parents[item]]
+            item = self.parents[item]
+        return item
+
+    def union(self, a: int, b: int):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parents[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def distinctive_tokens(name: str) -> set:
+    return {token for token in name.split() if len(token) >= 3 and token not in GENERIC_NAME_TOKENS}
+
+
+def similar(a: str, b: str) -> bool:
+    # Upper bounds of the ratio from the lengths and the letters in common rule most pairs out before the full comparison
+    total = len(a) + len(b)
+    if not total or 2 * min(len(a), len(b)) < FUZZY_MATCH_RATIO * total:
+        return a == b
+    if 2 * sum((Counter(a) & Counter(b)).values()) < FUZZY_MATCH_RATIO * total:
+        return False
+    return SequenceMatcher(None, a, b).ratio() >= FUZZY_MATCH_RATIO
+
+
+def tokens_match(a: str, b: str) -> bool:
+    "The same word, or a spelling variant of a long enough one"
+    return a == b or (min(len(a), len(b)) >= 5 and similar(a, b))
+
+
+def share_distinctive_token(a: str, b: str) -> bool:
+    "A word both names have that isn't a kind of business"
+    tokens_a, tokens_b = distinctive_tokens(a), distinctive_tokens(b)
+    return bool(tokens_a & tokens_b) or any(tokens_match(token_a, token_b) for token_a in tokens_a for token_b in tokens_b)
+
+
+def names_match(a: str, b: str) -> bool:
+    compact_a, compact_b = a.replace(" ", ""), b.replace(" ", "")
+    if compact_a == compact_b:
+        return True
+    if not share_distinctive_token(a, b):
+        return False
+    # "acme" vs "acme solucoes": every word of the shorter name is in the longer one
+    tokens_a, tokens_b = set(a.split()), set(b.split())
+    shorter, longer = sorted((tokens_a, tokens_b), key=len)
+    if max(map(len, shorter)) >= 4 and all(any(tokens_match(token, other) for other in longer) for token in shorter):
+        return True
+    # With and without kinds of business: "Distribuidora Bakomi Sul" and "Distribuidora Bakoru Sul" look alike
+    # until "Distribuidora" is left out, "Comercial Sul" and "Distribuidora Sul" only once it is
+    distinctive_a, distinctive_b = ("".join(token for token in name.split() if token not in GENERIC_NAME_TOKENS) for name in (a, b))
+    return similar(distinctive_a, distinctive_b) and similar(compact_a, compact_b)
+
+
+def rank_companies(results: Iterable[Tuple[str, List]]) -> List[RankedCompany]:
+    """
+    Merges the companies found for each keyword into one ranked share-of-voice table.
+    `results` is (keyword, companies) pairs, companies being anything with name, relevantUrls and times_cited.
+
+    Duplicates are merged by normalized name, by a website domain that is the own site of both names
+    and by fuzzy name match. Directories, news sites and site builders many brands are cited through never merge them.
+    Names only match when they share a word that isn't a kind of business, and groups only merge when every exemplar
+    of one (its first few names) matches every exemplar of the other (or shares an own domain with it),
+    so a generic name can't bridge two brands that don't match each other.
+    Each name is only compared with the exemplars of the groups it shares a block with, blocks being the start and
+    end of its distinctive words and its name without spaces. A block holding many groups is a word common to many
+    brands and is left out, so the cost stays linear in the number of citations.
+    """
+    entries = [(keyword, company) for keyword, companies in results for company in companies or []]
+    if not entries:
+        return []
+
+    # Exact normalized names are grouped first, fuzzy matching only sees distinct names
+    name_ids: Dict[str, int] = {}
+    entry_names = []
+    for _, company in entries:
+        normalized = normalize_name(company.name)
+        entry_names.append(name_ids.setdefault(normalized, len(name_ids)))
+
+    names = list(name_ids)
+    groups = UnionFind(len(names))
+    exemplars: Dict[int, List[int]] = {name_id: [name_id] for name_id in range(len(names))}
+
+    # {domain: names citing it}, and the domains each name owns
+    domain_names: Dict[str, Dict[int, None]] = {}
+    own_domains: List[set] = [set() for _ in names]
+    for name_id, (_, company) in zip(entry_names, entries):
+        for url in company.relevantUrls:
+            domain = registrable_domain(url)
+            if domain and domain not in SHARED_DOMAINS:
+                domain_names.setdefault(domain, {})[name_id] = None
+                if owns_domain(names[name_id], domain):
+                    own_domains[name_id].add(domain)
+
+    def compatible(a: int, b: int) -> bool:
+        return bool(own_domains[a] & own_domains[b]) or names_match(names[a], names[b])
+
+    def merge(a: int, b: int) -> bool:
+        root_a, root_b = groups.find(a), groups.find(b)
+        if root_a == root_b or not all(compatible(x, y) for x in exemplars[root_a] for y in exemplars[root_b]):
+            return False
+        groups.union(root_a, root_b)
+        group_exemplars = exemplars.pop(root_a) + exemplars.pop(root_b)
+        exemplars[groups.find(root_a)] = group_exemplars[:MAX_GROUP_EXEMPLARS]
+        return True
+
+    for domain, citing in domain_names.items():
+        owners = [name_id for name_id in citing if domain in own_domains[name_id]]
+        for name_id in owners[1:]:
+            merge(owners[0], name_id)
+
+    # {block: names registered in it, one per group when they were added}
+    blocks: Dict[str, Dict[int, None]] = {}
+    for name_id, name in enumerate(names):
+        if not name:
+            continue
+        keys = {f"compact:{name.replace(' ', '')}"}
+        keys.update(key for token in distinctive_tokens(name) for key in (f"start:{token[:4]}", f"end:{token[-4:]}"))
+        candidates = {
+            groups.find(other): other
+            for key in keys if len(block := blocks.get(key, ())) <= MAX_BLOCK_GROUPS for other in block
+        }
+        for other in candidates.values():
+            merge(name_id, other)
+        root = groups.find(name_id)
+        for key in keys:
+            block = blocks.setdefault(key, {})
+            # One name per group is enough to find it. A block past the cap isn't looked at anymore, nor grown
+            if len(block) <= MAX_BLOCK_GROUPS and all(groups.find(other) != root for other in block):
+                block[name_id] = None
+
+    merged: Dict[int, dict] = {}
+    for name_id, (keyword, company) in zip(entry_names, entries):
+        group = merged.setdefault(groups.find(name_id), {"aliases": {}, "urls": {}, "domains": {}, "keywords": {}, "times_cited": 0})
+        group["times_cited"] += company.times_cited
+        group["aliases"][company.name] = group["aliases"].get(company.name, 0) + company.times_cited
+        group["keywords"][keyword] = group["keywords"].get(keyword, 0) + company.times_cited
+        for url in company.relevantUrls:
+            group["urls"].setdefault(normalize_url(url), url)
+            domain = registrable_domain(url)
+            # Only domains that are the brand's own site, or that no other name was cited through
+            if domain in own_domains[name_id] or (domain in domain_names and len(domain_names[domain]) == 1):
+                group["domains"].setdefault(domain, None)
+
+    total_citations = sum(group["times_cited"] for group in merged.values()) or 1
+    ranked = [
+        RankedCompany(
+            # The most cited spelling names the brand, dicts keep first-seen order for ties
+            name=max(group["aliases"], key=group["aliases"].get),
+            aliases=list(group["aliases"]),
+            domains=list(group["domains"]),
+            relevantUrls=list(group["urls"].values()),
+            times_cited=group["times_cited"],
+            share_of_voice=group["times_cited"] / total_citations,
+            keywords=group["keywords"],
+        )
+        for group in merged.values()
+    ]
+    ranked.sort(key=lambda company: (-company.times_cited, company.name.casefold()))
+    return ranked
+
+
+class CityStanding(BaseModel):
+    "Where a brand stands in one city"
+    rank: int
+    times_cited: int
+    share_of_voice: float
+
+
+class CityComparison(BaseModel):
+    "A brand merged across the cities of a multi-city analysis"
+    name: str
+    aliases: List[str]
+    times_cited: int
+    share_of_voice: float
+    cities_present: int
+    cities: Dict[str, CityStanding]
+
+
+def compare_cities(rankings_by_city: Dict[str, List[RankedCompany]]) -> List[CityComparison]:
+    """
+    Lines up the rankings of each city: every brand with its rank, citations and share of voice per city it was cited in.
+    Brands are merged across cities the same way rank_companies merges them across keywords, with each city as a keyword.
+    """
+    merged = rank_companies(rankings_by_city.items())
+    standings: Dict[Tuple[str, str], Tuple[int, RankedCompany]] = {
+        (city, company.name): (rank, company)
+        for city, rankings in rankings_by_city.items() for rank, company in enumerate(rankings, start=1)
+    }
+
+    comparison = []
+    for company in merged:
+        cities: Dict[str, CityStanding] = {}
+        aliases: Dict[str, None] = {}
+        for city in company.keywords:
+            # Each alias of the merged brand is a name one city ranked it under, two of them can meet in the same city
+            for rank, ranked in sorted(standings[(city, alias)] for alias in company.aliases if (city, alias) in standings):
+                standing = cities.get(city)
+                cities[city] = CityStanding(
+                    rank=standing.rank if standing else rank,
+                    times_cited=ranked.times_cited + (standing.times_cited if standing else 0),
+                    share_of_voice=ranked.share_of_voice + (standing.share_of_voice if standing else 0.0),
+                )
+                aliases.update(dict.fromkeys(ranked.aliases))
+        comparison.append(CityComparison(
+            name=company.name,
+            aliases=list(aliases),
+            times_cited=company.times_cited,
+            share_of_voice=company.share_of_voice,
+            cities_present=len(cities),
+            cities=cities,
+        ))
+    return comparison
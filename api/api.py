@@ -1,12 +1,17 @@
 from dotenv import load_dotenv
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 
-from pydantic import BaseModel, model_validator
+from pydantic import BaseModel, Field, model_validator
 from typing import List, Literal, Optional
 
+import geo_aval
 from geo_aval import Agent
+from aggregation import CityComparison, RankedCompany
+from metrics import REGISTRY, ACTIVE_SESSIONS, MetricsMiddleware
+from admission import admission_controller, AdmissionMiddleware
 
 load_dotenv()
 
@@ -16,6 +21,8 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Innermost, so its 429s and 503s still get CORS headers and request metrics
+app.add_middleware(AdmissionMiddleware, controller=admission_controller)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://frontend:3000"],
@@ -23,33 +30,87 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
 
 # Request/Response Models
 class AnalysisRequest(BaseModel):
     brand_name: str
     city: str
     language: Literal["pt_BR", "en_US"]
+    # Research and keywords of a brand analysed recently are reused, unless this asks for fresh ones
+    refresh_profile: bool = False
 
 class CompanyResponse(BaseModel):
     name: str
     relevantUrls: List[str]
     times_cited: int
 
-class RankingsRequest(BaseModel):
+class RunOptions(BaseModel):
+    "How gather_results runs, shared by single analyses and batch jobs"
+    use_cache: bool = True
+    # "batched" structures several keywords per LLM call, trading per-keyword streaming granularity for fewer round trips
+    structuring_mode: Literal["per_keyword", "batched"] = "per_keyword"
+    # Caps for this request's keyword searches, keywords past them are skipped and the results come back partial
+    token_budget: Optional[int] = Field(default=None, ge=1)
+    search_budget: Optional[int] = Field(default=None, ge=0)
+    # Keywords not searched within this many seconds are left out and the results come back partial
+    deadline_seconds: Optional[float] = Field(default=None, gt=0)
+    # Sends a duplicate of unusually slow web searches, spending at most hedge_cost_budget_usd (estimated) on them
+    hedge: Optional[bool] = None
+    hedge_cost_budget_usd: Optional[float] = Field(default=None, ge=0)
+    # Searches of this request running at once (every city's together), GEO_SEARCH_CONCURRENCY when unset
+    search_concurrency: Optional[int] = Field(default=None, ge=1)
+
+    def run_options(self) -> dict:
+        "Graph config entries tuning how gather_results runs"
+        return {
+            "use_cache": self.use_cache,
+            "structuring_mode": self.structuring_mode,
+            "token_budget": self.token_budget,
+            "search_budget": self.search_budget,
+            "deadline_seconds": self.deadline_seconds,
+            "hedge": self.hedge,
+            "hedge_cost_budget_usd": self.hedge_cost_budget_usd,
+            "search_concurrency": self.search_concurrency,
+        }
+
+# Cities a single get_rankings can search its keywords in
+MAX_CITIES = 25
+
+class RankingsRequest(RunOptions):
     session_id: Optional[str] = None
     brand_name: Optional[str] = None
     city: Optional[str] = None
     language: Optional[Literal["pt_BR", "en_US"]] = None
     keywords: Optional[List[str]] = []
+    # Searches the keywords in each of these cities instead of the session's, reusing its research and keywords
+    cities: Optional[List[str]] = Field(default=None, min_length=1, max_length=MAX_CITIES)
 
     @model_validator(mode="after")
     def validade_ranking_request(self):
         if self.session_id is not None:
             return self
-        elif all([self.brand_name, self.city, self.language]):
+        elif all([self.brand_name, self.city or self.cities, self.language]):
             return self
         else:
-            raise ValueError("Either session_id or brand_name, city, and language must be provided.")
+            raise ValueError("Either session_id or brand_name, city (or cities), and language must be provided.")
+
+    @model_validator(mode="after")
+    def validate_cities(self):
+        if self.cities is not None:
+            # The same city spelled twice would only be searched twice
+            cities = {" ".join(city.split()).casefold(): " ".join(city.split()) for city in reversed(self.cities)}
+            if "" in cities:
+                raise ValueError("cities can't have empty names.")
+            self.cities = list(reversed(cities.values()))
+        return self
+
+    def run_options(self) -> dict:
+        return {**super().run_options(), "cities": self.cities}
+
+    def location(self) -> Optional[str]:
+        "City of a new session's research and keywords, the first of cities when only those are given"
+        return self.city or (self.cities[0] if self.cities else None)
 
     @model_validator(mode="after")
     def validate_keywords_length(self):
@@ -57,6 +118,14 @@ class RankingsRequest(BaseModel):
             raise ValueError("You can only search for up to 10 keywords.")
         return self
 
+class BatchOptions(RunOptions):
+    # "openai_batch" sends the keyword searches and their structuring as OpenAI Batch API files:
+    # half the token price and none of the realtime rate limit, answered within 24h instead of minutes
+    execution: Literal["realtime", "openai_batch"] = "realtime"
+
+class BatchJobRequest(BatchOptions):
+    items: List[AnalysisRequest] = Field(min_length=1)
+
 
 class AnalysisResponse(BaseModel):
     companies: List[CompanyResponse]
@@ -69,9 +138,57 @@ class ErrorResponse(BaseModel):
     error: str
     detail: str
 
+# Stream events (sent as SSE `event:` / `data:` frames by streaming.py)
+class StageEvent(BaseModel):
+    session_id: Optional[str]
+    stage: str
+    status: Literal["started", "completed"]
+
+class KeywordsEvent(BaseModel):
+    session_id: Optional[str]
+    keywords: List[str]
+
+class CompaniesEvent(BaseModel):
+    session_id: Optional[str]
+    keyword: Optional[str] = None
+    city: Optional[str] = None
+    companies: List[CompanyResponse]
+    # Set when the keyword wasn't searched because of the request's budget
+    skipped: Optional[bool] = None
+    # Set when the keyword's search missed the request's deadline
+    timed_out: Optional[bool] = None
+
+class CompletedEvent(BaseModel):
+    session_id: Optional[str]
+    keywords: Optional[List[str]] = None
+    graph: Optional[List[CompanyResponse]] = None
+    rankings: Optional[List[RankedCompany]] = None
+    usage: Optional[dict] = None
+    partial: Optional[bool] = None
+    skipped_keywords: Optional[List[str]] = None
+    timed_out_keywords: Optional[List[str]] = None
+    # Multi-city runs only
+    cities: Optional[dict] = None
+    comparison: Optional[List[CityComparison]] = None
+
+class ErrorEvent(BaseModel):
+    session_id: Optional[str]
+    detail: str
+
+
+def city_reports(city_results: dict | None) -> dict | None:
+    "Results of each city of a multi-city get_rankings, None for single city ones"
+    if city_results is None:
+        return None
+    return {
+        city: {**results, "partial": len(results["skipped_keywords"]) + len(results["timed_out_keywords"]) > 0}
+        for city, results in city_results.items()
+    }
+
 
 agent = Agent()
 compiled_graph = agent.get_graph()
+ACTIVE_SESSIONS.set_function(agent.checkpointer.session_count)
 
 @app.get("/", summary="API Health Check")
 async def root():
@@ -82,5 +199,34 @@ async def root():
         "version": "1.0.0"
     }
 
+@app.get("/sessions/stats", summary="Session Store Metrics")
+def sessions_stats():
+    """Resident sessions and bytes held by the checkpointer"""
+    # Sync on purpose, the SQLite backend scans every checkpoint and shouldn't hold the event loop
+    return agent.checkpointer.stats()
 
+@app.get("/cache/stats", summary="Search Cache Metrics")
+async def search_cache_stats():
+    """Hit / miss counters of the keyword search, brand profile and runnable caches and coalesced in-flight searches"""
+    return {
+        **agent.search_cache.stats(),
+        "single_flight": agent.search_flights.stats(),
+        "brand_profiles": agent.brand_profiles.stats(),
+        "runnables": agent.runnables.stats(),
+    }
 
+@app.get("/scheduler/stats", summary="OpenAI Scheduler Metrics")
+async def scheduler_stats():
+    """Queued requests per priority class and remaining rate limit capacity of each model"""
+    return geo_aval.llm_scheduler.stats()
+
+@app.get("/admission/stats", summary="Admission Control Metrics")
+async def admission_stats():
+    """Running and queued analysis requests, admissions and rejections per endpoint class"""
+    return admission_controller.stats()
+
+@app.get("/metrics", summary="Prometheus Metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    """Node and LLM call latencies, token usage, web searches, sessions and in-flight requests, in Prometheus text format"""
+    # Sync on purpose, reading the session count can hit SQLite and shouldn't hold the event loop
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,232 @@
+import os
+import csv
+import io
+import json
+import uuid
+import asyncio
+from typing import Annotated
+
+from fastapi import HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from langgraph.types import Command
+from pydantic import ValidationError
+
+from api import app
+from api import AnalysisRequest, BatchJobRequest, BatchOptions
+from api import agent, compiled_graph
+
+from geo_aval import DominanceGraph, llm_transport
+from jobs import BatchJob, JobLimitError, JobNotFoundError, JobRunner
+from openai_batch import transport_from_env
+from openai_http import shared_pooled_transport
+from usage import usage_report
+from scheduler import llm_priority
+
+
+CSV_COLUMNS = ("brand_name", "city", "language")
+
+
+def item_config(item: dict, options: dict, thread_id: str | None = None) -> dict:
+    return {"configurable": {
+        "thread_id": thread_id or str(uuid.uuid4()), "language": item["language"], "location": item["city"], "refresh_profile": item.get("refresh_profile", False), **options,
+    }}
+
+
+async def get_item_keywords(item: dict, config: dict):
+    # Stops after the keywords, like get_keywords
+    await compiled_graph.ainvoke({
+        "keywords": [],
+        "target": item["brand_name"],
+        "graph": DominanceGraph(companies=[]),
+        "messages": []
+    }, config=config)
+
+
+async def item_result(config: dict) -> dict:
+    values = (await compiled_graph.aget_state(config)).values
+    skipped_keywords = values.get("skipped_keywords") or []
+    timed_out_keywords = values.get("timed_out_keywords") or []
+    return jsonable_encoder({
+        "status": "ok",
+        "keywords": values.get("keywords"),
+        "graph": values.get("graph"),
+        "rankings": values.get("rankings"),
+        "usage": usage_report(values.get("usage")),
+        "partial": len(skipped_keywords) + len(timed_out_keywords) > 0,
+        "skipped_keywords": skipped_keywords,
+        "timed_out_keywords": timed_out_keywords,
+    })
+
+
+async def analyze_item(item: dict, options: dict, job_id: str) -> dict:
+    """
+    Runs one brand and city through the whole graph, the keywords it picks are searched as they are.
+    Keyword searches go through the shared search cache and single flight, so items of a city reuse each other's searches.
+    """
+    config = item_config(item, options)
+    try:
+        # The whole job is one session for the scheduler, so a big job shares the batch class fairly with the others
+        with llm_priority("batch", job_id):
+            await get_item_keywords(item, config)
+            await compiled_graph.ainvoke(Command(resume=""), config=config)
+        return await item_result(config)
+    finally:
+        # Results live in the job, the session would only take room from interactive ones
+        await agent.checkpointer.adelete_thread(config["configurable"]["thread_id"])
+
+
+# Batch API calls go straight to OpenAI (they don't count against the realtime rate limits),
+# the local stand-in sends its requests through the agent's client like realtime ones
+openai_batch_transport = transport_from_env(os.getenv("GEO_AVAL_API_KEY"), shared_pooled_transport(), llm_transport)
+
+
+async def analyze_in_openai_batch(job: BatchJob):
+    """
+    Runs a whole job with its keyword searches in OpenAI Batch API files: every item gets its keywords in realtime
+    (as many at once as there are batch workers), then the searches of all of them go out as one batch file and their
+    structuring as a second one. Item results come in once both are answered.
+    Budgets, deadlines and hedging only apply to realtime searches, structuring is always per keyword.
+    The job keeps the session of each item and the id of each batch file: taken over by another worker (the server
+    restarted), sessions still holding their keywords aren't asked for them again and files sent are waited for, not sent again.
+    """
+    configs: dict[int, dict] = {}
+    semaphore = asyncio.Semaphore(job_runner.workers)
+
+    async def get_keywords(index: int):
+        config = configs[index] = item_config(job.items[index], job.options, job.threads.get(index))
+        if (await compiled_graph.aget_state(config)).values.get("keywords"):
+            return
+        async with semaphore:
+            try:
+                await get_item_keywords(job.items[index], config)
+            except Exception as e:
+                del configs[index]
+                await agent.checkpointer.adelete_thread(config["configurable"]["thread_id"])
+                await job.add_results(index, {"status": "failed", "error": str(e)})
+
+    try:
+        await job.set_phase("keywords")
+        with llm_priority("batch", job.id):
+            await asyncio.gather(*[get_keywords(index) for index in sorted(job.pending)])
+
+        job.threads = {index: config["configurable"]["thread_id"] for index, config in configs.items()}
+        await job.set_phase("openai_batch")
+        states = [((await compiled_graph.aget_state(config)).values, config) for config in configs.values()]
+        updates = await agent.gather_in_openai_batch(states, openai_batch_transport, job.openai_batches, job.record_openai_batch)
+
+        await job.set_phase("results")
+        for (index, config), update in zip(configs.items(), updates):
+            await compiled_graph.aupdate_state(config, update, as_node="gather_results")
+            await job.add_results(index, await item_result(config))
+    except asyncio.CancelledError:
+        if not job.finished and job.store is not None:
+            # Stopped with its worker, the sessions and the files sent are left for the worker taking the job over
+            configs.clear()
+        else:
+            for batch_id in job.openai_batches.values():
+                # The first one may well be over already, the Batch API refuses to cancel it
+                try:
+                    await asyncio.shield(openai_batch_transport.cancel(batch_id))
+                except Exception as e:
+                    print(f"OpenAI batch {batch_id} not cancelled: {e}")
+        raise
+    finally:
+        for config in configs.values():
+            await agent.checkpointer.adelete_thread(config["configurable"]["thread_id"])
+
+
+job_runner = JobRunner(analyze_item, {"openai_batch": analyze_in_openai_batch})
+# Jobs left unfinished by the previous run of the server are taken over without waiting for a new one
+app.add_event_handler("startup", job_runner.start_workers)
+
+
+async def submit(items: list[AnalysisRequest], options: BatchOptions):
+    try:
+        job = await job_runner.submit([item.model_dump() for item in items], options.run_options(), options.execution)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except JobLimitError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return job.progress()
+
+
+def parse_csv(text: str) -> list[AnalysisRequest]:
+    reader = csv.DictReader(io.StringIO(text))
+    missing = [column for column in CSV_COLUMNS if column not in (reader.fieldnames or [])]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"CSV header must have the columns {', '.join(CSV_COLUMNS)}, missing {', '.join(missing)}.")
+
+    items = []
+    # Line 1 is the header
+    for line, row in enumerate(reader, start=2):
+        try:
+            items.append(AnalysisRequest(**{column: (row[column] or "").strip() for column in CSV_COLUMNS}))
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid CSV line {line}: {e.errors()[0]['msg']}")
+    return items
+
+
+@app.post("/batch/jobs", summary="Start Batch Analysis Job")
+async def create_batch_job(request: BatchJobRequest):
+    """
+    Queues a full analysis (keywords then rankings) of every (brand, city, language) item and returns the job right away.
+    Follow it at /batch/jobs/{job_id} and download results from /batch/jobs/{job_id}/results.
+    With execution "openai_batch" the keyword searches go through the OpenAI Batch API, for jobs that can wait up to a day.
+    """
+    return await submit(request.items, request)
+
+
+@app.post("/batch/jobs/csv", summary="Start Batch Analysis Job From CSV")
+async def create_batch_job_from_csv(request: Request, options: Annotated[BatchOptions, Query()]):
+    """
+    Same as /batch/jobs with the items sent as a CSV body (brand_name,city,language header), options as query parameters.
+    """
+    body = await request.body()
+    try:
+        text = body.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="CSV body must be UTF-8.")
+    return await submit(parse_csv(text), options)
+
+
+@app.get("/batch/jobs/{job_id}", summary="Batch Job Progress")
+async def batch_job_progress(job_id: str):
+    try:
+        return await job_runner.progress(job_id)
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/batch/jobs/{job_id}/results", summary="Download Batch Job Results")
+async def batch_job_results(job_id: str, wait: bool = True):
+    """
+    One JSON line per item in the order they finished, each with its index in the submitted list.
+    While the job runs the download stays open and new results are sent as they come, unless wait is false.
+    """
+    try:
+        results = await job_runner.results(job_id, wait=wait)
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    async def lines():
+        async for result in results:
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={
+        "Content-Disposition": f'attachment; filename="batch-{job_id}.ndjson"',
+    })
+
+
+@app.delete("/batch/jobs/{job_id}", summary="Cancel Batch Job")
+async def cancel_batch_job(job_id: str):
+    """Stops the job, items already finished keep their results"""
+    try:
+        return await job_runner.cancel(job_id)
+    except JobNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@app.get("/batch/stats", summary="Batch Worker Metrics")
+async def batch_stats():
+    return await job_runner.stats()
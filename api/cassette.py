@@ -0,0 +1,173 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from typing import AsyncIterator, Dict, List
+
+import httpx
+
+
+# Set GEO_LLM_CASSETTE to a json file to record or replay every OpenAI request the agent makes
+CASSETTE_PATH = os.getenv("GEO_LLM_CASSETTE")
+# "replay" never touches the network, "record" always does and saves what it got, "auto" only records what's missing
+CASSETTE_MODE = os.getenv("GEO_LLM_CASSETTE_MODE", "replay")
+# Seconds a replayed response waits before answering, the recorded time is used when unset
+CASSETTE_LATENCY = os.getenv("GEO_LLM_CASSETTE_LATENCY")
+# Seconds between the events of a replayed streaming response
+CASSETTE_CHUNK_LATENCY = float(os.getenv("GEO_LLM_CASSETTE_CHUNK_LATENCY", 0))
+
+CASSETTE_MODES = ("replay", "record", "auto")
+
+# Decoded bodies are stored, so headers describing the wire encoding don't apply on replay
+DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding", "connection", "set-cookie", "date"}
+
+
+class CassetteMissError(Exception):
+    def __init__(self, request: httpx.Request):
+        super().__init__(f"No recorded response for {request.method} {request.url.path} in replay mode, record it first.")
+
+
+class ReplayStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: List[bytes], chunk_latency: float):
+        self.chunks = chunks
+        self.chunk_latency = chunk_latency
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for index, chunk in enumerate(self.chunks):
+            if index and self.chunk_latency:
+                await asyncio.sleep(self.chunk_latency)
+            yield chunk
+
+
+class CassetteTransport(httpx.AsyncBaseTransport):
+    """
+    httpx transport recording OpenAI responses to a json file and replaying them offline.
+    Requests are matched on method, path and body, identical requests replay their recordings in order
+    and start over once they run out. Replayed responses wait the recorded time, or `latency` when given.
+    """
+    def __init__(self, path: str, mode: str = "replay", latency: float | None = None, chunk_latency: float = 0.0, upstream: httpx.AsyncBaseTransport | None = None):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Cassette mode must be one of {', '.join(CASSETTE_MODES)}.")
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.upstream = upstream
+
+        self.lock = threading.Lock()
+        self.interactions: Dict[str, List[dict]] = {}
+        self.replayed: Dict[str, int] = {}
+        # Requests recorded during this run, their older recordings are dropped on the first new one
+        self.fresh: set[str] = set()
+        if mode != "record" and os.path.exists(path):
+            with open(path, encoding="utf-8") as cassette:
+                for interaction in json.load(cassette)["interactions"]:
+                    self.interactions.setdefault(interaction["key"], []).append(interaction)
+        self.recorded = 0
+        self.replays = 0
+
+    @classmethod
+    def from_env(cls, upstream: httpx.AsyncBaseTransport | None = None):
+        return cls(
+            CASSETTE_PATH,
+            mode=CASSETTE_MODE,
+            latency=float(CASSETTE_LATENCY) if CASSETTE_LATENCY else None,
+            chunk_latency=CASSETTE_CHUNK_LATENCY,
+            upstream=upstream,
+        )
+
+    @staticmethod
+    def key(request: httpx.Request) -> str:
+        body = request.content
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True, ensure_ascii=False).encode()
+        except ValueError:
+            pass
+        return hashlib.sha256(b"\x1f".join([request.method.encode(), request.url.path.encode(), body])).hexdigest()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        key = self.key(request)
+
+        with self.lock:
+            recordings = self.interactions.get(key) if self.mode != "record" else None
+            if recordings:
+                interaction = recordings[self.replayed.get(key, 0) % len(recordings)]
+                self.replayed[key] = self.replayed.get(key, 0) + 1
+                self.replays += 1
+        if recordings:
+            return await self.replay(interaction, request)
+
+        if self.mode == "replay":
+            raise CassetteMissError(request)
+        return await self.record(key, request)
+
+    async def replay(self, interaction: dict, request: httpx.Request) -> httpx.Response:
+        response = interaction["response"]
+        await asyncio.sleep(self.latency if self.latency is not None else response["elapsed"])
+
+        body = response["body"].encode()
+        if response["headers"].get("content-type", "").startswith("text/event-stream"):
+            # Streams are replayed event by event so consumers see the same chunking as live
+            chunks = [event + b"\n\n" for event in body.split(b"\n\n") if event]
+        else:
+            chunks = [body]
+        return httpx.Response(response["status"], headers=response["headers"], stream=ReplayStream(chunks, self.chunk_latency), request=request)
+
+    async def record(self, key: str, request: httpx.Request) -> httpx.Response:
+        if self.upstream is None:
+            self.upstream = httpx.AsyncHTTPTransport()
+
+        start = time.perf_counter()
+        upstream_response = await self.upstream.handle_async_request(request)
+        response = httpx.Response(upstream_response.status_code, headers=upstream_response.headers, stream=upstream_response.stream, request=request)
+        body = await response.aread()
+        elapsed = time.perf_counter() - start
+
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in DROPPED_HEADERS}
+        interaction = {
+            "key": key,
+            "request": {"method": request.method, "path": request.url.path},
+            "response": {"status": response.status_code, "headers": headers, "body": body.decode(), "elapsed": round(elapsed, 4)},
+        }
+        with self.lock:
+            if key not in self.fresh:
+                self.interactions[key] = []
+                self.fresh.add(key)
+            self.interactions[key].append(interaction)
+            self.recorded += 1
+            self.save()
+        return httpx.Response(response.status_code, headers=headers, content=body, request=request)
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as cassette:
+            interactions = [interaction for recordings in self.interactions.values() for interaction in recordings]
+            json.dump({"version": 1, "interactions": interactions}, cassette, ensure_ascii=False, indent=1)
+        os.replace(temporary_path, self.path)
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "mode": self.mode,
+            "recorded": self.recorded,
+            "replayed": self.replays,
+        }
+
+    async def aclose(self):
+        if self.upstream is not None:
+            await self.upstream.aclose()
+
+
+cassette_transport: CassetteTransport | None = None
+
+def shared_cassette_transport(upstream: httpx.AsyncBaseTransport | None = None) -> CassetteTransport | None:
+    "The transport recording or replaying every model tier's requests, when GEO_LLM_CASSETTE is set"
+    global cassette_transport
+    if CASSETTE_PATH and cassette_transport is None:
+        cassette_transport = CassetteTransport.from_env(upstream)
+    return cassette_transport
@@ -0,0 +1,70 @@
+import os
+import re
+from typing import Dict, Tuple
+
+from langchain_core.messages import AIMessage
+
+from aggregation import normalize_url
+
+
+# Characters of research text kept in the session, around 1000 tokens
+RESEARCH_SUMMARY_CHARS = int(os.getenv("GEO_RESEARCH_SUMMARY_CHARS", "4000"))
+# Distinct sources listed under the research, links past them are dropped from the text
+RESEARCH_MAX_SOURCES = 20
+
+# Web search cites inline as "([copapel.com.br](https://copapel.com.br/...?utm_source=openai))"
+CITATION_LINK = re.compile(r"\(?\[([^\]]*)\]\((https?://[^\s)]+)\)\)?")
+CITATION_NUMBER = re.compile(r"\[(\d+)\]")
+
+
+def citation_titles(message: AIMessage) -> Dict[str, str]:
+    "Page titles of the url_citation annotations of a Responses API message, by normalized URL"
+    blocks = message.content if isinstance(message.content, list) else []
+    return {
+        normalize_url(annotation["url"]): annotation.get("title")
+        for block in blocks if isinstance(block, dict)
+        for annotation in block.get("annotations") or [] if annotation.get("type") == "url_citation"
+    }
+
+
+def truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    # Whole paragraphs when they fill at least half the room, whole words otherwise
+    cut = text.rfind("\n\n", 0, max_chars)
+    if cut < max_chars // 2:
+        cut = text.rfind(" ", 0, max_chars)
+    if cut <= 0:
+        cut = max_chars
+    return text[:cut].rstrip() + " …"
+
+
+def compact_research(message: AIMessage, max_chars: int = RESEARCH_SUMMARY_CHARS) -> AIMessage:
+    """
+    The research answer as plain text of at most max_chars, its inline links replaced by numbered
+    references to a deduplicated source table appended at the end.
+    Annotations, tool outputs and response metadata are dropped: every later node and every checkpoint
+    only carries what the keyword step reads.
+    """
+    titles = citation_titles(message)
+    sources: Dict[str, Tuple[int, str]] = {}
+
+    def cite(match: re.Match) -> str:
+        label, url = match.groups()
+        key = normalize_url(url)
+        if key not in sources:
+            if len(sources) >= RESEARCH_MAX_SOURCES:
+                return ""
+            sources[key] = (len(sources) + 1, titles.get(key) or label or key)
+        return f"[{sources[key][0]}]"
+
+    text = CITATION_LINK.sub(cite, message.text())
+    text = re.sub(r"[ \t]+", " ", text)
+    text = re.sub(r" +([.,;:])", r"\1", text)
+    summary = truncate(re.sub(r"\n{3,}", "\n\n", text).strip(), max_chars)
+
+    # References cut off with the end of the text don't need a line either
+    cited = {int(number) for number in CITATION_NUMBER.findall(summary)}
+    lines = [f"[{number}] {title} - {url}" for url, (number, title) in sources.items() if number in cited]
+    content = summary + ("\n\nSources:\n" + "\n".join(lines) if lines else "")
+    return AIMessage(content=content, id=message.id, name=message.name)
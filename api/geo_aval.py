@@ -1,43 +1,91 @@
 import os
+import asyncio
+import functools
 from dotenv import load_dotenv
 from typing_extensions import TypedDict, Optional, Literal
-from rich.console import Console
 
 from langgraph.graph import MessagesState, StateGraph, END
+from langgraph.config import get_stream_writer
 from langchain_core.runnables import RunnableConfig
 
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage, AIMessage
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langgraph.checkpoint.memory import InMemorySaver
+from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage, AIMessage, messages_from_dict, messages_to_dict
+from langgraph.checkpoint.base import BaseCheckpointSaver
 
 from pydantic import BaseModel, Field
-from typing import List
-from rich.pretty import pprint as rpprint
-
-from prompts.en_US import (
-    web_info_gathering_prompt,
-    keywords_organization_prompt,
-    refine_keywords_prompt,
-    structure_brands_dominance_prompt,
-    resume_target_info_prompt
-)
-from prompts.pt_BR import (
-    web_info_gathering_prompt,
-    keywords_organization_prompt,
-    refine_keywords_prompt,
-    structure_brands_dominance_prompt,
-    resume_target_info_prompt
-)
+from typing import TYPE_CHECKING, Annotated, Awaitable, Callable, Dict, List
+
+from sessions import make_checkpointer
+from search_cache import BRAND_PROFILE_CACHE_PATH, BRAND_PROFILE_MAX_ENTRIES, BRAND_PROFILE_TTL, SearchCache
+from rankings_history import RankingsHistory
+from singleflight import SingleFlight
+from runnable_cache import RunnableCache
+from compaction import compact_research
+from aggregation import CityComparison, RankedCompany, compare_cities, rank_companies
+from cassette import shared_cassette_transport
+from openai_http import OPENAI_TIMEOUT, async_http_client, shared_pooled_transport, shared_sync_http_client
+from scheduler import SCHEDULER_ENABLED, OpenAIScheduler, ScheduledTransport
+from metrics import KEYWORDS_TIMED_OUT, SEARCHES_DROPPED, SEARCHES_OVER_BUDGET, register_metrics_handler
+from hedging import DEFAULT_HEDGE_COST_BUDGET_USD, HEDGING_DEFAULT, HedgedCalls, HedgePolicy, HedgeThrottle
+from usage import BudgetExceededError, SearchBudget, UsageTracker, batch_model, merge_usage, track_usage
+from openai_batch import BatchTransport, parse_structured_output, parse_web_search, run_batch, structured_output_body, web_search_body
+
+import prompts
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
 
 
 load_dotenv()
 
 # LLM initialization 
 
-dumbass_llm = ChatOpenAI(model="gpt-4.1-nano", api_key=os.getenv("GEO_AVAL_API_KEY"))
-llm = ChatOpenAI(model="gpt-4.1-mini", api_key=os.getenv("GEO_AVAL_API_KEY"))
-smart_llm = ChatOpenAI(model="gpt-4.1", api_key=os.getenv("GEO_AVAL_API_KEY"))
+# Every tier shares one HTTP client, so all outbound OpenAI calls go through the same scheduler (and cassette, when set)
+# and reuse the same pooled connections
+llm_scheduler = OpenAIScheduler()
+llm_transport = shared_cassette_transport(upstream=shared_pooled_transport()) or shared_pooled_transport()
+if SCHEDULER_ENABLED:
+    llm_transport = ScheduledTransport(llm_scheduler, llm_transport)
+
+@functools.cache
+def llm_client_kwargs() -> dict:
+    return {
+        "api_key": os.getenv("GEO_AVAL_API_KEY"),
+        # ChatOpenAI's default of None would turn every timeout off
+        "timeout": OPENAI_TIMEOUT,
+        "http_async_client": async_http_client(llm_transport),
+        "http_client": shared_sync_http_client(),
+        # Makes streamed calls report tokens too
+        "stream_usage": True,
+    }
+
+# Model of each tier. The clients (dumbass_llm, llm, smart_llm) are built on first use: langchain_openai and the
+# openai SDK take longer to import than the rest of the app, a worker is ready without them.
+# Assigning one (tests do) replaces it.
+MODEL_NAMES = {
+    "dumbass_llm": "gpt-4.1-nano",
+    "llm": "gpt-4.1-mini",
+    "smart_llm": "gpt-4.1",
+}
+
+def get_llm(tier: str) -> "ChatOpenAI":
+    client = globals().get(tier)
+    if client is None:
+        from langchain_openai import ChatOpenAI
+        client = globals()[tier] = ChatOpenAI(model=MODEL_NAMES[tier], **llm_client_kwargs())
+    return client
+
+def __getattr__(name: str):
+    if name in MODEL_NAMES:
+        return get_llm(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Tier label of each model in /metrics
+MODEL_TIERS = {
+    MODEL_NAMES["dumbass_llm"]: "nano",
+    MODEL_NAMES["llm"]: "mini",
+    MODEL_NAMES["smart_llm"]: "smart",
+}
+register_metrics_handler(MODEL_TIERS)
 
 # Structured Outputs
 
@@ -51,25 +99,78 @@ class DominanceGraph(BaseModel):
     "List of companies cited"
     companies: List[Company]
 
+class KeywordDominance(BaseModel):
+    "Companies cited for one search"
+    keyword: str = Field(description="The search exactly as given")
+    companies: List[Company]
+
+class BatchedDominanceGraph(BaseModel):
+    "Companies cited for each search, one item per search"
+    results: List[KeywordDominance]
+
 class Keywords(TypedDict):
     keywords: List[str] = Field(description="List of the keywords abstracted from given info")
 
 # Agent definition
 
+# How many keywords gather_results searches + structures at the same time, unless the request sets search_concurrency
+DEFAULT_SEARCH_CONCURRENCY = int(os.getenv("GEO_SEARCH_CONCURRENCY", 10))
+
+# "per_keyword" structures every search on its own, "batched" packs several searches in one structuring call
+STRUCTURING_MODES = ("per_keyword", "batched")
+# Input tokens a batched structuring call is packed up to, the system prompt not included
+DEFAULT_STRUCTURING_TOKEN_BUDGET = 12000
+# Rough estimate used to pack batches, close enough without shipping a tokenizer
+CHARS_PER_TOKEN = 4
+
 # Since tools will be different for different runtimes place them in config?
 class ConfigSchema(TypedDict):
     tools: List[dict]
     language: Literal["pt_BR", "en_US"]
     location: str
+    search_concurrency: int
+    use_cache: bool
+    structuring_mode: Literal["per_keyword", "batched"]
+    structuring_token_budget: int
+    token_budget: int
+    search_budget: int
+    deadline_seconds: float
+    hedge: bool
+    hedge_cost_budget_usd: float
+    refresh_profile: bool
+    # Searches the session's keywords in each of these cities instead of its own location
+    cities: List[str]
 
 class State(MessagesState):
     target: str
     keywords: List[str]
     graph: DominanceGraph | None
+    rankings: List[RankedCompany] | None
+    # {node: {model: {calls, input_tokens, output_tokens, web_searches}}}, summed over the whole session
+    usage: Annotated[dict, merge_usage]
+    skipped_keywords: List[str] | None
+    timed_out_keywords: List[str] | None
+    # From the config of the session's first request, resuming it doesn't have to repeat them
+    language: str | None
+    location: str | None
+    # Research and keywords of the brand found in the profile cache, set when both nodes are skipped
+    brand_profile: dict | None
+    # Multi-city runs only: {city: {graph, rankings, skipped_keywords, timed_out_keywords}} and the brands lined up across cities
+    city_results: dict | None
+    comparison: List[CityComparison] | None
 
 class Agent():
-    def __init__(self):
-        self.console = Console()
+    def __init__(self, checkpointer: BaseCheckpointSaver | None = None, search_cache: SearchCache | None = None, history: RankingsHistory | None = None, brand_profiles: SearchCache | None = None):
+        self.runnables = RunnableCache()
+        self.search_cache = search_cache or SearchCache()
+        self.brand_profiles = brand_profiles or SearchCache(ttl_seconds=BRAND_PROFILE_TTL, max_entries=BRAND_PROFILE_MAX_ENTRIES, path=BRAND_PROFILE_CACHE_PATH)
+        self.history = history or RankingsHistory()
+        # Identical searches running at the same time (from any session) share one upstream call
+        self.search_flights = SingleFlight()
+        # Latency history of the web search calls and the process wide hedge budget, shared by every session
+        self.hedge_throttle = HedgeThrottle()
+        self.research_calls = HedgedCalls("web_research", self.hedge_throttle)
+        self.search_calls = HedgedCalls("keyword_search", self.hedge_throttle)
         
         builder = StateGraph(State, config_schema=ConfigSchema)
         builder.add_node("starting_node", self.starting_node)
@@ -84,8 +185,8 @@ class Agent():
         builder.add_edge("gather_results", END)
         
 
-        checkpointer = InMemorySaver()
-        self.graph = builder.compile(checkpointer=checkpointer, interrupt_after=["get_keywords"])
+        self.checkpointer = checkpointer or make_checkpointer()
+        self.graph = builder.compile(checkpointer=self.checkpointer, interrupt_after=["get_keywords"])
     
     def get_graph(self):
         return self.graph
@@ -94,6 +195,10 @@ class Agent():
     def get_from_config(config: RunnableConfig, key: str):
         return config["configurable"].get(key, None)
 
+    def get_setting(self, state: State, config: RunnableConfig, key: str):
+        "language or location of the request, or of the session when the request resumes it without them"
+        return self.get_from_config(config, key) or state.get(key)
+
     @staticmethod
     def add_city_to_keywords(keywords: List[str], city: str):
         """
@@ -114,85 +219,559 @@ class Agent():
 
     @staticmethod
     def get_prompt(prompt: str, language: str):
-        if language == "en_US":
-            import prompts.en_US as en_prompts
-            return getattr(en_prompts, prompt)
-        else:
-            import prompts.pt_BR as pt_prompts
-            return getattr(pt_prompts, prompt)
-        
-    def starting_node(self, state: State):
-        return { "messages": [] }
+        return prompts.get_prompt(prompt, language)
+
+    def get_chain(self, prompt: str, language: str, tier: str, schema: type | None = None):
+        "prompt | the tier's client (with structured output when a schema is given), built once and reused by every call"
+        def build(client):
+            return self.get_prompt(prompt, language) | (client.with_structured_output(schema) if schema is not None else client)
+        return self.runnables.get((prompt, language, tier, schema), get_llm(tier), build)
+
+    def get_web_search_chain(self, prompt: str | None, language: str | None, city: str, tier: str = "llm"):
+        "The tier's client with the web search tool of the city bound, after the prompt when there is one"
+        def build(client):
+            searcher = client.bind_tools([self.get_openai_web_research_tool(city)])
+            return self.get_prompt(prompt, language) | searcher if prompt else searcher
+        return self.runnables.get((prompt, language, tier, "web_search", city), get_llm(tier), build)
+
+    async def starting_node(self, state: State, config: RunnableConfig):
+        update = {
+            "messages": [],
+            "language": self.get_setting(state, config, "language"),
+            "location": self.get_setting(state, config, "location"),
+            "brand_profile": None,
+        }
+        if not state.get("keywords"):
+            profile = await self.load_brand_profile(state.get("target"), update["location"], update["language"], config)
+            if profile is not None:
+                update["messages"] = messages_from_dict(profile["messages"])
+                update["brand_profile"] = profile
+        return update
 
     def route_starting_node(self, state: State):
         keywords = state.get("keywords")
         if keywords and len(keywords) > 0:
             return "gather_results"
+        elif state.get("brand_profile"):
+            # Stops after get_keywords like any new session, with the cached keywords
+            return "get_keywords"
         else:
             return "web_research"
 
+    def brand_profile_key(self, target: str, city: str, language: str) -> str:
+        # Research and keywords come from two models, a different pair would pick other keywords
+        return self.brand_profiles.key(target, city, language, f"{get_llm('llm').model_name}+{get_llm('smart_llm').model_name}")
 
-    def research_target(self, state: State, config: RunnableConfig):
-        target = state.get("target")
-        city = self.get_from_config(config, "location")
-        language = self.get_from_config(config, "language")
-        web_research_tool = self.get_openai_web_research_tool(city)
+    async def load_brand_profile(self, target: str, city: str, language: str, config: RunnableConfig) -> dict | None:
+        if self.get_from_config(config, "refresh_profile"):
+            self.brand_profiles.record_bypass()
+            return None
+        return await self.brand_profiles.get(self.brand_profile_key(target, city, language))
 
+    async def save_brand_profile(self, state: State, messages: list, keywords: List[str]):
+        if keywords:
+            await self.brand_profiles.set(
+                self.brand_profile_key(state.get("target"), state.get("location"), state.get("language")),
+                {"messages": messages_to_dict(messages), "keywords": keywords},
+            )
 
-        web_researcher_agent = self.get_prompt(language=language, prompt="web_info_gathering_prompt") | llm.bind_tools([web_research_tool]) # The tool called directly in the openAI model runs automatically
-        
-        research_result = web_researcher_agent.invoke({"messages": [HumanMessage(content=target)]})
 
-        return { "messages": [HumanMessage(target), research_result] }
+    async def research_target(self, state: State, config: RunnableConfig):
+        target = state.get("target")
+        city = self.get_setting(state, config, "location")
+        language = self.get_setting(state, config, "language")
+        # The tool called directly in the openAI model runs automatically
+        web_researcher_agent = self.get_web_search_chain("web_info_gathering_prompt", language, city)
+
+        with track_usage() as usage:
+            research_result = await self.research_calls.run(
+                lambda: web_researcher_agent.ainvoke({"messages": [HumanMessage(content=target)]}),
+                hedge=self.prepare_hedging(config),
+            )
+
+        # Only the compacted research goes in the state: every checkpoint, get_keywords prompt and brand profile copies it
+        return { "messages": [HumanMessage(target), compact_research(research_result)], "usage": {"web_research": usage.snapshot()} }
     
-    def get_keywords(self, state: State, config: RunnableConfig):
+    async def get_keywords(self, state: State, config: RunnableConfig):
+        if profile := state.get("brand_profile"):
+            return { "keywords": profile["keywords"], "usage": {"get_keywords": {}} }
+
         messages = state.get("messages")
-        language = self.get_from_config(config, "language")
-        keyword_organizer_agent = self.get_prompt(prompt="keywords_organization_prompt", language=language) | smart_llm.with_structured_output(Keywords)
+        language = self.get_setting(state, config, "language")
+        keyword_organizer_agent = self.get_chain("keywords_organization_prompt", language, "smart_llm", Keywords)
         keywords = []
         last_length = 1
-        for chunk in keyword_organizer_agent.stream({"messages": messages}):
-            if 'keywords' in chunk and chunk['keywords']:
-                new_length = len(chunk["keywords"])
-                if new_length > last_length:
-                    keyword = chunk["keywords"][-2]
-                    print(f"Keyword found: {keyword}")
-                    keywords.append(keyword)
-                    last_length = new_length
-        
-        return { "keywords": keywords }
+        with track_usage() as usage:
+            async for chunk in keyword_organizer_agent.astream({"messages": messages}):
+                if 'keywords' in chunk and chunk['keywords']:
+                    new_length = len(chunk["keywords"])
+                    if new_length > last_length:
+                        keyword = chunk["keywords"][-2]
+                        print(f"Keyword found: {keyword}")
+                        keywords.append(keyword)
+                        last_length = new_length
+
+        await self.save_brand_profile(state, messages, keywords)
+        return { "keywords": keywords, "usage": {"get_keywords": usage.snapshot()} }
                 
-    def gather_cited_companies(self, state: State, config: RunnableConfig):
+    @staticmethod
+    def web_research_was_called(response: AIMessage):
+        tool_called = response.additional_kwargs.get("tool_outputs")
+        return tool_called is not None and len(tool_called) > 0
+
+    def get_search_agents(self, language: str, city: str):
+        searcher = self.get_web_search_chain(None, None, city)
+        structurer_agent = self.get_chain("structure_brands_dominance_prompt", language, "llm", DominanceGraph)
+        return searcher, structurer_agent
+
+    def get_batched_structurer_agent(self, language: str):
+        return self.get_chain("structure_batched_brands_dominance_prompt", language, "llm", BatchedDominanceGraph)
+
+    async def web_search(self, keyword: str, searcher, hedge: HedgePolicy | None = None) -> AIMessage | None:
+        """
+        Searches a single formatted keyword, raising TimeoutError when the call misses its deadline.
+        Returns None when the model answered without triggering web research.
+        """
+        response = await self.search_calls.run(lambda: searcher.ainvoke([HumanMessage(keyword)]), hedge=hedge)
+
+        # Filter out responses that did not trigger web research
+        if not self.web_research_was_called(response):
+            SEARCHES_DROPPED.inc()
+            return None
+        return response
+
+    async def search_keyword(self, keyword: str, searcher, structurer_agent, hedge: HedgePolicy | None = None) -> List[Company] | None:
+        """
+        Searches a single formatted keyword and structures the cited companies.
+        Returns None when the model answered without triggering web research.
+        """
+        response = await self.web_search(keyword, searcher, hedge)
+        if response is None:
+            return None
+
+        dominance = await structurer_agent.ainvoke({"web_results": [response]})
+        return dominance.companies if dominance else None
+
+    @staticmethod
+    def batched_search_message(keyword: str, response: AIMessage) -> HumanMessage:
+        return HumanMessage(f"## Search: {keyword}\n\n{response.text()}")
+
+    @staticmethod
+    def estimate_tokens(message: HumanMessage) -> int:
+        return len(message.content) // CHARS_PER_TOKEN + 1
+
+    @classmethod
+    def pack_batches(cls, messages: List[tuple[str, HumanMessage]], token_budget: int) -> List[List[tuple[str, HumanMessage]]]:
+        """
+        Greedily packs (keyword, message) pairs in order into batches of at most token_budget estimated tokens.
+        A single message over the budget still gets a batch of its own.
+        """
+        batches, batch, batch_tokens = [], [], 0
+        for keyword, message in messages:
+            tokens = cls.estimate_tokens(message)
+            if batch and batch_tokens + tokens > token_budget:
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append((keyword, message))
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @staticmethod
+    def match_batched_results(keywords: List[str], dominance: BatchedDominanceGraph | None) -> dict[str, List[Company]]:
+        # The model echoes the search text back, whitespace and casing aren't guaranteed
+        normalize = lambda text: " ".join(text.lower().split())
+        by_keyword = {normalize(result.keyword): result.companies for result in (dominance.results if dominance else [])}
+        return {keyword: by_keyword[normalize(keyword)] for keyword in keywords if normalize(keyword) in by_keyword}
+
+    def prepare_keywords_search(self, state: State, city: str):
         keywords = state.get("keywords")
-        language = self.get_from_config(config, "language")
-        city = self.get_from_config(config, "location")
-        web_research_tool = self.get_openai_web_research_tool(city)
 
         if keywords and len(keywords) == 0:
             raise Exception("No keywords given for gathering results.")
         if len(keywords) > 10:
             keywords = keywords[0:4]
 
-        formatted_keywords = self.add_city_to_keywords(keywords, city)
-
-        gathered_results = []
-        for keyword in formatted_keywords:
-            agent = ChatPromptTemplate([HumanMessage(keyword)]) | llm.bind_tools([web_research_tool])
-            response = agent.invoke({})
-            tool_called = response.additional_kwargs.get("tool_outputs")
-            
-            # Filter out responses that did not trigger web research
-            if tool_called is not None and len(tool_called) > 0:
-                structurer_agent = self.get_prompt(prompt="structure_brands_dominance_prompt", language=language) | llm.with_structured_output(DominanceGraph)
-                for chunk in structurer_agent.stream({"web_results": [response]}):
-                    
-                    if isinstance(chunk, DominanceGraph) and chunk.companies:
-                        companies = chunk.companies
-                        gathered_results.append(companies)
-
-        flattened_companies = [company for companies_list in gathered_results for company in companies_list]
-        return { "graph": flattened_companies }
+        return keywords, self.add_city_to_keywords(keywords, city)
+
+    def prepare_concurrency(self, config: RunnableConfig) -> asyncio.Semaphore:
+        "Limit on the searches of a request running at once, across every city it searches"
+        concurrency = self.get_from_config(config, "search_concurrency") or DEFAULT_SEARCH_CONCURRENCY
+        if concurrency < 1:
+            raise Exception("search_concurrency must be at least 1.")
+        return asyncio.Semaphore(concurrency)
+
+    def prepare_structuring(self, config: RunnableConfig):
+        mode = self.get_from_config(config, "structuring_mode") or "per_keyword"
+        if mode not in STRUCTURING_MODES:
+            raise Exception(f"structuring_mode must be one of {', '.join(STRUCTURING_MODES)}.")
+
+        token_budget = self.get_from_config(config, "structuring_token_budget") or DEFAULT_STRUCTURING_TOKEN_BUDGET
+        if token_budget < 1:
+            raise Exception("structuring_token_budget must be at least 1.")
+
+        return mode, token_budget
+
+    def prepare_budget(self, config: RunnableConfig, usage) -> SearchBudget:
+        token_budget = self.get_from_config(config, "token_budget")
+        search_budget = self.get_from_config(config, "search_budget")
+        if (token_budget is not None and token_budget < 1) or (search_budget is not None and search_budget < 0):
+            raise Exception("token_budget must be at least 1 and search_budget can't be negative.")
+        return SearchBudget(usage, max_tokens=token_budget, max_searches=search_budget)
+
+    def prepare_hedging(self, config: RunnableConfig) -> HedgePolicy | None:
+        hedge = self.get_from_config(config, "hedge")
+        if not (HEDGING_DEFAULT if hedge is None else hedge):
+            return None
+        cost_budget = self.get_from_config(config, "hedge_cost_budget_usd")
+        if cost_budget is not None and cost_budget < 0:
+            raise Exception("hedge_cost_budget_usd can't be negative.")
+        return HedgePolicy(get_llm("llm").model_name, DEFAULT_HEDGE_COST_BUDGET_USD if cost_budget is None else cost_budget)
+
+    def prepare_deadline(self, config: RunnableConfig) -> float | None:
+        "Event loop time the keyword searches have to be done by, None when the request has no deadline"
+        deadline_seconds = self.get_from_config(config, "deadline_seconds")
+        if deadline_seconds is None:
+            return None
+        if deadline_seconds <= 0:
+            raise Exception("deadline_seconds must be positive.")
+        return asyncio.get_running_loop().time() + deadline_seconds
+
+    @staticmethod
+    def flatten_results(gathered_results: List[List[Company] | None]):
+        # Results are kept in keyword order regardless of which search finished first
+        return [company for companies_list in gathered_results if companies_list for company in companies_list]
+
+    async def gather_cited_companies(self, state: State, config: RunnableConfig):
+        cities = self.get_from_config(config, "cities")
+        with track_usage() as usage:
+            # Budget, deadline, hedging and the concurrency limit hold for the whole request, however many cities it searches
+            limits = (self.prepare_budget(config, usage), self.prepare_hedging(config), self.prepare_deadline(config), self.prepare_concurrency(config))
+            if cities:
+                results = await self.gather_cities(state, config, cities, *limits)
+            else:
+                city = self.get_setting(state, config, "location")
+                results = await self.city_results(*await self.gather_city(state, config, city, *limits))
+                await self.record_history(state, config, results["rankings"], city)
+                results = {**results, "city_results": None, "comparison": None}
+        return {**results, "usage": {"gather_results": usage.snapshot()}}
+
+    async def gather_cities(self, state: State, config: RunnableConfig, cities: List[str], *limits):
+        """
+        Searches the session's keywords in every city at once, the research and keywords behind them are the session's own.
+        Returns the overall results (every city's citations merged), the results of each city and the brands compared across cities.
+        """
+        gathered = await asyncio.gather(*[self.gather_city(state, config, city, *limits) for city in cities])
+        city_results = {city: await self.city_results(*results) for city, results in zip(cities, gathered)}
+        for city, results in city_results.items():
+            await self.record_history(state, config, results["rankings"], city)
+
+        keywords = gathered[0][0]
+        skipped = {keyword for _, _, skipped_keywords, _ in gathered for keyword in skipped_keywords}
+        timed_out = {keyword for _, _, _, timed_out_keywords in gathered for keyword in timed_out_keywords}
+        rankings = await asyncio.to_thread(rank_companies, [
+            (keyword, companies) for keywords, gathered_results, _, _ in gathered for keyword, companies in zip(keywords, gathered_results)
+        ])
+        comparison = await asyncio.to_thread(compare_cities, {city: results["rankings"] for city, results in city_results.items()})
+        return {
+            "graph": [company for results in city_results.values() for company in results["graph"]],
+            "rankings": rankings,
+            "skipped_keywords": [keyword for keyword in keywords if keyword in skipped],
+            "timed_out_keywords": [keyword for keyword in keywords if keyword in timed_out],
+            "city_results": city_results,
+            "comparison": comparison,
+        }
+
+    async def city_results(self, keywords: List[str], gathered_results: List[List[Company] | None], skipped_keywords: List[str], timed_out_keywords: List[str]) -> dict:
+        return {
+            "graph": self.flatten_results(gathered_results),
+            # Merging many companies takes a while, the event loop keeps serving other requests meanwhile
+            "rankings": await asyncio.to_thread(rank_companies, list(zip(keywords, gathered_results))),
+            # Kept in keyword order, whatever order the budget ran out in
+            "skipped_keywords": [keyword for keyword in keywords if keyword in skipped_keywords],
+            "timed_out_keywords": [keyword for keyword in keywords if keyword in timed_out_keywords],
+        }
+
+    async def record_history(self, state: State, config: RunnableConfig, rankings: List[RankedCompany], city: str):
+        # The rankings are already there for the caller, a history write failing doesn't take them away
+        try:
+            await self.history.record(
+                state.get("target"), city, self.get_setting(state, config, "language"),
+                rankings, session_id=self.get_from_config(config, "thread_id"),
+            )
+        except Exception as e:
+            print(f"Rankings history not recorded: {e}")
+
+    async def gather_city(self, state: State, config: RunnableConfig, city: str, budget: SearchBudget, hedge: HedgePolicy | None, deadline: float | None, semaphore: asyncio.Semaphore):
+        """
+        Searches and structures the session's keywords in one city.
+        Returns the keywords, the companies found for each (None when nothing was), and the keywords skipped and timed out.
+        """
+        language = self.get_setting(state, config, "language")
+        keywords, formatted_keywords = self.prepare_keywords_search(state, city)
+        structuring_mode, structuring_budget = self.prepare_structuring(config)
+        searcher, structurer_agent = self.get_search_agents(language, city)
+        writer = get_stream_writer()
+        skipped_keywords = []
+        timed_out_keywords = []
+
+        # Cache is read unless the request opts out, fresh results are always written back
+        use_cache = self.get_from_config(config, "use_cache") is not False
+
+        async def cache_lookup(keyword: str):
+            cache_key = self.search_cache.key(keyword, city, language, get_llm("llm").model_name)
+            if not use_cache:
+                self.search_cache.record_bypass()
+                return cache_key, None
+            cached = await self.search_cache.get(cache_key)
+            return cache_key, [Company(**company) for company in cached] if cached is not None else None
+
+        async def cache_store(cache_key: str, companies: List[Company] | None):
+            if companies is not None:
+                await self.search_cache.set(cache_key, [company.model_dump() for company in companies])
+
+        def publish(keyword: str, companies: List[Company] | None):
+            # Sent on the "custom" stream as soon as the keyword is done, so streams can draw the graph progressively
+            writer({"keyword": keyword, "city": city, "companies": companies or []})
+
+        def skip(keyword: str):
+            SEARCHES_OVER_BUDGET.inc()
+            skipped_keywords.append(keyword)
+            writer({"keyword": keyword, "city": city, "companies": [], "skipped": True})
+
+        def time_out(keyword: str):
+            # A search still running keeps going in its single flight task and fills the cache for the next request
+            KEYWORDS_TIMED_OUT.inc()
+            timed_out_keywords.append(keyword)
+            writer({"keyword": keyword, "city": city, "companies": [], "timed_out": True})
+
+        async def budgeted_flight(key: str, search):
+            # Joining an identical search already running costs nothing, starting one has to fit in the budget
+            if self.search_flights.in_flight(key):
+                return await self.search_flights.do(key, search)
+            if not budget.try_start():
+                raise BudgetExceededError(key)
+            try:
+                return await self.search_flights.do(key, search)
+            finally:
+                budget.finish()
+
+        if structuring_mode == "batched":
+            gathered_results = await self.gather_batched(
+                keywords, formatted_keywords, searcher, structurer_agent, language, structuring_budget, semaphore,
+                cache_lookup, cache_store, publish, skip, budgeted_flight, hedge, deadline, time_out,
+            )
+        else:
+            async def search_and_publish(keyword: str, formatted_keyword: str):
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        cache_key, companies = await cache_lookup(formatted_keyword)
+                        if companies is None:
+                            async def search():
+                                async with semaphore:
+                                    companies = await self.search_keyword(formatted_keyword, searcher, structurer_agent, hedge)
+                                await cache_store(cache_key, companies)
+                                return companies
+                            try:
+                                companies = await budgeted_flight(cache_key, search)
+                            except BudgetExceededError:
+                                skip(keyword)
+                                return None
+                except TimeoutError:
+                    time_out(keyword)
+                    return None
+                publish(keyword, companies)
+                return companies
+
+            gathered_results = await asyncio.gather(*[
+                search_and_publish(keyword, formatted_keyword) for keyword, formatted_keyword in zip(keywords, formatted_keywords)
+            ])
+
+        return keywords, gathered_results, skipped_keywords, timed_out_keywords
+
+    async def gather_batched(self, keywords, formatted_keywords, searcher, structurer_agent, language, structuring_budget, semaphore, cache_lookup, cache_store, publish, skip, budgeted_flight, hedge, deadline, time_out):
+        """
+        Runs the web searches one per keyword, then structures them in as few calls as the token budget allows.
+        Keywords the model leaves out of a batch answer are structured on their own.
+        Keywords not structured by the deadline are timed out, the rest of their batch still counts.
+        """
+        batched_structurer_agent = self.get_batched_structurer_agent(language)
+        results: dict[str, List[Company] | None] = {}
+
+        async def search_uncached(keyword: str, formatted_keyword: str):
+            cache_key, companies = await cache_lookup(formatted_keyword)
+            if companies is not None:
+                results[keyword] = companies
+                publish(keyword, companies)
+                return None
+
+            async def search():
+                async with semaphore:
+                    return await self.web_search(formatted_keyword, searcher, hedge)
+            # Only the web search is shared with other sessions, structuring depends on what it's batched with
+            try:
+                async with asyncio.timeout_at(deadline):
+                    response = await budgeted_flight(f"search:{cache_key}", search)
+            except BudgetExceededError:
+                results[keyword] = None
+                skip(keyword)
+                return None
+            except TimeoutError:
+                results[keyword] = None
+                time_out(keyword)
+                return None
+            if response is None:
+                results[keyword] = None
+                publish(keyword, None)
+                return None
+            return keyword, formatted_keyword, cache_key, response
+
+        searched = [
+            item for item in await asyncio.gather(*[
+                search_uncached(keyword, formatted_keyword) for keyword, formatted_keyword in zip(keywords, formatted_keywords)
+            ]) if item is not None
+        ]
+        pending = {formatted_keyword: (keyword, cache_key, response) for keyword, formatted_keyword, cache_key, response in searched}
+
+        async def structure_within_deadline(batch: List[tuple[str, HumanMessage]]):
+            try:
+                async with asyncio.timeout_at(deadline):
+                    await structure(batch)
+            except TimeoutError:
+                for formatted_keyword, _ in batch:
+                    keyword = pending[formatted_keyword][0]
+                    if keyword not in results:
+                        results[keyword] = None
+                        time_out(keyword)
+
+        async def structure(batch: List[tuple[str, HumanMessage]]):
+            async with semaphore:
+                dominance = await batched_structurer_agent.ainvoke({"web_results": [message for _, message in batch]})
+            matched = self.match_batched_results([formatted_keyword for formatted_keyword, _ in batch], dominance)
+
+            for formatted_keyword, _ in batch:
+                keyword, cache_key, response = pending[formatted_keyword]
+                companies = matched.get(formatted_keyword)
+                if companies is None:
+                    print(f"Keyword missing from batched structuring, structuring alone: {formatted_keyword}")
+                    async with semaphore:
+                        dominance = await structurer_agent.ainvoke({"web_results": [response]})
+                    companies = dominance.companies if dominance else None
+                await cache_store(cache_key, companies)
+                results[keyword] = companies
+                publish(keyword, companies)
+
+        messages = [
+            (formatted_keyword, self.batched_search_message(formatted_keyword, response))
+            for formatted_keyword, (_, _, response) in pending.items()
+        ]
+        await asyncio.gather(*[structure_within_deadline(batch) for batch in self.pack_batches(messages, structuring_budget)])
+
+        return [results.get(keyword) for keyword in keywords]
+
+    async def gather_in_openai_batch(self, sessions: List[tuple[dict, RunnableConfig]], transport: BatchTransport, batch_ids: Dict[str, str] | None = None, on_submit: Callable[[str, str], Awaitable[None]] | None = None) -> List[dict]:
+        """
+        gather_results of many sessions stopped after get_keywords, run through OpenAI Batch API files instead of realtime calls:
+        every keyword search of every session not in the cache goes in one file, their structuring in a second one.
+        Identical searches across sessions are sent once and billed to the first session that asked for them.
+        Returns the gather_results state update of each session, in order. Searches the batch didn't answer are timed out.
+        `batch_ids` (endpoint -> batch id) are files already sent for these sessions, waited for instead of sent again,
+        `on_submit(endpoint, batch_id)` is told about every file sent.
+        """
+        batch_ids = batch_ids or {}
+
+        async def send_batch(endpoint: str, bodies: Dict[str, dict]) -> Dict[str, dict]:
+            recorded = on_submit and functools.partial(on_submit, endpoint)
+            return await run_batch(transport, endpoint, bodies, batch_ids.get(endpoint), recorded)
+
+        planned = []
+        # cache key -> companies, None for searches answered without web research
+        results: dict[str, List[Company] | None] = {}
+        # cache key -> (formatted keyword, language, city, index of the session it's billed to)
+        searches: dict[str, tuple[str, str, str, int]] = {}
+        usages = [UsageTracker() for _ in sessions]
+
+        for index, (state, config) in enumerate(sessions):
+            language = self.get_setting(state, config, "language")
+            city = self.get_setting(state, config, "location")
+            keywords, formatted_keywords = self.prepare_keywords_search(state, city)
+            use_cache = self.get_from_config(config, "use_cache") is not False
+            cache_keys = []
+            for formatted_keyword in formatted_keywords:
+                cache_key = self.search_cache.key(formatted_keyword, city, language, get_llm("llm").model_name)
+                cache_keys.append(cache_key)
+                if cache_key in results or cache_key in searches:
+                    continue
+                if not use_cache:
+                    self.search_cache.record_bypass()
+                elif (cached := await self.search_cache.get(cache_key)) is not None:
+                    results[cache_key] = [Company(**company) for company in cached]
+                    continue
+                searches[cache_key] = (formatted_keyword, language, city, index)
+            planned.append((keywords, cache_keys))
+
+        # Named after the search itself, so a file sent before matches the same searches planned again
+        custom_ids = {cache_key: f"search-{cache_key[:32]}" for cache_key in searches}
+        answered = await send_batch("/v1/responses", {
+            custom_ids[cache_key]: web_search_body(get_llm("llm"), [HumanMessage(formatted_keyword)], [self.get_openai_web_research_tool(city)])
+            for cache_key, (formatted_keyword, _, city, _) in searches.items()
+        })
+        responses: dict[str, AIMessage] = {}
+        for cache_key, (_, _, _, index) in searches.items():
+            if (body := answered.get(custom_ids[cache_key])) is None:
+                continue
+            response = parse_web_search(body)
+            self.add_batch_usage(usages[index], response)
+            if not self.web_research_was_called(response):
+                SEARCHES_DROPPED.inc()
+                results[cache_key] = None
+                continue
+            responses[cache_key] = response
+
+        answered = await send_batch("/v1/chat/completions", {
+            custom_ids[cache_key]: structured_output_body(
+                get_llm("llm"),
+                self.get_prompt(prompt="structure_brands_dominance_prompt", language=searches[cache_key][1]).format_messages(web_results=[response]),
+                DominanceGraph,
+            )
+            for cache_key, response in responses.items()
+        })
+        for cache_key in responses:
+            if (body := answered.get(custom_ids[cache_key])) is None:
+                continue
+            message, dominance = parse_structured_output(body, DominanceGraph)
+            self.add_batch_usage(usages[searches[cache_key][3]], message)
+            results[cache_key] = dominance.companies if dominance else None
+            if dominance:
+                await self.search_cache.set(cache_key, [company.model_dump() for company in dominance.companies])
+
+        updates = []
+        for (state, config), (keywords, cache_keys), usage in zip(sessions, planned, usages):
+            gathered_results = [results.get(cache_key) for cache_key in cache_keys]
+            timed_out_keywords = [keyword for keyword, cache_key in zip(keywords, cache_keys) if cache_key not in results]
+            KEYWORDS_TIMED_OUT.inc(len(timed_out_keywords))
+            rankings = await asyncio.to_thread(rank_companies, list(zip(keywords, gathered_results)))
+            await self.record_history(state, config, rankings, self.get_setting(state, config, "location"))
+            updates.append({
+                "graph": self.flatten_results(gathered_results),
+                "rankings": rankings,
+                "skipped_keywords": [],
+                "timed_out_keywords": timed_out_keywords,
+                "usage": {"gather_results": usage.snapshot()},
+            })
+        return updates
 
+    @staticmethod
+    def add_batch_usage(usage: UsageTracker, message: AIMessage):
+        counts = message.usage_metadata or {}
+        usage.add(
+            batch_model(get_llm("llm").model_name),
+            calls=1,
+            input_tokens=counts.get("input_tokens", 0),
+            output_tokens=counts.get("output_tokens", 0),
+            web_searches=sum(1 for output in message.additional_kwargs.get("tool_outputs", []) if output.get("type") == "web_search_call"),
+        )
     
 
 
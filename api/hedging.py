@@ -0,0 +1,145 @@
+import os
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, TypeVar
+
+from metrics import LLM_CALL_TIMEOUTS, HEDGES_SENT, HEDGES_WON
+from usage import ESTIMATED_TOKENS_PER_SEARCH, cost
+
+
+T = TypeVar("T")
+
+# Per web search call, hedge included. The request's own deadline (deadline_seconds) can cut it shorter
+WEB_SEARCH_TIMEOUT_SECONDS = float(os.getenv("GEO_WEB_SEARCH_TIMEOUT_SECONDS", 90))
+
+# Hedging is opt in per request (hedge: true), this turns it on for every request that doesn't say
+HEDGING_DEFAULT = os.getenv("GEO_HEDGING", "off") == "on"
+# A duplicate is sent once the call has taken longer than this quantile of recent calls of its kind
+HEDGE_QUANTILE = 0.95
+# Until enough calls were seen to trust the quantile, hedge after a fixed delay
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("GEO_HEDGE_DEFAULT_DELAY_SECONDS", 20))
+# Process wide, at most this many hedges per call sent, so a slow OpenAI doesn't get twice the load
+HEDGE_BUDGET_RATIO = float(os.getenv("GEO_HEDGE_BUDGET_RATIO", 0.1))
+HEDGE_BUDGET_BURST = 5
+# Per request, in estimated USD of the duplicate calls
+DEFAULT_HEDGE_COST_BUDGET_USD = 0.10
+
+
+class LatencyWindow():
+    "Durations of the most recent successful calls of one kind"
+    def __init__(self, size: int = 500):
+        self.lock = threading.Lock()
+        self.samples: Deque[float] = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        with self.lock:
+            if len(self.samples) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class HedgeThrottle():
+    """
+    Process wide hedge budget: every call sent earns `ratio` of a hedge, every hedge spends one.
+    Keeps hedges a small fraction of the traffic however many calls are slow at once.
+    """
+    def __init__(self, ratio: float = HEDGE_BUDGET_RATIO, burst: int = HEDGE_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = float(burst)
+
+    def record_call(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def try_hedge(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class HedgePolicy():
+    "Hedging allowance of one request: duplicates are sent while their estimated cost fits in its budget"
+    def __init__(self, model: str, cost_budget_usd: float = DEFAULT_HEDGE_COST_BUDGET_USD):
+        self.cost_budget_usd = cost_budget_usd
+        # A hedge repeats the whole web search, its fee included
+        self.hedge_cost = cost(model, {"input_tokens": ESTIMATED_TOKENS_PER_SEARCH, "web_searches": 1})
+        self.lock = threading.Lock()
+        self.spent_usd = 0.0
+        self.hedges = 0
+
+    def try_hedge(self, throttle: HedgeThrottle) -> bool:
+        with self.lock:
+            # The request's cap is checked first, so a capped request doesn't use up the process budget
+            if self.spent_usd + self.hedge_cost > self.cost_budget_usd or not throttle.try_hedge():
+                return False
+            self.spent_usd += self.hedge_cost
+            self.hedges += 1
+            return True
+
+
+class HedgedCalls():
+    """
+    Deadlines and hedging for one kind of call, with the latency history shared by every request.
+    A hedged call sends a duplicate once it's slower than HEDGE_QUANTILE of recent calls, the first to succeed
+    is used and the other cancelled.
+    """
+    def __init__(self, kind: str, throttle: HedgeThrottle):
+        self.kind = kind
+        self.throttle = throttle
+        self.window = LatencyWindow()
+
+    def delay(self) -> float:
+        quantile = self.window.quantile(HEDGE_QUANTILE)
+        return quantile if quantile is not None else HEDGE_DEFAULT_DELAY_SECONDS
+
+    async def run(self, call: Callable[[], Awaitable[T]], timeout: float | None = WEB_SEARCH_TIMEOUT_SECONDS, hedge: HedgePolicy | None = None) -> T:
+        "Runs `call` (hedged when given a policy), raising TimeoutError after `timeout` seconds"
+        try:
+            async with asyncio.timeout(timeout):
+                return await self.hedged(call, hedge)
+        except TimeoutError:
+            LLM_CALL_TIMEOUTS.inc(call=self.kind)
+            raise
+
+    async def timed(self, call: Callable[[], Awaitable[T]]) -> T:
+        start = time.perf_counter()
+        result = await call()
+        self.window.observe(time.perf_counter() - start)
+        return result
+
+    async def hedged(self, call: Callable[[], Awaitable[T]], hedge: HedgePolicy | None) -> T:
+        self.throttle.record_call()
+        tasks = [asyncio.ensure_future(self.timed(call))]
+        try:
+            if hedge is not None:
+                done, _ = await asyncio.wait(tasks, timeout=self.delay())
+                if not done and hedge.try_hedge(self.throttle):
+                    HEDGES_SENT.inc(call=self.kind)
+                    tasks.append(asyncio.ensure_future(self.timed(call)))
+
+            pending, error = set(tasks), None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not tasks[0]:
+                            HEDGES_WON.inc(call=self.kind)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            # The slower call (or both, when the deadline hit) is dropped
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,77 @@
+from datetime import date, datetime, timedelta, timezone
+from typing import Literal, Optional
+
+from fastapi import HTTPException, Query
+
+from api import app
+from api import agent
+
+
+# Periods default to the last 30 days
+DEFAULT_PERIOD_DAYS = 30
+
+
+def period(start: date | None, end: date | None) -> tuple[str, str]:
+    end = end or datetime.now(timezone.utc).date()
+    start = start or end - timedelta(days=DEFAULT_PERIOD_DAYS)
+    if start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end.")
+    return start.isoformat(), end.isoformat()
+
+
+@app.get("/history/share-of-voice", summary="Share Of Voice Trend")
+async def share_of_voice_trend(
+    city: str,
+    language: Literal["pt_BR", "en_US"],
+    brand: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    top: int = Query(default=10, ge=0, le=100),
+):
+    """
+    Daily share of voice of the most cited companies of a city over the period, from every analysis recorded
+    (or only those of `brand`). `top` 0 returns every company.
+    """
+    start, end = period(start, end)
+    rows = await agent.history.share_of_voice(city, language, start, end, brand=brand, top=top)
+
+    companies = {}
+    for row in rows:
+        company = companies.setdefault(row["company_key"], {"company": row["company"], "citations": 0, "points": []})
+        company["citations"] += row["citations"]
+        company["points"].append({"day": row["day"], "citations": row["citations"], "share_of_voice": row["share_of_voice"]})
+    return {
+        "city": city,
+        "language": language,
+        "brand": brand,
+        "start": start,
+        "end": end,
+        "days": sorted({row["day"] for row in rows}),
+        "companies": sorted(companies.values(), key=lambda company: -company["citations"]),
+    }
+
+
+@app.get("/history/rank-changes", summary="Rank Changes")
+async def rank_changes(city: str, language: Literal["pt_BR", "en_US"], brand: Optional[str] = None, start: Optional[date] = None, end: Optional[date] = None):
+    """
+    How each company's rank moved between the first and the last day with recorded analyses in the period.
+    """
+    start, end = period(start, end)
+    return {"city": city, "language": language, "brand": brand, **await agent.history.rank_changes(city, language, start, end, brand=brand)}
+
+
+@app.get("/history/emerging", summary="Emerging Competitors")
+async def emerging_competitors(
+    city: str,
+    language: Literal["pt_BR", "en_US"],
+    brand: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    min_citations: int = Query(default=1, ge=1),
+):
+    """
+    Companies never cited before the period that were cited during it, everything recorded earlier is the baseline.
+    """
+    start, end = period(start, end)
+    companies = await agent.history.emerging(city, language, start, end, brand=brand, min_citations=min_citations)
+    return {"city": city, "language": language, "brand": brand, "start": start, "end": end, "companies": companies}
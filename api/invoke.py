@@ -2,13 +2,15 @@ from fastapi import HTTPException
 import uuid
 
 from langgraph.types import Command
-from rich.pretty import pprint as rpprint
 
 from api import app
-from api import AnalysisRequest, RankingsRequest
-from api import compiled_graph
+from api import AnalysisRequest, RankingsRequest, city_reports
+from api import agent, compiled_graph
 
 from geo_aval import DominanceGraph
+from sessions import SessionNotFoundError, SessionEvictedError
+from usage import usage_report
+from scheduler import llm_priority
 
 
 @app.post("/analyze/get_keywords", summary="Start Analysis Session")
@@ -21,17 +23,18 @@ async def get_keywords(request: AnalysisRequest):
         import uuid
         session_id = str(uuid.uuid4())
         
-        config = {"configurable": {"thread_id": session_id, "language": request.language, "location": request.city}}
+        config = {"configurable": {"thread_id": session_id, "language": request.language, "location": request.city, "refresh_profile": request.refresh_profile}}
         
         #(will stop after keywords were gathered)
-        compiled_graph.invoke({
-            "keywords": [],
-            "target": request.brand_name,
-            "graph": DominanceGraph(companies=[]),
-            "messages": []
-        }, config=config)
+        with llm_priority("standard", session_id):
+            await compiled_graph.ainvoke({
+                "keywords": [],
+                "target": request.brand_name,
+                "graph": DominanceGraph(companies=[]),
+                "messages": []
+            }, config=config)
 
-        graph_state = compiled_graph.get_state(config)
+        graph_state = await compiled_graph.aget_state(config)
         values = graph_state.values
         keywords = values.get("keywords")
 
@@ -48,12 +51,14 @@ async def get_keywords(request: AnalysisRequest):
 async def get_rankings(request: RankingsRequest):
     """
     Gather rankings based on chosen keywords.
+    With `cities`, the keywords are searched in each of them (the research and keywords are done once)
+    and the results come per city, with every brand compared across cities.
     """
     try:
         session_id = request.session_id
         keywords = request.keywords
         language = request.language
-        city = request.city
+        city = request.location()
         brand_name = request.brand_name
 
         if (len(keywords) > 10):
@@ -61,24 +66,41 @@ async def get_rankings(request: RankingsRequest):
 
         if session_id is None:
             new_session_id = str(uuid.uuid4())
-            config = {"configurable": {"thread_id": new_session_id, "language": language, "location": city}}
-            compiled_graph.invoke({
-                "keywords": keywords,
-                "target": brand_name,
-                "graph": DominanceGraph(companies=[]),
-                "messages": []
-            }, config=config)
+            config = {"configurable": {"thread_id": new_session_id, "language": language, "location": city, **request.run_options()}}
+            with llm_priority("standard", new_session_id):
+                await compiled_graph.ainvoke({
+                    "keywords": keywords,
+                    "target": brand_name,
+                    "graph": DominanceGraph(companies=[]),
+                    "messages": []
+                }, config=config)
         else:
-            config = {"configurable": {"thread_id": session_id}}
-            compiled_graph.invoke(Command(resume="", update={
-                "keywords": keywords if len(keywords) > 0 else None
-            }), config=config)
+            await agent.checkpointer.aensure_session(session_id)
+            config = {"configurable": {"thread_id": session_id, **request.run_options()}}
+            with llm_priority("standard", session_id):
+                # Without keywords the session searches the ones it picked
+                await compiled_graph.ainvoke(Command(resume="", update={"keywords": keywords} if keywords else None), config=config)
 
-        values = compiled_graph.get_state(config).values
+        values = (await compiled_graph.aget_state(config)).values
 
         graph = values.get("graph")
+        skipped_keywords = values.get("skipped_keywords") or []
+        timed_out_keywords = values.get("timed_out_keywords") or []
         return {
             "graph": graph,
-        }        
+            "rankings": values.get("rankings"),
+            "usage": usage_report(values.get("usage")),
+            "partial": len(skipped_keywords) + len(timed_out_keywords) > 0,
+            "skipped_keywords": skipped_keywords,
+            "timed_out_keywords": timed_out_keywords,
+            "cities": city_reports(values.get("city_results")),
+            "comparison": values.get("comparison"),
+        }
+    except HTTPException:
+        raise
+    except SessionEvictedError as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except SessionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to refine analysis: {str(e)}")
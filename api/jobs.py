@@ -0,0 +1,572 @@
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+from metrics import BATCH_ITEMS
+from sessions import CHECKPOINT_BACKEND, CHECKPOINT_PATH
+
+
+# Analyses run at once across every batch job, each one fans out its keyword searches on top
+DEFAULT_BATCH_WORKERS = int(os.getenv("GEO_BATCH_WORKERS", 4))
+MAX_JOB_ITEMS = int(os.getenv("GEO_BATCH_MAX_ITEMS", 1000))
+# Jobs kept with their results, the oldest finished ones are dropped past it
+MAX_JOBS = int(os.getenv("GEO_BATCH_MAX_JOBS", 100))
+# SQLite file the jobs and their results are kept in, shared by every worker using it. Defaults to the sessions' file
+# when they are kept in SQLite. "" keeps jobs in process memory, where only the worker that took a job knows about it
+# and a restart loses it
+BATCH_JOBS_PATH = os.getenv("GEO_BATCH_JOBS_PATH", CHECKPOINT_PATH if CHECKPOINT_BACKEND == "sqlite" else "")
+# Seconds between two looks at the job store: results of jobs run by another worker, cancellations, heartbeats
+BATCH_POLL_SECONDS = float(os.getenv("GEO_BATCH_POLL_SECONDS", 2))
+# An unfinished job whose worker hasn't checked in for this long (restarted, crashed) is taken over by another one
+BATCH_STALE_SECONDS = float(os.getenv("GEO_BATCH_STALE_SECONDS", 30))
+
+FINISHED_STATUSES = ("completed", "cancelled")
+
+
+class JobNotFoundError(Exception):
+    def __init__(self, job_id: str):
+        super().__init__(f"Batch job {job_id} not found.")
+        self.job_id = job_id
+
+
+class JobLimitError(Exception):
+    pass
+
+
+ItemRunner = Callable[[dict, dict, str], Awaitable[dict]]
+JobRunFunction = Callable[["BatchJob"], Awaitable[None]]
+
+
+def item_key(item: dict) -> Tuple[str, str, str]:
+    # The same brand asked twice for a city is analysed once, whatever the casing or spacing
+    normalize = lambda text: " ".join(str(text).lower().split())
+    return normalize(item["brand_name"]), normalize(item["city"]), item["language"]
+
+
+class JobStore():
+    """
+    Batch jobs and their result lines in SQLite. Every worker using the file can report on, download and cancel
+    a job whichever worker runs it, and the worker running a job checks in regularly: a job whose worker stopped
+    checking in is taken over by another one, or by the same server once restarted.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            job_id TEXT PRIMARY KEY,
+            execution TEXT NOT NULL,
+            items TEXT NOT NULL,
+            options TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            -- BatchJob.progress() as of its last change, what the other workers report
+            progress TEXT NOT NULL,
+            -- What a worker taking the job over needs besides its results, see BatchJob.state()
+            state TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            heartbeat_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS batch_jobs_status ON batch_jobs (status, heartbeat_at);
+        CREATE INDEX IF NOT EXISTS batch_jobs_owner ON batch_jobs (owner);
+        CREATE TABLE IF NOT EXISTS batch_job_results (
+            job_id TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            result TEXT NOT NULL,
+            PRIMARY KEY (job_id, seq)
+        );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+
+    def connect(self) -> sqlite3.Connection:
+        # Connections are not shared across a fork, each worker process opens its own
+        if self.connection is None or self.connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+            self.connection, self.connection_pid = connection, os.getpid()
+        return self.connection
+
+    def transaction(self):
+        connection = self.connect()
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent workers wait on busy_timeout instead of deadlocking
+        connection.execute("BEGIN IMMEDIATE")
+        return connection
+
+    def insert(self, job: "BatchJob", owner: str, max_jobs: int):
+        "Adds a job, dropping the oldest finished ones to keep at most max_jobs, raises JobLimitError when none is finished"
+        with self.lock:
+            connection = self.transaction()
+            try:
+                count = connection.execute("SELECT COUNT(*) FROM batch_jobs").fetchone()[0]
+                if count >= max_jobs:
+                    oldest = [row[0] for row in connection.execute(
+                        "SELECT job_id FROM batch_jobs WHERE status IN (?, ?) ORDER BY created_at LIMIT ?",
+                        (*FINISHED_STATUSES, count - max_jobs + 1),
+                    )]
+                    if len(oldest) < count - max_jobs + 1:
+                        raise JobLimitError(f"{max_jobs} batch jobs are already running or queued, try again later.")
+                    for job_id in oldest:
+                        connection.execute("DELETE FROM batch_jobs WHERE job_id = ?", (job_id,))
+                        connection.execute("DELETE FROM batch_job_results WHERE job_id = ?", (job_id,))
+                connection.execute(
+                    "INSERT INTO batch_jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        job.id, job.execution, json.dumps(job.items, ensure_ascii=False), json.dumps(job.options),
+                        job.status, job.created_at, json.dumps(job.progress()), json.dumps(job.state()), owner, time.time(),
+                    ),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def save(self, job_id: str, owner: str, status: str, progress: str, state: str, results: List[Tuple[int, str]]):
+        "Adds new result lines and updates the job, unless it was cancelled or taken over by another worker meanwhile"
+        with self.lock:
+            connection = self.transaction()
+            try:
+                connection.executemany(
+                    "INSERT OR IGNORE INTO batch_job_results VALUES (?, ?, ?)", [(job_id, seq, result) for seq, result in results]
+                )
+                connection.execute(
+                    "UPDATE batch_jobs SET status = ?, progress = ?, state = ?, heartbeat_at = ? WHERE job_id = ? AND owner = ? AND status != 'cancelled'",
+                    (status, progress, state, time.time(), job_id, owner),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def progress(self, job_id: str) -> dict | None:
+        with self.lock:
+            row = self.connect().execute("SELECT progress FROM batch_jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def results(self, job_id: str, start: int) -> Tuple[str | None, List[str]]:
+        "The job's status and its result lines from the start-th on, None when the job is gone"
+        with self.lock:
+            connection = self.connect()
+            # Read first, a finished job has every result line in already
+            row = connection.execute("SELECT status FROM batch_jobs WHERE job_id = ?", (job_id,)).fetchone()
+            results = [result for (result,) in connection.execute(
+                "SELECT result FROM batch_job_results WHERE job_id = ? AND seq >= ? ORDER BY seq", (job_id, start)
+            )]
+        return (row[0] if row else None), results
+
+    def cancel(self, job_id: str) -> dict | None:
+        "Marks a job run by another worker cancelled, that worker stops it when it next checks in"
+        with self.lock:
+            connection = self.transaction()
+            try:
+                row = connection.execute("SELECT status, progress FROM batch_jobs WHERE job_id = ?", (job_id,)).fetchone()
+                progress = json.loads(row[1]) if row else None
+                if row and row[0] not in FINISHED_STATUSES:
+                    progress.update(status="cancelled", finished_at=time.time(), running=0, queued=0)
+                    connection.execute(
+                        "UPDATE batch_jobs SET status = 'cancelled', progress = ? WHERE job_id = ?", (json.dumps(progress), job_id)
+                    )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return progress
+
+    def check_in(self, owner: str, stale_seconds: float) -> Tuple[List[str], List[Tuple[tuple, List[str]]]]:
+        """
+        Heartbeat of the owner's unfinished jobs. Returns the owner's jobs cancelled by other workers,
+        and the unfinished jobs of workers that stopped checking in, now the owner's, with their result lines.
+        """
+        now = time.time()
+        with self.lock:
+            connection = self.transaction()
+            try:
+                connection.execute(
+                    "UPDATE batch_jobs SET heartbeat_at = ? WHERE owner = ? AND status NOT IN (?, ?)", (now, owner, *FINISHED_STATUSES)
+                )
+                cancelled = [row[0] for row in connection.execute(
+                    "SELECT job_id FROM batch_jobs WHERE owner = ? AND status = 'cancelled'", (owner,)
+                )]
+                orphans = connection.execute(
+                    "SELECT job_id, execution, items, options, progress, state FROM batch_jobs "
+                    "WHERE status NOT IN (?, ?) AND heartbeat_at < ? ORDER BY created_at",
+                    (*FINISHED_STATUSES, now - stale_seconds),
+                ).fetchall()
+                adopted = []
+                for row in orphans:
+                    connection.execute("UPDATE batch_jobs SET owner = ?, heartbeat_at = ? WHERE job_id = ?", (owner, now, row[0]))
+                    results = [result for (result,) in connection.execute(
+                        "SELECT result FROM batch_job_results WHERE job_id = ? ORDER BY seq", (row[0],)
+                    )]
+                    adopted.append((row, results))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        return cancelled, adopted
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.connect().execute("SELECT status, COUNT(*) FROM batch_jobs GROUP BY status").fetchall())
+
+
+class BatchJob():
+    """
+    One submitted list of analyses and their results, kept in the order they finish.
+    Identical items share one run, every copy still gets its own result line.
+    With a store, every change is written to it for the other workers.
+    """
+    def __init__(self, items: List[dict], options: dict, execution: str = "realtime", job_id: str | None = None):
+        self.id = job_id or str(uuid.uuid4())
+        self.items = items
+        self.options = options
+        self.execution = execution
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+
+        # Index of the first occurrence of each distinct item -> indexes of every occurrence
+        self.groups: Dict[int, List[int]] = {}
+        first_seen: Dict[Tuple[str, str, str], int] = {}
+        for index, item in enumerate(items):
+            first = first_seen.setdefault(item_key(item), index)
+            self.groups.setdefault(first, []).append(index)
+
+        self.pending = set(self.groups)
+        self.results: List[dict] = []
+        self.completed = 0
+        self.failed = 0
+        self.running: Dict[int, asyncio.Task] = {}
+        # Set for jobs run as a whole instead of item by item, with the step they are at
+        self.task: asyncio.Task | None = None
+        self.phase: str | None = None
+        # Session of each distinct item and OpenAI batch of each endpoint, for jobs run through the Batch API
+        self.threads: Dict[int, str] = {}
+        self.openai_batches: Dict[str, str] = {}
+        self.web_searches = 0
+        self.cost_usd = 0.0
+        self.changed = asyncio.Condition()
+
+        self.store: JobStore | None = None
+        self.owner: str | None = None
+        self.saved_results = 0
+        self.saving = asyncio.Lock()
+
+    @classmethod
+    def restore(cls, row: tuple, results: List[str]) -> "BatchJob":
+        "A job taken over from the store, with the results it had, its items without one are pending again"
+        job_id, execution, items, options, progress, state = row
+        progress, state = json.loads(progress), json.loads(state)
+        job = cls(json.loads(items), json.loads(options), execution, job_id)
+        job.status = progress["status"]
+        job.created_at = progress["created_at"]
+        job.started_at = progress["started_at"]
+        job.phase = progress["phase"]
+        job.completed = progress["completed"]
+        job.failed = progress["failed"]
+        job.web_searches = progress["web_searches"]
+        job.cost_usd = progress["cost_usd"]
+        job.threads = {int(index): thread_id for index, thread_id in state["threads"].items()}
+        job.openai_batches = state["openai_batches"]
+        job.results = [json.loads(result) for result in results]
+        job.saved_results = len(job.results)
+        done = {result["index"] for result in job.results}
+        job.pending = {index for index in job.groups if index not in done}
+        return job
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def progress(self) -> dict:
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.items),
+            "unique": len(self.groups),
+            "deduplicated": len(self.items) - len(self.groups),
+            "completed": self.completed,
+            "failed": self.failed,
+            "running": len(self.running),
+            "phase": self.phase,
+            "queued": 0 if self.finished else sum(len(self.groups[index]) for index in self.pending if index not in self.running),
+            "web_searches": self.web_searches,
+            "cost_usd": round(self.cost_usd, 6),
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "elapsed_seconds": round(end - (self.started_at or end), 3),
+        }
+
+    def state(self) -> dict:
+        return {"threads": self.threads, "openai_batches": self.openai_batches}
+
+    async def save(self):
+        if self.store is None:
+            return
+        async with self.saving:
+            results = [
+                (seq, json.dumps(result, ensure_ascii=False))
+                for seq, result in enumerate(self.results[self.saved_results:], start=self.saved_results)
+            ]
+            # The job carries on in memory, its next change may well get through
+            try:
+                await asyncio.to_thread(
+                    self.store.save, self.id, self.owner, self.status, json.dumps(self.progress()), json.dumps(self.state()), results
+                )
+            except sqlite3.Error as e:
+                print(f"Batch job {self.id} not saved: {e}")
+                return
+            self.saved_results += len(results)
+
+    async def start(self):
+        if self.started_at is None:
+            self.started_at = time.time()
+        self.status = "running"
+        await self.save()
+
+    async def set_phase(self, phase: str):
+        self.phase = phase
+        await self.save()
+
+    async def record_openai_batch(self, endpoint: str, batch_id: str):
+        self.openai_batches[endpoint] = batch_id
+        await self.save()
+
+    async def add_results(self, index: int, result: dict):
+        ok = result.get("status") == "ok"
+        usage = (result.get("usage") or {}).get("total", {})
+        self.web_searches += usage.get("web_searches", 0)
+        self.cost_usd += usage.get("cost_usd", 0.0)
+        self.pending.discard(index)
+        for copy in self.groups[index]:
+            self.results.append({"index": copy, **self.items[copy], **result})
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            BATCH_ITEMS.inc(status="ok" if ok else "failed")
+        await self.save()
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def finish(self, status: str):
+        if self.finished:
+            return
+        self.status = status
+        self.finished_at = time.time()
+        await self.save()
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def follow(self, wait: bool = True) -> AsyncIterator[dict]:
+        "Every result so far, then (with wait) the next ones as they come until the job is over"
+        sent = 0
+        while True:
+            while sent < len(self.results):
+                yield self.results[sent]
+                sent += 1
+            if self.finished or not wait:
+                return
+            async with self.changed:
+                await self.changed.wait_for(lambda: sent < len(self.results) or self.finished)
+
+
+class JobRunner():
+    """
+    Runs batch jobs in the background on a fixed pool of workers shared by every job, in submission order.
+    `run_item(item, options, job_id)` analyses one item and returns its result line, jobs with another execution
+    are run as a whole by `run_jobs[execution](job)`, which adds the result of every item itself.
+    With a store path, jobs run by other workers sharing it are reported on and cancelled through it,
+    and this worker takes over the ones whose worker went away.
+    """
+    def __init__(self, run_item: ItemRunner, run_jobs: Dict[str, JobRunFunction] | None = None, workers: int = DEFAULT_BATCH_WORKERS, max_items: int = MAX_JOB_ITEMS, max_jobs: int = MAX_JOBS, store_path: str = BATCH_JOBS_PATH):
+        self.run_item = run_item
+        self.run_jobs = run_jobs or {}
+        self.workers = workers
+        self.max_items = max_items
+        self.max_jobs = max_jobs
+        self.store = JobStore(store_path) if store_path else None
+        # Jobs this worker runs or ran
+        self.jobs: OrderedDict[str, BatchJob] = OrderedDict()
+        self.queue: asyncio.Queue[Tuple[BatchJob, int]] | None = None
+        self.worker_tasks: List[asyncio.Task] = []
+        self.watch_task: asyncio.Task | None = None
+        self.owner: str | None = None
+
+    async def submit(self, items: List[dict], options: dict, execution: str = "realtime") -> BatchJob:
+        "Queues every distinct item for the workers, or for executions other than realtime starts the job right away as a whole"
+        if not items:
+            raise ValueError("A batch job needs at least one item.")
+        if len(items) > self.max_items:
+            raise ValueError(f"A batch job can have up to {self.max_items} items, got {len(items)}.")
+        if execution != "realtime" and execution not in self.run_jobs:
+            raise ValueError(f"Unknown batch job execution {execution}.")
+        self.start_workers()
+        self.make_room()
+
+        job = BatchJob(items, options, execution)
+        if self.store is not None:
+            job.store, job.owner = self.store, self.owner
+            await asyncio.to_thread(self.store.insert, job, self.owner, self.max_jobs)
+        self.jobs[job.id] = job
+        await self.start(job)
+        return job
+
+    async def start(self, job: BatchJob):
+        if job.execution != "realtime":
+            job.task = asyncio.create_task(self.run_whole(job, self.run_jobs[job.execution]))
+            return
+        if not job.pending:
+            # Taken over after its last result came in
+            await job.finish("completed")
+        for index in sorted(job.pending):
+            self.queue.put_nowait((job, index))
+
+    def make_room(self):
+        while len(self.jobs) >= self.max_jobs:
+            oldest = next((job_id for job_id, job in self.jobs.items() if job.finished), None)
+            if oldest is None:
+                raise JobLimitError(f"{self.max_jobs} batch jobs are already running or queued, try again later.")
+            del self.jobs[oldest]
+
+    async def progress(self, job_id: str) -> dict:
+        if job_id in self.jobs:
+            return self.jobs[job_id].progress()
+        progress = await asyncio.to_thread(self.store.progress, job_id) if self.store is not None else None
+        if progress is None:
+            raise JobNotFoundError(job_id)
+        if progress["status"] not in FINISHED_STATUSES:
+            progress["elapsed_seconds"] = round(time.time() - (progress["started_at"] or time.time()), 3)
+        return progress
+
+    async def results(self, job_id: str, wait: bool = True) -> AsyncIterator[dict]:
+        "Raises JobNotFoundError right away, then gives what BatchJob.follow does wherever the job runs"
+        if job_id in self.jobs:
+            return self.jobs[job_id].follow(wait)
+        await self.progress(job_id)
+        return self.follow_stored(job_id, wait)
+
+    async def follow_stored(self, job_id: str, wait: bool) -> AsyncIterator[dict]:
+        sent = 0
+        while True:
+            status, results = await asyncio.to_thread(self.store.results, job_id, sent)
+            for result in results:
+                yield json.loads(result)
+            sent += len(results)
+            if status in FINISHED_STATUSES or status is None or not wait:
+                return
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+
+    async def cancel(self, job_id: str) -> dict:
+        job = self.jobs.get(job_id)
+        if job is None:
+            progress = await asyncio.to_thread(self.store.cancel, job_id) if self.store is not None else None
+            if progress is None:
+                raise JobNotFoundError(job_id)
+            return progress
+        await self.stop(job)
+        return job.progress()
+
+    async def stop(self, job: BatchJob):
+        await job.finish("cancelled")
+        # Queued items are skipped by the workers when they get to them
+        for task in list(job.running.values()):
+            task.cancel()
+        if job.task is not None:
+            job.task.cancel()
+
+    def start_workers(self):
+        # Started on the first job or with the server, the queue and tasks need the server's event loop
+        if self.queue is None:
+            self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self.queue = asyncio.Queue()
+            self.worker_tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+            if self.store is not None:
+                self.watch_task = asyncio.create_task(self.watch())
+
+    async def watch(self):
+        "Checks in with the store: stops the jobs cancelled by other workers, takes over the ones nobody runs anymore"
+        while True:
+            try:
+                cancelled, adopted = await asyncio.to_thread(self.store.check_in, self.owner, BATCH_STALE_SECONDS)
+            except sqlite3.Error as e:
+                print(f"Batch jobs not checked in: {e}")
+                cancelled, adopted = [], []
+            for job_id in cancelled:
+                if (job := self.jobs.get(job_id)) is not None and not job.finished:
+                    await self.stop(job)
+            for row, results in adopted:
+                job = BatchJob.restore(row, results)
+                job.store, job.owner = self.store, self.owner
+                self.jobs[job.id] = job
+                await self.start(job)
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+
+    async def work(self):
+        while True:
+            job, index = await self.queue.get()
+            try:
+                if not job.finished:
+                    await self.run(job, index)
+            finally:
+                self.queue.task_done()
+
+    async def run(self, job: BatchJob, index: int):
+        if job.status == "queued":
+            await job.start()
+
+        task = asyncio.create_task(self.run_item(job.items[index], job.options, job.id))
+        job.running[index] = task
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            # Cancelled with its job the worker carries on, cancelled itself (shutdown) it stops
+            if asyncio.current_task().cancelling() or not job.finished:
+                raise
+            return
+        except Exception as e:
+            result = {"status": "failed", "error": str(e)}
+        finally:
+            job.running.pop(index, None)
+
+        await job.add_results(index, result)
+        if not job.pending and not job.running:
+            await job.finish("completed")
+
+    async def run_whole(self, job: BatchJob, run_job: JobRunFunction):
+        await job.start()
+        try:
+            await run_job(job)
+        except asyncio.CancelledError:
+            # Cancelled with its job it's over, cancelled itself (shutdown) it stops
+            if not job.finished:
+                raise
+            return
+        except Exception as e:
+            for index in list(job.pending):
+                await job.add_results(index, {"status": "failed", "error": str(e)})
+        await job.finish("completed")
+
+    async def stats(self):
+        if self.store is not None:
+            jobs = await asyncio.to_thread(self.store.counts)
+        else:
+            jobs = {status: sum(1 for job in self.jobs.values() if job.status == status) for status in ("queued", "running", *FINISHED_STATUSES)}
+        return {
+            "workers": self.workers,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+            "jobs": {status: jobs.get(status, 0) for status in ("queued", "running", *FINISHED_STATUSES)},
+            "store": self.store.path if self.store is not None else None,
+        }
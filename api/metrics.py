@@ -0,0 +1,271 @@
+import time
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.tracers.context import register_configure_hook
+
+
+# Seconds, from a cached search to a slow multi-keyword analysis
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class Registry():
+    def __init__(self):
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric"):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        "Prometheus text exposition format (version 0.0.4)"
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric():
+    """
+    Base of the hand rolled Prometheus metrics, labels are given as keyword arguments on every update.
+    Every update takes a lock and touches one dict entry, cheap enough for the hot paths.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple[str, ...], object] = {}
+        # Unlabeled counters and gauges start at 0 instead of missing until their first update
+        if not self.label_names and self.type in ("counter", "gauge"):
+            self.values[()] = 0
+        registry.register(self)
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.label_names) or 'none'}, got {', '.join(labels) or 'none'}.")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}" for key, value in values]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function: Callable[[], float] | None = None
+
+    def set(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        "Reads the value when scraped instead of tracking it, for values something else already keeps"
+        self.function = function
+
+    def samples(self) -> List[str]:
+        if self.function is not None:
+            return [f"{self.name} {format_value(self.function())}"]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels, registry)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            # [count per bucket (the last one is +Inf), sum]
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = format_labels((*self.label_names, "le"), (*key, format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+NODE_DURATION = Histogram("geo_node_duration_seconds", "Wall time of each graph node run.", ("node",))
+LLM_CALL_DURATION = Histogram("geo_llm_call_duration_seconds", "Wall time of each LLM call, streamed calls until their last chunk.", ("tier", "model", "status"))
+LLM_TOKENS = Counter("geo_llm_tokens_total", "Tokens reported by the LLM provider.", ("tier", "model", "direction"))
+WEB_SEARCH_CALLS = Counter("geo_web_search_calls_total", "Web search tool calls made by the models.", ("tier", "model"))
+LLM_QUEUE_DEPTH = Gauge("geo_llm_queue_depth", "OpenAI requests waiting in the scheduler for rate limit capacity.", ("model", "priority"))
+LLM_QUEUE_WAIT = Histogram("geo_llm_queue_wait_seconds", "Time OpenAI requests spent waiting in the scheduler.", ("model", "priority"))
+LLM_RATE_LIMITED = Counter("geo_llm_rate_limited_total", "OpenAI responses with status 429.", ("model",))
+OPENAI_CONNECTIONS_OPENED = Counter("geo_openai_connections_opened_total", "TCP connections opened to OpenAI, a request that reuses a pooled connection opens none.", ("client",))
+OPENAI_HTTP_REQUESTS = Counter("geo_openai_http_requests_total", "HTTP requests sent to OpenAI, retries included.", ("client", "http_version"))
+OPENAI_POOL_CONNECTIONS = Gauge("geo_openai_pool_connections", "Connections held by the shared async OpenAI connection pool.")
+OPENAI_POOL_IDLE_CONNECTIONS = Gauge("geo_openai_pool_idle_connections", "Pooled OpenAI connections kept alive with no request on them.")
+LLM_CALL_TIMEOUTS = Counter("geo_llm_call_timeouts_total", "Web search calls given up on after their deadline.", ("call",))
+HEDGES_SENT = Counter("geo_llm_hedges_sent_total", "Duplicate web search calls sent because the first one was slow.", ("call",))
+HEDGES_WON = Counter("geo_llm_hedges_won_total", "Hedged web search calls where the duplicate answered first.", ("call",))
+KEYWORDS_TIMED_OUT = Counter("geo_keywords_timed_out_total", "Keywords left out of the rankings because their search missed a deadline.")
+SEARCHES_DROPPED = Counter("geo_searches_dropped_total", "Keyword searches dropped because the model answered without calling web search.")
+SEARCHES_OVER_BUDGET = Counter("geo_searches_over_budget_total", "Keyword searches skipped because the request's token or search budget would be exceeded.")
+BATCH_ITEMS = Counter("geo_batch_items_total", "Batch job items analysed, duplicates of an item included.", ("status",))
+OPENAI_BATCH_REQUESTS = Counter("geo_openai_batch_requests_total", "Requests sent through OpenAI Batch API files, by whether they were answered.", ("endpoint", "status"))
+ACTIVE_SESSIONS = Gauge("geo_active_sessions", "Analysis sessions held by the checkpointer.")
+REQUESTS_IN_FLIGHT = Gauge("geo_http_requests_in_flight", "HTTP requests being served, open streams included.")
+REQUEST_DURATION = Histogram("geo_http_request_duration_seconds", "Wall time of each HTTP request, streamed responses until their last event.", ("method", "route", "status"))
+ADMISSION_ACTIVE = Gauge("geo_admission_active", "Analysis requests holding an admission slot, open streams included.", ("endpoint",))
+ADMISSION_QUEUE_DEPTH = Gauge("geo_admission_queue_depth", "Analysis requests waiting for an admission slot.", ("endpoint",))
+ADMISSION_QUEUE_WAIT = Histogram("geo_admission_queue_wait_seconds", "Time admitted analysis requests waited for their slot.", ("endpoint",))
+ADMISSION_REJECTED = Counter("geo_admission_rejected_total", "Analysis requests turned away by admission control.", ("endpoint", "reason"))
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Times graph nodes and LLM calls from LangChain callbacks.
+    Runs inline on the event loop, so it only reads timestamps and updates counters.
+    """
+    run_inline = True
+
+    def __init__(self, tiers: Dict[str, str]):
+        self.tiers = tiers
+        self.nodes: Dict[object, Tuple[str, float]] = {}
+        self.llm_calls: Dict[object, Tuple[str, float]] = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # Only the node itself, not every runnable it calls
+        if node is not None and kwargs.get("name") == node:
+            self.nodes[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        if (started := self.nodes.pop(run_id, None)) is not None:
+            NODE_DURATION.observe(time.perf_counter() - started[1], node=started[0])
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.on_chain_end(None, run_id=run_id)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        model = (metadata or {}).get("ls_model_name") or kwargs.get("invocation_params", {}).get("model", "unknown")
+        self.llm_calls[run_id] = (model, time.perf_counter())
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        if (started := self.llm_calls.pop(run_id, None)) is None:
+            return
+        model, start = started
+        tier = self.tiers.get(model, "other")
+        LLM_CALL_DURATION.observe(time.perf_counter() - start, tier=tier, model=model, status="ok")
+
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if message is None:
+                    continue
+                if usage := getattr(message, "usage_metadata", None):
+                    LLM_TOKENS.inc(usage.get("input_tokens", 0), tier=tier, model=model, direction="input")
+                    LLM_TOKENS.inc(usage.get("output_tokens", 0), tier=tier, model=model, direction="output")
+                searches = sum(1 for output in message.additional_kwargs.get("tool_outputs", []) if output.get("type") == "web_search_call")
+                if searches:
+                    WEB_SEARCH_CALLS.inc(searches, tier=tier, model=model)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        if (started := self.llm_calls.pop(run_id, None)) is not None:
+            model, start = started
+            LLM_CALL_DURATION.observe(time.perf_counter() - start, tier=self.tiers.get(model, "other"), model=model, status="error")
+
+
+def register_metrics_handler(tiers: Dict[str, str]) -> MetricsCallbackHandler:
+    "Adds the handler to every LangChain run in the process, `tiers` maps model names to tier labels"
+    handler = MetricsCallbackHandler(tiers)
+    register_configure_hook(ContextVar("geo_metrics_handler", default=handler), inheritable=True)
+    return handler
+
+
+class MetricsMiddleware():
+    """
+    ASGI middleware counting in-flight requests and timing them until the response body is fully sent,
+    which for the SSE endpoints is the end of the stream.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status = 500
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # The matched route template, unmatched paths share one label so scanners can't blow up the series count
+            route = scope.get("route")
+            REQUEST_DURATION.observe(
+                time.perf_counter() - start,
+                method=scope["method"], route=route.path if route is not None else "unmatched", status=status,
+            )
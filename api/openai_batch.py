@@ -0,0 +1,259 @@
+import os
+import json
+import uuid
+import asyncio
+import functools
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Protocol, Type
+
+import httpx
+from pydantic import BaseModel
+from langchain_core.messages import AIMessage, BaseMessage, convert_to_openai_messages
+
+from metrics import OPENAI_BATCH_REQUESTS
+from openai_http import async_http_client
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from langchain_openai import ChatOpenAI
+
+
+# "openai" sends the files to the OpenAI Batch API, "local" runs them right away through the agent's own
+# HTTP client (cassette included) and keeps the files in GEO_OPENAI_BATCH_DIR, for development and tests
+BATCH_TRANSPORT = os.getenv("GEO_OPENAI_BATCH_TRANSPORT", "openai")
+BATCH_DIR = os.getenv("GEO_OPENAI_BATCH_DIR", ".openai_batches")
+# Seconds between two status checks of a submitted batch
+BATCH_POLL_SECONDS = float(os.getenv("GEO_OPENAI_BATCH_POLL_SECONDS", 60))
+BATCH_COMPLETION_WINDOW = "24h"
+
+BATCH_TRANSPORTS = ("openai", "local")
+FINISHED_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchTransport(Protocol):
+    "Where batch input files go and their output comes back from"
+    poll_seconds: float
+
+    async def submit(self, endpoint: str, content: bytes) -> str: ...
+
+    async def status(self, batch_id: str) -> str: ...
+
+    async def output(self, batch_id: str) -> bytes: ...
+
+    async def cancel(self, batch_id: str): ...
+
+
+class OpenAIBatchTransport():
+    "The OpenAI Batch API: half the token price, answered within the completion window, outside the realtime rate limits"
+    def __init__(self, api_key: str | None, transport: httpx.AsyncBaseTransport, poll_seconds: float = BATCH_POLL_SECONDS):
+        self.api_key = api_key
+        self.transport = transport
+        self.poll_seconds = poll_seconds
+
+    @functools.cached_property
+    def client(self) -> "AsyncOpenAI":
+        # Built by the first batch, most workers never send one
+        from openai import AsyncOpenAI
+        return AsyncOpenAI(api_key=self.api_key, http_client=async_http_client(self.transport))
+
+    async def submit(self, endpoint: str, content: bytes) -> str:
+        input_file = await self.client.files.create(file=("batch.jsonl", content), purpose="batch")
+        batch = await self.client.batches.create(input_file_id=input_file.id, endpoint=endpoint, completion_window=BATCH_COMPLETION_WINDOW)
+        return batch.id
+
+    async def status(self, batch_id: str) -> str:
+        return (await self.client.batches.retrieve(batch_id)).status
+
+    async def output(self, batch_id: str) -> bytes:
+        # Answered requests are in the output file, failed ones in the error file
+        batch = await self.client.batches.retrieve(batch_id)
+        content = b""
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content += (await self.client.files.content(file_id)).content
+        return content
+
+    async def cancel(self, batch_id: str):
+        await self.client.batches.cancel(batch_id)
+
+
+class LocalBatchTransport():
+    """
+    Stand-in for the Batch API: every request of a file is sent right away through `upstream` (an httpx transport),
+    the input and output files are written to `directory` with the names and line format OpenAI uses.
+    """
+    def __init__(self, directory: str, upstream: httpx.AsyncBaseTransport, concurrency: int = 8, poll_seconds: float = 0.05):
+        self.directory = directory
+        self.upstream = upstream
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.tasks: Dict[str, asyncio.Task] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, batch_id: str, kind: str) -> str:
+        return os.path.join(self.directory, f"{batch_id}.{kind}.jsonl")
+
+    async def submit(self, endpoint: str, content: bytes) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        with open(self.path(batch_id, "input"), "wb") as input_file:
+            input_file.write(content)
+        self.tasks[batch_id] = asyncio.create_task(self.process(batch_id, content))
+        return batch_id
+
+    async def process(self, batch_id: str, content: bytes):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(line: dict) -> dict:
+            request = httpx.Request(line["method"], f"https://api.openai.com{line['url']}", json=line["body"])
+            async with semaphore:
+                response = await self.upstream.handle_async_request(request)
+                await response.aread()
+            return {
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": line["custom_id"],
+                "response": {"status_code": response.status_code, "request_id": response.headers.get("x-request-id", ""), "body": json.loads(response.content)},
+                "error": None,
+            }
+
+        lines = [json.loads(line) for line in content.splitlines() if line.strip()]
+        outputs = await asyncio.gather(*[send(line) for line in lines])
+        with open(self.path(batch_id, "output"), "w", encoding="utf-8") as output_file:
+            output_file.writelines(json.dumps(output, ensure_ascii=False) + "\n" for output in outputs)
+
+    async def status(self, batch_id: str) -> str:
+        task = self.tasks.get(batch_id)
+        if task is None:
+            # Sent before a restart, it only got to finish if its output was written
+            return "completed" if os.path.exists(self.path(batch_id, "output")) else "expired"
+        if not task.done():
+            return "in_progress"
+        if task.cancelled():
+            return "cancelled"
+        return "failed" if task.exception() is not None else "completed"
+
+    async def output(self, batch_id: str) -> bytes:
+        path = self.path(batch_id, "output")
+        if not os.path.exists(path):
+            return b""
+        with open(path, "rb") as output_file:
+            return output_file.read()
+
+    async def cancel(self, batch_id: str):
+        if batch_id in self.tasks:
+            self.tasks[batch_id].cancel()
+
+
+def transport_from_env(api_key: str | None, transport: httpx.AsyncBaseTransport, upstream: httpx.AsyncBaseTransport) -> BatchTransport:
+    "`transport` carries the Batch API calls, `upstream` the requests of the local stand-in"
+    if BATCH_TRANSPORT not in BATCH_TRANSPORTS:
+        raise ValueError(f"GEO_OPENAI_BATCH_TRANSPORT must be one of {', '.join(BATCH_TRANSPORTS)}.")
+    if BATCH_TRANSPORT == "local":
+        return LocalBatchTransport(BATCH_DIR, upstream)
+    return OpenAIBatchTransport(api_key, transport)
+
+
+async def run_batch(transport: BatchTransport, endpoint: str, bodies: Dict[str, dict], batch_id: str | None = None, on_submit: Callable[[str], Awaitable[None]] | None = None) -> Dict[str, dict]:
+    """
+    Sends every {custom_id: request body} as one batch file and waits for it to finish, or with `batch_id` waits for
+    that batch sent before instead. Returns the response body of each request that was answered, failed and expired ones are left out.
+    `on_submit(batch_id)` is told about the batch once sent, to keep its id somewhere it can be waited for or cancelled
+    from: cancelled while waiting, the batch is then left alone, otherwise it is cancelled too.
+    """
+    if batch_id is None:
+        if not bodies:
+            return {}
+        content = "".join(
+            json.dumps({"custom_id": custom_id, "method": "POST", "url": endpoint, "body": body}, ensure_ascii=False) + "\n"
+            for custom_id, body in bodies.items()
+        ).encode("utf-8")
+        batch_id = await transport.submit(endpoint, content)
+        if on_submit is not None:
+            await on_submit(batch_id)
+    try:
+        while (status := await transport.status(batch_id)) not in FINISHED_STATUSES:
+            await asyncio.sleep(transport.poll_seconds)
+    except asyncio.CancelledError:
+        if on_submit is None:
+            await asyncio.shield(transport.cancel(batch_id))
+        raise
+
+    # An expired or cancelled batch still returns the requests it got to
+    answered = {}
+    for line in (await transport.output(batch_id)).splitlines():
+        output = json.loads(line)
+        response = output.get("response") or {}
+        if response.get("status_code") == 200:
+            answered[output["custom_id"]] = response["body"]
+    OPENAI_BATCH_REQUESTS.inc(len(answered), endpoint=endpoint, status="ok")
+    OPENAI_BATCH_REQUESTS.inc(len(bodies) - len(answered), endpoint=endpoint, status="failed")
+    if status != "completed":
+        print(f"OpenAI batch {batch_id} ended {status}, {len(answered)} of {len(bodies)} requests answered")
+    return answered
+
+
+# Request bodies are built from the public Responses and Chat Completions parameters with the model's own settings,
+# answers are read with the openai SDK's public response types into the AIMessage fields the realtime calls fill
+# (text content, web searches in tool_outputs, token usage). The openai types are imported by the first batch,
+# most workers never run one.
+
+def model_settings(model: "ChatOpenAI", max_tokens_name: str) -> dict:
+    settings = {"temperature": model.temperature, "top_p": model.top_p, max_tokens_name: model.max_tokens}
+    return {"model": model.model_name, **{name: value for name, value in settings.items() if value is not None}}
+
+
+def web_search_body(model: "ChatOpenAI", messages: List[BaseMessage], tools: List[dict]) -> dict:
+    return {**model_settings(model, "max_output_tokens"), "input": convert_to_openai_messages(messages), "tools": tools}
+
+
+def parse_web_search(body: dict) -> AIMessage:
+    from openai.types.responses import Response
+    response = Response.model_validate(body)
+    content, tool_outputs, message_id = [], [], None
+    for item in response.output:
+        if item.type != "message":
+            tool_outputs.append(item.model_dump(exclude_none=True))
+            continue
+        message_id = item.id
+        content.extend(
+            {"type": "text", "text": part.text, "annotations": [annotation.model_dump(exclude_none=True) for annotation in part.annotations]}
+            for part in item.content if part.type == "output_text"
+        )
+    usage = response.usage
+    return AIMessage(
+        content=content,
+        additional_kwargs={"tool_outputs": tool_outputs} if tool_outputs else {},
+        response_metadata={"id": response.id, "model_name": response.model, "status": response.status},
+        id=message_id,
+        usage_metadata=usage and {
+            "input_tokens": usage.input_tokens,
+            "output_tokens": usage.output_tokens,
+            "total_tokens": usage.total_tokens,
+            "input_token_details": {"cache_read": usage.input_tokens_details.cached_tokens},
+            "output_token_details": {"reasoning": usage.output_tokens_details.reasoning_tokens},
+        },
+    )
+
+
+def structured_output_body(model: "ChatOpenAI", messages: List[BaseMessage], schema: Type[BaseModel]) -> dict:
+    from openai import pydantic_function_tool
+    # The strict json schema the SDK sends for structured outputs, the way the realtime call asks for them
+    function = pydantic_function_tool(schema)["function"]
+    return {
+        **model_settings(model, "max_completion_tokens"),
+        "messages": convert_to_openai_messages(messages),
+        "response_format": {"type": "json_schema", "json_schema": {"name": function["name"], "schema": function["parameters"], "strict": True}},
+    }
+
+
+def parse_structured_output(body: dict, schema: Type[BaseModel]) -> tuple[AIMessage, BaseModel | None]:
+    from openai.types.chat import ChatCompletion
+    completion = ChatCompletion.model_validate(body)
+    usage = completion.usage
+    message = AIMessage(
+        content=completion.choices[0].message.content or "",
+        response_metadata={"id": completion.id, "model_name": completion.model, "finish_reason": completion.choices[0].finish_reason},
+        usage_metadata=usage and {"input_tokens": usage.prompt_tokens, "output_tokens": usage.completion_tokens, "total_tokens": usage.total_tokens},
+    )
+    try:
+        return message, schema.model_validate_json(message.text())
+    except ValueError:
+        return message, None
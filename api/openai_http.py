@@ -0,0 +1,108 @@
+import os
+import functools
+import importlib.util
+
+import httpx
+
+from metrics import OPENAI_CONNECTIONS_OPENED, OPENAI_HTTP_REQUESTS, OPENAI_POOL_CONNECTIONS, OPENAI_POOL_IDLE_CONNECTIONS
+
+
+# "auto" uses HTTP/2 when the h2 package is installed (pip install h2), many concurrent calls then share one connection
+HTTP2_SETTING = os.getenv("GEO_OPENAI_HTTP2", "auto")
+HTTP2 = importlib.util.find_spec("h2") is not None if HTTP2_SETTING == "auto" else HTTP2_SETTING == "on"
+
+# Enough for a few sessions fanning out all their keywords at once, kept alive between the steps of a session
+OPENAI_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("GEO_OPENAI_MAX_CONNECTIONS", 200)),
+    max_keepalive_connections=int(os.getenv("GEO_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 100)),
+    keepalive_expiry=float(os.getenv("GEO_OPENAI_KEEPALIVE_EXPIRY_SECONDS", 60)),
+)
+# Connecting should be quick, reading can't be: a web search answer regularly takes most of a minute
+OPENAI_TIMEOUT = httpx.Timeout(
+    float(os.getenv("GEO_OPENAI_READ_TIMEOUT_SECONDS", 120)),
+    connect=float(os.getenv("GEO_OPENAI_CONNECT_TIMEOUT_SECONDS", 5)),
+    write=float(os.getenv("GEO_OPENAI_WRITE_TIMEOUT_SECONDS", 30)),
+    pool=float(os.getenv("GEO_OPENAI_POOL_TIMEOUT_SECONDS", 30)),
+)
+
+
+@functools.cache
+def ssl_context():
+    # Loading the CA bundle takes tens of milliseconds, both pools trust the same one
+    return httpx.create_ssl_context()
+
+
+def count_request(client: str, response: httpx.Response):
+    OPENAI_HTTP_REQUESTS.inc(client=client, http_version=response.extensions.get("http_version", b"").decode() or "unknown")
+
+
+class PooledTransport(httpx.AsyncBaseTransport):
+    "The shared async connection pool, counting the connections it opens and the requests it sends"
+    def __init__(self):
+        self.transport = httpx.AsyncHTTPTransport(verify=ssl_context(), http2=HTTP2, limits=OPENAI_LIMITS)
+
+    async def trace(self, event: str, info: dict):
+        if event == "connection.connect_tcp.complete":
+            OPENAI_CONNECTIONS_OPENED.inc(client="async")
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions = {**request.extensions, "trace": self.trace}
+        response = await self.transport.handle_async_request(request)
+        count_request("async", response)
+        return response
+
+    def connections(self, idle: bool = False) -> int:
+        # httpx keeps its httpcore pool private, but the pool's connection list is public API of httpcore
+        connections = self.transport._pool.connections
+        return sum(1 for connection in connections if connection.is_idle()) if idle else len(connections)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class PooledSyncTransport(httpx.BaseTransport):
+    "Same pool settings for the sync paths (scripts and invoke calls), which can't go through the async scheduler"
+    def __init__(self):
+        self.transport = httpx.HTTPTransport(verify=ssl_context(), http2=HTTP2, limits=OPENAI_LIMITS)
+
+    def trace(self, event: str, info: dict):
+        if event == "connection.connect_tcp.complete":
+            OPENAI_CONNECTIONS_OPENED.inc(client="sync")
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.extensions = {**request.extensions, "trace": self.trace}
+        response = self.transport.handle_request(request)
+        count_request("sync", response)
+        return response
+
+    def close(self):
+        self.transport.close()
+
+
+pooled_transport: PooledTransport | None = None
+sync_http_client: httpx.Client | None = None
+
+
+def shared_pooled_transport() -> PooledTransport:
+    "The one async connection pool every OpenAI call of the process goes out on"
+    global pooled_transport
+    if pooled_transport is None:
+        pooled_transport = PooledTransport()
+        OPENAI_POOL_CONNECTIONS.set_function(pooled_transport.connections)
+        OPENAI_POOL_IDLE_CONNECTIONS.set_function(lambda: pooled_transport.connections(idle=True))
+    return pooled_transport
+
+
+# The openai SDK is imported by the first client built, not when the app starts
+
+def async_http_client(transport: httpx.AsyncBaseTransport) -> httpx.AsyncClient:
+    from openai import DefaultAsyncHttpxClient
+    return DefaultAsyncHttpxClient(transport=transport, timeout=OPENAI_TIMEOUT)
+
+
+def shared_sync_http_client() -> httpx.Client:
+    global sync_http_client
+    if sync_http_client is None:
+        from openai import DefaultHttpxClient
+        sync_http_client = DefaultHttpxClient(transport=PooledSyncTransport(), timeout=OPENAI_TIMEOUT)
+    return sync_http_client
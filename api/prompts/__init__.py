@@ -0,0 +1,25 @@
+from langchain_core.prompts import ChatPromptTemplate
+
+from prompts import en_US, pt_BR
+
+
+PROMPT_NAMES = (
+    "web_info_gathering_prompt",
+    "keywords_organization_prompt",
+    "refine_keywords_prompt",
+    "structure_brands_dominance_prompt",
+    "structure_batched_brands_dominance_prompt",
+    "resume_target_info_prompt",
+)
+# Languages without prompts of their own get these
+DEFAULT_LANGUAGE = "pt_BR"
+
+# {language: {prompt name: template}}, built once when the package is first imported
+PROMPTS: dict[str, dict[str, ChatPromptTemplate]] = {
+    language: {name: getattr(module, name) for name in PROMPT_NAMES}
+    for language, module in (("en_US", en_US), ("pt_BR", pt_BR))
+}
+
+
+def get_prompt(prompt: str, language: str) -> ChatPromptTemplate:
+    return PROMPTS.get(language, PROMPTS[DEFAULT_LANGUAGE])[prompt]
@@ -124,6 +124,15 @@ structure_brands_dominance_prompt = ChatPromptTemplate([
 MessagesPlaceholder("web_results")
 ])
 
+structure_batched_brands_dominance_prompt = ChatPromptTemplate([
+    ("system", """
+    Given a list of searches and results, structure how the brand scenario is organized for EACH search separately.
+    For every search, get the different brands, how many times they appear and the relevant URLs provided for each brand.
+    Return one item per search, using the search text exactly as given as the keyword.
+"""),
+MessagesPlaceholder("web_results")
+])
+
 resume_target_info_prompt = ChatPromptTemplate([
     ("system", """
         Given information about a brand / company, summarize it.
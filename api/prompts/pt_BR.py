@@ -129,6 +129,16 @@ structure_brands_dominance_prompt = ChatPromptTemplate([
 MessagesPlaceholder("web_results")
 ])
 
+structure_batched_brands_dominance_prompt = ChatPromptTemplate([
+    ("system", """
+    Dada uma lista de pesquisas e resultados, estruture o cenário de marcas de CADA pesquisa separadamente.
+    Para cada pesquisa, obtenha as diferentes marcas, quantas vezes aparecem e as URLs relevantes fornecidas para cada marca.
+    Retorne um item por pesquisa, usando como keyword o texto da pesquisa exatamente como foi dado.
+     NÃO INCLUA URLs do GOOGLE MAPS. APENAS URLS AUTORAIS DAS EMPRESAS
+"""),
+MessagesPlaceholder("web_results")
+])
+
 resume_target_info_prompt = ChatPromptTemplate([
     ("system", """
         Dada informacoes sobre uma marca / empresa, resuma-as.
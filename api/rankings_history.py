@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+from datetime import datetime, timezone
+from typing import List
+
+from aggregation import RankedCompany, normalize_name
+
+
+# Every finished gather_results is kept here, set to an empty string to keep no history
+HISTORY_PATH = os.getenv("GEO_HISTORY_PATH", "rankings_history.db")
+
+
+def normalize_key(text: str | None) -> str:
+    return " ".join(str(text or "").lower().split())
+
+
+class RankingsHistory():
+    """
+    Append-only history of the rankings of every finished analysis, in SQLite (WAL mode, shared between workers).
+    Each run keeps its companies with their URLs and their citations per keyword. Two rollups per day and company,
+    one over every brand of a city and one per brand, are clustered on (city, language[, brand], day):
+    a time range is one contiguous read of a few rows per day, whatever the number of runs behind them.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            recorded_at REAL NOT NULL,
+            day TEXT NOT NULL,
+            city TEXT NOT NULL,
+            language TEXT NOT NULL,
+            brand TEXT NOT NULL,
+            session_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS runs_partition ON runs (city, language, day);
+        CREATE TABLE IF NOT EXISTS run_companies (
+            run_id INTEGER NOT NULL,
+            company_key TEXT NOT NULL,
+            company TEXT NOT NULL,
+            times_cited INTEGER NOT NULL,
+            urls TEXT NOT NULL,
+            PRIMARY KEY (run_id, company_key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS citations (
+            run_id INTEGER NOT NULL,
+            company_key TEXT NOT NULL,
+            keyword TEXT NOT NULL,
+            times_cited INTEGER NOT NULL,
+            PRIMARY KEY (run_id, company_key, keyword)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS daily (
+            city TEXT NOT NULL,
+            language TEXT NOT NULL,
+            day TEXT NOT NULL,
+            company_key TEXT NOT NULL,
+            company TEXT NOT NULL,
+            citations INTEGER NOT NULL,
+            runs INTEGER NOT NULL,
+            PRIMARY KEY (city, language, day, company_key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS brand_daily (
+            city TEXT NOT NULL,
+            language TEXT NOT NULL,
+            brand TEXT NOT NULL,
+            day TEXT NOT NULL,
+            company_key TEXT NOT NULL,
+            company TEXT NOT NULL,
+            citations INTEGER NOT NULL,
+            runs INTEGER NOT NULL,
+            PRIMARY KEY (city, language, brand, day, company_key)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str | None = HISTORY_PATH):
+        self.path = path or None
+        self.lock = threading.RLock()
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def connect(self) -> sqlite3.Connection:
+        # Connections are not shared across a fork, each worker process opens its own
+        if self.connection is None or self.connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(self.SCHEMA)
+            self.connection, self.connection_pid = connection, os.getpid()
+        return self.connection
+
+    async def record(self, brand: str, city: str, language: str, rankings: List[RankedCompany], session_id: str | None = None, recorded_at: float | None = None):
+        if self.enabled and rankings:
+            await asyncio.to_thread(self._record, brand, city, language, rankings, session_id, recorded_at or time.time())
+
+    def _record(self, brand: str, city: str, language: str, rankings: List[RankedCompany], session_id: str | None, recorded_at: float):
+        day = datetime.fromtimestamp(recorded_at, timezone.utc).date().isoformat()
+        city, brand = normalize_key(city), normalize_key(brand)
+        # The spelling picked in one run can change in the next, the normalized name holds across runs
+        companies: dict[str, dict] = {}
+        for company in rankings:
+            merged = companies.setdefault(normalize_name(company.name), {"company": company.name, "times_cited": 0, "urls": [], "keywords": {}})
+            merged["times_cited"] += company.times_cited
+            merged["urls"] += company.relevantUrls
+            for keyword, times_cited in company.keywords.items():
+                merged["keywords"][keyword] = merged["keywords"].get(keyword, 0) + times_cited
+
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                run_id = connection.execute(
+                    "INSERT INTO runs (recorded_at, day, city, language, brand, session_id) VALUES (?, ?, ?, ?, ?, ?)",
+                    (recorded_at, day, city, language, brand, session_id),
+                ).lastrowid
+                connection.executemany("INSERT INTO run_companies VALUES (?, ?, ?, ?, ?)", [
+                    (run_id, company_key, company["company"], company["times_cited"], json.dumps(company["urls"], ensure_ascii=False))
+                    for company_key, company in companies.items()
+                ])
+                connection.executemany("INSERT INTO citations VALUES (?, ?, ?, ?)", [
+                    (run_id, company_key, keyword, times_cited)
+                    for company_key, company in companies.items() for keyword, times_cited in company["keywords"].items()
+                ])
+                for table, partition in (("daily", (city, language, day)), ("brand_daily", (city, language, brand, day))):
+                    connection.executemany(
+                        f"INSERT INTO {table} VALUES ({', '.join('?' * (len(partition) + 4))}) ON CONFLICT DO UPDATE SET "
+                        "company = excluded.company, citations = citations + excluded.citations, runs = runs + 1",
+                        [(*partition, company_key, company["company"], company["times_cited"], 1) for company_key, company in companies.items()],
+                    )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def query(self, sql: str, parameters: tuple) -> List[dict]:
+        if not self.enabled:
+            return []
+        with self.lock:
+            connection = self.connect()
+            cursor = connection.execute(sql, parameters)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def rollup(city: str, language: str, brand: str | None) -> tuple[str, str, tuple]:
+        "Rollup table to read and the filter of its partition"
+        if brand:
+            return "brand_daily", "city = ? AND language = ? AND brand = ?", (normalize_key(city), language, normalize_key(brand))
+        return "daily", "city = ? AND language = ?", (normalize_key(city), language)
+
+    async def share_of_voice(self, city: str, language: str, start: str, end: str, brand: str | None = None, top: int = 10) -> List[dict]:
+        """
+        Daily share of voice of the `top` most cited companies of the period, in the analyses of `brand` or of every brand.
+        A company's share of a day is its citations over all the citations of that day.
+        """
+        table, where, parameters = self.rollup(city, language, brand)
+        return await asyncio.to_thread(self.query, f"""
+            WITH days AS (
+                SELECT day, company_key, company, citations FROM {table} WHERE {where} AND day BETWEEN ? AND ?
+            ), shares AS (
+                -- Every company of the day counts in its total, not only the top ones
+                SELECT *, CAST(citations AS REAL) / SUM(citations) OVER (PARTITION BY day) AS share_of_voice FROM days
+            ), top AS (
+                SELECT company_key FROM days GROUP BY company_key ORDER BY SUM(citations) DESC, company_key LIMIT ?
+            )
+            SELECT day, company_key, company, citations, share_of_voice
+            FROM shares WHERE company_key IN top OR ? = 0
+            ORDER BY day, citations DESC
+        """, (*parameters, start, end, top, top))
+
+    async def rank_changes(self, city: str, language: str, start: str, end: str, brand: str | None = None) -> dict:
+        "Rank and share of voice of every company on the first and the last day with data in the period"
+        table, where, parameters = self.rollup(city, language, brand)
+        rows = await asyncio.to_thread(self.query, f"""
+            WITH bounds AS (
+                SELECT MIN(day) AS first, MAX(day) AS last FROM {table} WHERE {where} AND day BETWEEN ? AND ?
+            ), days AS (
+                SELECT day, company_key, company, citations
+                FROM {table} WHERE {where} AND day IN (SELECT first FROM bounds UNION SELECT last FROM bounds)
+            )
+            SELECT day, company_key, company, citations,
+                RANK() OVER (PARTITION BY day ORDER BY citations DESC) AS rank,
+                CAST(citations AS REAL) / SUM(citations) OVER (PARTITION BY day) AS share_of_voice
+            FROM days ORDER BY day, rank
+        """, (*parameters, start, end, *parameters))
+        if not rows:
+            return {"from_day": None, "to_day": None, "companies": []}
+
+        first, last = rows[0]["day"], rows[-1]["day"]
+        before = {row["company_key"]: row for row in rows if row["day"] == first}
+        after = {row["company_key"]: row for row in rows if row["day"] == last}
+        companies = []
+        for company_key in dict.fromkeys([*after, *before]):
+            old, new = before.get(company_key), after.get(company_key)
+            companies.append({
+                "company": (new or old)["company"],
+                "rank_before": old["rank"] if old else None,
+                "rank_after": new["rank"] if new else None,
+                # Positive is climbing, companies missing on one of the days have no change
+                "rank_change": old["rank"] - new["rank"] if old and new else None,
+                "share_of_voice_before": old["share_of_voice"] if old else 0.0,
+                "share_of_voice_after": new["share_of_voice"] if new else 0.0,
+            })
+        return {"from_day": first, "to_day": last, "companies": companies}
+
+    async def emerging(self, city: str, language: str, since: str, until: str, brand: str | None = None, min_citations: int = 1) -> List[dict]:
+        "Companies cited for the first time between `since` and `until`, with everything recorded before as their baseline"
+        table, where, parameters = self.rollup(city, language, brand)
+        return await asyncio.to_thread(self.query, f"""
+            SELECT company_key, MAX(company) AS company, MIN(day) AS first_seen, COUNT(*) AS days_seen,
+                SUM(citations) AS citations, SUM(runs) AS runs
+            FROM {table} WHERE {where} AND day <= ?
+            GROUP BY company_key
+            HAVING MIN(day) >= ? AND SUM(citations) >= ?
+            ORDER BY first_seen, citations DESC
+        """, (*parameters, until, since, min_citations))
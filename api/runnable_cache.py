@@ -0,0 +1,56 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from langchain_core.runnables import Runnable
+
+
+# Enough for every prompt, language and model tier plus the web search tool of a few hundred cities
+RUNNABLE_CACHE_MAX_ENTRIES = int(os.getenv("GEO_RUNNABLE_CACHE_MAX_ENTRIES", 512))
+
+
+class RunnableCache():
+    """
+    LRU of the chains the agent runs (prompt | client with its tools or structured output bound), so building them,
+    their JSON schemas and tool definitions happens once per key instead of on every call.
+    Each entry remembers the client it was built on: when a tier's client is replaced the entry is built again.
+    """
+    def __init__(self, max_entries: int = RUNNABLE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> (client, runnable), ordered from least to most recently used
+        self.entries: OrderedDict[Hashable, tuple[Any, Runnable]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, client: Any, build: Callable[[Any], Runnable]) -> Runnable:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is client:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        runnable = build(client)
+        with self.lock:
+            self.entries[key] = (client, runnable)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return runnable
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "evictions": self.evictions,
+            }
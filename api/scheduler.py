@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Deque, Dict, Iterator, Tuple
+
+import httpx
+
+from metrics import LLM_QUEUE_DEPTH, LLM_QUEUE_WAIT, LLM_RATE_LIMITED
+
+
+# Requests and tokens per minute of each model, OpenAI's tier 1 defaults.
+# The scheduler switches to the account's real limits as soon as OpenAI reports them in response headers.
+DEFAULT_RATE_LIMITS = {
+    "gpt-4.1": {"rpm": 500, "tpm": 30_000},
+    "gpt-4.1-mini": {"rpm": 500, "tpm": 200_000},
+    "gpt-4.1-nano": {"rpm": 500, "tpm": 200_000},
+}
+FALLBACK_RATE_LIMIT = {"rpm": 500, "tpm": 200_000}
+# JSON overrides, e.g. {"gpt-4.1": {"rpm": 5000, "tpm": 450000}}
+RATE_LIMITS = {**DEFAULT_RATE_LIMITS, **json.loads(os.getenv("GEO_OPENAI_RATE_LIMITS", "{}"))}
+# "off" sends requests straight through, the way the module-level clients did before
+SCHEDULER_ENABLED = os.getenv("GEO_LLM_SCHEDULER", "on") != "off"
+
+# Served in this order, interactive streams first and batch jobs only with what's left
+PRIORITIES = ("interactive", "standard", "batch")
+
+CHARS_PER_TOKEN = 4
+# Backoff after a 429 that didn't say how long to wait, doubled on every 429 in a row
+BASE_BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 30.0
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+
+
+llm_priority_var: ContextVar[Tuple[str, str | None]] = ContextVar("geo_llm_priority", default=("standard", None))
+
+
+@contextmanager
+def llm_priority(priority: str, session_id: str | None = None) -> Iterator[None]:
+    """
+    Every OpenAI call started inside the block (tasks spawned from it included) is queued
+    with this priority class, and shares its class's capacity fairly with other sessions.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Priority must be one of {', '.join(PRIORITIES)}.")
+    token = llm_priority_var.set((priority, session_id))
+    try:
+        yield
+    finally:
+        llm_priority_var.reset(token)
+
+
+def parse_duration(value: str | None) -> float | None:
+    "OpenAI's reset headers look like 1s, 6m0s, 20ms or 1h2m3.5s"
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(amount) * scale[unit] for amount, unit in parts)
+
+
+class TokenBucket():
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self.refill(now)
+        # Requests bigger than the whole bucket only wait for it to be full
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+    def resize(self, per_minute: float):
+        if per_minute > 0 and per_minute != self.capacity:
+            self.level = self.level * per_minute / self.capacity
+            self.capacity = per_minute
+
+
+class Waiter():
+    __slots__ = ("future", "tokens", "priority", "session", "enqueued_at")
+
+    def __init__(self, tokens: int, priority: str, session: str | None):
+        self.future = asyncio.get_running_loop().create_future()
+        self.tokens = tokens
+        self.priority = priority
+        self.session = session
+        self.enqueued_at = time.monotonic()
+
+
+class ModelLimiter():
+    """
+    Requests and tokens per minute buckets of one model, plus its wait queue.
+    The queue is one round robin of sessions per priority class, so a session sending twenty
+    searches at once doesn't hold back a session sending one.
+    """
+    def __init__(self, model: str, rpm: float, tpm: float):
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.consecutive_rate_limits = 0
+        self.queues: Dict[str, OrderedDict[str | None, Deque[Waiter]]] = {priority: OrderedDict() for priority in PRIORITIES}
+        self.timer: asyncio.TimerHandle | None = None
+
+    def enqueue(self, waiter: Waiter):
+        self.queues[waiter.priority].setdefault(waiter.session, deque()).append(waiter)
+        LLM_QUEUE_DEPTH.inc(model=self.model, priority=waiter.priority)
+
+    def remove(self, waiter: Waiter):
+        sessions = self.queues[waiter.priority]
+        waiters = sessions.get(waiter.session)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del sessions[waiter.session]
+            LLM_QUEUE_DEPTH.dec(model=self.model, priority=waiter.priority)
+
+    def head(self) -> Waiter | None:
+        for priority in PRIORITIES:
+            for waiters in self.queues[priority].values():
+                return waiters[0]
+        return None
+
+    def pop(self, waiter: Waiter):
+        sessions = self.queues[waiter.priority]
+        sessions[waiter.session].popleft()
+        # The session goes to the back of its class, the next session in line is served next
+        if sessions[waiter.session]:
+            sessions.move_to_end(waiter.session)
+        else:
+            del sessions[waiter.session]
+        LLM_QUEUE_DEPTH.dec(model=self.model, priority=waiter.priority)
+
+    def depth(self) -> Dict[str, int]:
+        return {priority: sum(len(waiters) for waiters in sessions.values()) for priority, sessions in self.queues.items()}
+
+
+class OpenAIScheduler():
+    """
+    Central queue for every outbound OpenAI request of the process.
+    Requests wait until their model's requests/min and tokens/min buckets allow them, highest priority class first.
+    Rate limit headers keep the buckets in line with what OpenAI actually sees, and a 429 pauses the model
+    until OpenAI says it's fine (or an exponential backoff) instead of letting every caller retry at once.
+    """
+    def __init__(self, rate_limits: Dict[str, dict] = RATE_LIMITS):
+        self.rate_limits = rate_limits
+        self.limiters: Dict[str, ModelLimiter] = {}
+
+    def limiter(self, model: str) -> ModelLimiter:
+        if model not in self.limiters:
+            limits = self.rate_limits.get(model, FALLBACK_RATE_LIMIT)
+            self.limiters[model] = ModelLimiter(model, limits["rpm"], limits["tpm"])
+        return self.limiters[model]
+
+    async def acquire(self, model: str, tokens: int):
+        priority, session = llm_priority_var.get()
+        limiter = self.limiter(model)
+        waiter = Waiter(tokens, priority, session)
+        limiter.enqueue(waiter)
+        self.dispatch(limiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            limiter.remove(waiter)
+            # Whoever was behind may be able to go now
+            self.dispatch(limiter)
+            raise
+        LLM_QUEUE_WAIT.observe(time.monotonic() - waiter.enqueued_at, model=model, priority=priority)
+
+    def dispatch(self, limiter: ModelLimiter):
+        if limiter.timer is not None:
+            limiter.timer.cancel()
+            limiter.timer = None
+
+        while (waiter := limiter.head()) is not None:
+            now = time.monotonic()
+            wait = max(
+                limiter.paused_until - now,
+                limiter.requests.wait_time(1, now),
+                limiter.tokens.wait_time(waiter.tokens, now),
+            )
+            if wait > 0:
+                limiter.timer = asyncio.get_running_loop().call_later(wait, self.dispatch, limiter)
+                return
+            limiter.pop(waiter)
+            limiter.requests.take(1)
+            limiter.tokens.take(waiter.tokens)
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+
+    def observe(self, model: str, status_code: int, headers: httpx.Headers):
+        "Feeds a response's rate limit headers back into the model's buckets"
+        limiter = self.limiter(model)
+        now = time.monotonic()
+
+        if limit := headers.get("x-ratelimit-limit-requests"):
+            limiter.requests.resize(float(limit))
+        if limit := headers.get("x-ratelimit-limit-tokens"):
+            limiter.tokens.resize(float(limit))
+        # OpenAI's own count wins when it has less left than we think
+        for bucket, header in ((limiter.requests, "x-ratelimit-remaining-requests"), (limiter.tokens, "x-ratelimit-remaining-tokens")):
+            if (remaining := headers.get(header)) is not None:
+                bucket.refill(now)
+                bucket.level = min(bucket.level, float(remaining))
+
+        if status_code != 429:
+            limiter.consecutive_rate_limits = 0
+            return
+
+        LLM_RATE_LIMITED.inc(model=model)
+        limiter.consecutive_rate_limits += 1
+        retry_after = (
+            (float(headers["retry-after-ms"]) / 1000 if headers.get("retry-after-ms") else None)
+            or parse_duration(headers.get("retry-after"))
+            or max(parse_duration(headers.get("x-ratelimit-reset-requests")) or 0, parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0)
+            or min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** (limiter.consecutive_rate_limits - 1))
+        )
+        # A little jitter so paused callers don't all come back on the same tick
+        limiter.paused_until = max(limiter.paused_until, now + retry_after * random.uniform(1.0, 1.1))
+
+    @staticmethod
+    def estimate_tokens(body: dict, raw_size: int) -> int:
+        "What OpenAI's limiter counts: the prompt plus the output cap when there is one"
+        output_cap = body.get("max_completion_tokens") or body.get("max_tokens") or body.get("max_output_tokens") or 0
+        return raw_size // CHARS_PER_TOKEN + output_cap
+
+    def stats(self):
+        return {
+            model: {
+                "queued": limiter.depth(),
+                "requests_available": round(limiter.requests.level, 1),
+                "tokens_available": round(limiter.tokens.level),
+                "rpm": limiter.requests.capacity,
+                "tpm": limiter.tokens.capacity,
+                "paused_for": round(max(0.0, limiter.paused_until - time.monotonic()), 3),
+            }
+            for model, limiter in self.limiters.items()
+        }
+
+
+class ScheduledTransport(httpx.AsyncBaseTransport):
+    "Sends every request through the scheduler before handing it to the wrapped transport"
+    def __init__(self, scheduler: OpenAIScheduler, transport: httpx.AsyncBaseTransport):
+        self.scheduler = scheduler
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        try:
+            body = json.loads(request.content)
+        except ValueError:
+            body = {}
+        model = body.get("model") if isinstance(body, dict) else None
+        if model is None:
+            return await self.transport.handle_async_request(request)
+
+        await self.scheduler.acquire(model, self.scheduler.estimate_tokens(body, len(request.content)))
+        response = await self.transport.handle_async_request(request)
+        self.scheduler.observe(model, response.status_code, response.headers)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any
+
+
+SEARCH_CACHE_TTL = float(os.getenv("GEO_SEARCH_CACHE_TTL_SECONDS", 6 * 60 * 60))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("GEO_SEARCH_CACHE_MAX_ENTRIES", 5000))
+# Optional on-disk tier, shared between workers the same way the sqlite session backend is
+SEARCH_CACHE_PATH = os.getenv("GEO_SEARCH_CACHE_PATH")
+SEARCH_CACHE_MAX_DISK_ENTRIES = int(os.getenv("GEO_SEARCH_CACHE_MAX_DISK_ENTRIES", 100_000))
+
+# Brand research and keywords, reused by the next analysis of the same brand, city and language
+BRAND_PROFILE_TTL = float(os.getenv("GEO_BRAND_PROFILE_TTL_SECONDS", 24 * 60 * 60))
+BRAND_PROFILE_MAX_ENTRIES = int(os.getenv("GEO_BRAND_PROFILE_MAX_ENTRIES", 1000))
+BRAND_PROFILE_CACHE_PATH = os.getenv("GEO_BRAND_PROFILE_CACHE_PATH")
+
+
+class SearchCache():
+    """
+    Content-addressed cache for the per-keyword search + structuring step, and for brand profiles (research and keywords).
+    An in-memory LRU tier sits in front of an optional SQLite tier, entries expire after ttl_seconds.
+    Values must be JSON serializable.
+    The memory tier is only touched from the event loop and takes no lock, so a hit never waits on the disk tier,
+    whose connection is used from worker threads under a lock of its own.
+    """
+    def __init__(self, ttl_seconds: float = SEARCH_CACHE_TTL, max_entries: int = SEARCH_CACHE_MAX_ENTRIES, path: str | None = SEARCH_CACHE_PATH, max_disk_entries: int = SEARCH_CACHE_MAX_DISK_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+
+        self.disk_lock = threading.Lock()
+        # key -> (expires_at, serialized value), ordered from least to most recently used
+        self.memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    @staticmethod
+    def key(keyword: str, city: str | None, language: str | None, model: str) -> str:
+        normalized = [" ".join(str(part or "").lower().split()) for part in (keyword, city, language, model)]
+        return hashlib.sha256("\x1f".join(normalized).encode()).hexdigest()
+
+    async def get(self, key: str) -> Any | None:
+        now = time.time()
+        entry = self.memory.get(key)
+        if entry and entry[0] > now:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return json.loads(entry[1])
+        elif entry:
+            del self.memory[key]
+
+        if self.path:
+            entry = await asyncio.to_thread(self._disk_get, key, now)
+            if entry:
+                self._memory_set(key, *entry)
+                self.hits += 1
+                self.disk_hits += 1
+                return json.loads(entry[1])
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: Any):
+        entry = (time.time() + self.ttl_seconds, json.dumps(value))
+        self._memory_set(key, *entry)
+        if self.path:
+            await asyncio.to_thread(self._disk_set, key, *entry)
+
+    def record_bypass(self):
+        self.bypasses += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypasses": self.bypasses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory),
+            "max_entries": self.max_entries,
+            "disk": self.path,
+        }
+
+    def _memory_set(self, key: str, expires_at: float, value: str):
+        self.memory[key] = (expires_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None or self.connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS search_cache (key TEXT PRIMARY KEY, expires_at REAL NOT NULL, value TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS search_cache_expires_at ON search_cache (expires_at)")
+            self.connection, self.connection_pid = connection, os.getpid()
+        return self.connection
+
+    def _disk_get(self, key: str, now: float) -> tuple[float, str] | None:
+        with self.disk_lock:
+            return self._connect().execute(
+                "SELECT expires_at, value FROM search_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+
+    def _disk_set(self, key: str, expires_at: float, value: str):
+        with self.disk_lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("INSERT OR REPLACE INTO search_cache VALUES (?, ?, ?)", (key, expires_at, value))
+                # Both are index range scans, nothing counts the whole table
+                connection.execute("DELETE FROM search_cache WHERE expires_at <= ?", (time.time(),))
+                # Rowids grow with every write and every entry has the same ttl, so the oldest rowids expire first.
+                # Deleted rows leave gaps, the tier holds at most max_disk_entries
+                connection.execute(
+                    "DELETE FROM search_cache WHERE rowid <= (SELECT MAX(rowid) FROM search_cache) - ?",
+                    (self.max_disk_entries,),
+                )
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
@@ -0,0 +1,580 @@
+import os
+import time
+import zlib
+import sqlite3
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Iterator, List, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    ChannelVersions,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.serde.base import SerializerProtocol
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+
+DEFAULT_MAX_SESSIONS = int(os.getenv("GEO_MAX_SESSIONS", 1000))
+DEFAULT_SESSION_TTL = float(os.getenv("GEO_SESSION_TTL_SECONDS", 60 * 60))
+
+# "memory" keeps sessions in the worker process, "sqlite" shares them between workers through a WAL database file
+CHECKPOINT_BACKEND = os.getenv("GEO_CHECKPOINT_BACKEND", "memory")
+CHECKPOINT_PATH = os.getenv("GEO_CHECKPOINT_PATH", "sessions.db")
+
+# Serialized values bigger than this are zlib compressed (the research AIMessage is the usual one)
+COMPRESSION_MIN_BYTES = 1024
+
+# How many evicted session ids are remembered to tell "evicted" apart from "never existed"
+EVICTED_MEMORY_FACTOR = 10
+
+
+class SessionNotFoundError(Exception):
+    def __init__(self, session_id: str, message: str | None = None):
+        self.session_id = session_id
+        super().__init__(message or f"Session {session_id} does not exist.")
+
+
+class SessionEvictedError(SessionNotFoundError):
+    def __init__(self, session_id: str, reason: str):
+        self.reason = reason
+        super().__init__(session_id, f"Session {session_id} is no longer available ({reason}), start a new analysis.")
+
+
+class BoundedInMemorySaver(InMemorySaver):
+    """
+    InMemorySaver with a max session count, TTL expiry and LRU eviction.
+    Only the latest checkpoint of each session is kept (unless keep_history is set),
+    which is all the graph needs to resume after the get_keywords interrupt.
+    """
+    def __init__(self, max_sessions: int = DEFAULT_MAX_SESSIONS, ttl_seconds: float = DEFAULT_SESSION_TTL, keep_history: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1.")
+
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.keep_history = keep_history
+
+        self.lock = threading.RLock()
+        # thread_id -> last access (monotonic), ordered from least to most recently used
+        self.last_used: OrderedDict[str, float] = OrderedDict()
+        # thread_id -> eviction reason
+        self.evicted: OrderedDict[str, str] = OrderedDict()
+        # thread_id -> keys of its blobs / writes, so a session is dropped without scanning every other one
+        self.blob_keys: dict[str, set] = {}
+        self.write_keys: dict[str, set] = {}
+
+        self.evictions = 0
+        self.expirations = 0
+
+    def ensure_session(self, thread_id: str):
+        """
+        Raises SessionEvictedError / SessionNotFoundError when the session can't be resumed.
+        """
+        with self.lock:
+            self._expire()
+            if thread_id in self.evicted:
+                raise SessionEvictedError(thread_id, self.evicted[thread_id])
+            if thread_id not in self.last_used:
+                raise SessionNotFoundError(thread_id)
+
+    async def aensure_session(self, thread_id: str):
+        # Dict lookups under a lock only held for dict operations, fine on the event loop
+        self.ensure_session(thread_id)
+
+    def session_count(self) -> int:
+        with self.lock:
+            self._expire()
+            return len(self.last_used)
+
+    def stats(self):
+        with self.lock:
+            self._expire()
+            return {
+                "sessions": len(self.last_used),
+                "max_sessions": self.max_sessions,
+                "bytes": sum(self._session_bytes(thread_id) for thread_id in self.last_used),
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config["configurable"]["thread_id"]
+        with self.lock:
+            self._expire()
+            if thread_id in self.evicted:
+                raise SessionEvictedError(thread_id, self.evicted[thread_id])
+
+            checkpoint_tuple = super().get_tuple(config)
+            if checkpoint_tuple:
+                # The lookup also creates an empty writes entry for the checkpoint
+                configurable = checkpoint_tuple.config["configurable"]
+                self.write_keys.setdefault(thread_id, set()).add((thread_id, configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"]))
+            if thread_id in self.last_used:
+                self.last_used.move_to_end(thread_id)
+                self.last_used[thread_id] = time.monotonic()
+            else:
+                # InMemorySaver's defaultdict creates an empty entry on lookup
+                self.storage.pop(thread_id, None)
+            return checkpoint_tuple
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        with self.lock:
+            self._expire()
+            next_config = super().put(config, checkpoint, metadata, new_versions)
+
+            self.blob_keys.setdefault(thread_id, set()).update(
+                (thread_id, checkpoint_ns, channel, version) for channel, version in new_versions.items()
+            )
+            if not self.keep_history:
+                self._prune_history(thread_id, checkpoint_ns, checkpoint)
+
+            self.last_used[thread_id] = time.monotonic()
+            self.last_used.move_to_end(thread_id)
+            self.evicted.pop(thread_id, None)
+            while len(self.last_used) > self.max_sessions:
+                self._evict(next(iter(self.last_used)), "evicted to make room for newer sessions")
+                self.evictions += 1
+
+            return next_config
+
+    def put_writes(self, config: RunnableConfig, writes, task_id: str, task_path: str = "") -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        with self.lock:
+            super().put_writes(config, writes, task_id, task_path)
+            self.write_keys.setdefault(thread_id, set()).add((thread_id, checkpoint_ns, checkpoint_id))
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.lock:
+            self.storage.pop(thread_id, None)
+            for key in self.write_keys.pop(thread_id, ()):
+                self.writes.pop(key, None)
+            for key in self.blob_keys.pop(thread_id, ()):
+                self.blobs.pop(key, None)
+            self.last_used.pop(thread_id, None)
+
+    def _prune_history(self, thread_id: str, checkpoint_ns: str, checkpoint: Checkpoint):
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        for checkpoint_id in [id for id in checkpoints if id != checkpoint["id"]]:
+            del checkpoints[checkpoint_id]
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+            self.write_keys.get(thread_id, set()).discard((thread_id, checkpoint_ns, checkpoint_id))
+
+        live_blobs = {(thread_id, checkpoint_ns, channel, version) for channel, version in checkpoint["channel_versions"].items()}
+        thread_blobs = self.blob_keys.get(thread_id, set())
+        for key in [key for key in thread_blobs if key[1] == checkpoint_ns and key not in live_blobs]:
+            self.blobs.pop(key, None)
+            thread_blobs.discard(key)
+
+    def _expire(self):
+        if not self.ttl_seconds:
+            return
+        deadline = time.monotonic() - self.ttl_seconds
+        while self.last_used:
+            thread_id, last_used = next(iter(self.last_used.items()))
+            if last_used > deadline:
+                break
+            self._evict(thread_id, f"expired after {self.ttl_seconds:g}s without activity")
+            self.expirations += 1
+
+    def _evict(self, thread_id: str, reason: str):
+        self.delete_thread(thread_id)
+        self.evicted[thread_id] = reason
+        while len(self.evicted) > self.max_sessions * EVICTED_MEMORY_FACTOR:
+            self.evicted.popitem(last=False)
+
+    def _session_bytes(self, thread_id: str) -> int:
+        size = 0
+        for checkpoints in self.storage.get(thread_id, {}).values():
+            for checkpoint, metadata, _ in checkpoints.values():
+                size += len(checkpoint[1]) + len(metadata[1])
+        for key in self.blob_keys.get(thread_id, ()):
+            if key in self.blobs:
+                size += len(self.blobs[key][1])
+        for key in self.write_keys.get(thread_id, ()):
+            for _, _, value, _ in self.writes.get(key, {}).values():
+                size += len(value[1])
+        return size
+
+
+class CompressedSerializer(SerializerProtocol):
+    """
+    msgpack serialization (JsonPlusSerializer) with zlib compression of large payloads.
+    """
+    def __init__(self, serde: SerializerProtocol | None = None, min_bytes: int = COMPRESSION_MIN_BYTES):
+        self.serde = serde or JsonPlusSerializer()
+        self.min_bytes = min_bytes
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.serde.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return self.serde.loads(data)
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        if len(data) >= self.min_bytes:
+            return f"{type_}+zlib", zlib.compress(data)
+        return type_, data
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_.endswith("+zlib"):
+            return self.serde.loads_typed((type_.removesuffix("+zlib"), zlib.decompress(payload)))
+        return self.serde.loads_typed(data)
+
+
+class SqliteSessionSaver(BaseCheckpointSaver[int]):
+    """
+    Checkpointer backed by a SQLite database in WAL mode, so every uvicorn worker (or container
+    sharing the same volume) can resume any session. Same session semantics as BoundedInMemorySaver:
+    max session count, TTL expiry, LRU eviction and only the latest checkpoint kept per session.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            thread_id TEXT PRIMARY KEY,
+            last_used REAL NOT NULL,
+            evicted TEXT
+        );
+        CREATE INDEX IF NOT EXISTS sessions_last_used ON sessions (evicted, last_used);
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            thread_id TEXT NOT NULL,
+            checkpoint_ns TEXT NOT NULL,
+            checkpoint_id TEXT NOT NULL,
+            parent_checkpoint_id TEXT,
+            type TEXT NOT NULL,
+            checkpoint BLOB NOT NULL,
+            metadata_type TEXT NOT NULL,
+            metadata BLOB NOT NULL,
+            PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+        );
+        CREATE TABLE IF NOT EXISTS writes (
+            thread_id TEXT NOT NULL,
+            checkpoint_ns TEXT NOT NULL,
+            checkpoint_id TEXT NOT NULL,
+            task_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            channel TEXT NOT NULL,
+            type TEXT NOT NULL,
+            value BLOB NOT NULL,
+            task_path TEXT NOT NULL,
+            PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+        );
+    """
+
+    def __init__(self, path: str = CHECKPOINT_PATH, max_sessions: int = DEFAULT_MAX_SESSIONS, ttl_seconds: float = DEFAULT_SESSION_TTL, keep_history: bool = False, serde: SerializerProtocol | None = None):
+        super().__init__(serde=serde or CompressedSerializer())
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1.")
+
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.keep_history = keep_history
+
+        self.lock = threading.RLock()
+        self.connection: sqlite3.Connection | None = None
+        self.connection_pid: int | None = None
+
+    def connect(self) -> sqlite3.Connection:
+        # Connections are not shared across a fork, each worker process opens its own
+        if self.connection is None or self.connection_pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(self.SCHEMA)
+            self.connection, self.connection_pid = connection, os.getpid()
+        return self.connection
+
+    def transaction(self):
+        connection = self.connect()
+        # BEGIN IMMEDIATE takes the write lock up front so concurrent workers wait on busy_timeout instead of deadlocking
+        connection.execute("BEGIN IMMEDIATE")
+        return connection
+
+    def ensure_session(self, thread_id: str):
+        """
+        Raises SessionEvictedError / SessionNotFoundError when the session can't be resumed.
+        """
+        with self.lock:
+            connection = self.transaction()
+            try:
+                self._expire(connection)
+                row = connection.execute("SELECT evicted FROM sessions WHERE thread_id = ?", (thread_id,)).fetchone()
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            raise SessionNotFoundError(thread_id)
+        if row[0] is not None:
+            raise SessionEvictedError(thread_id, row[0])
+
+    def session_count(self) -> int:
+        # Read only, sessions past their TTL are left for the next write to evict
+        deadline = time.time() - self.ttl_seconds if self.ttl_seconds else float("-inf")
+        with self.lock:
+            return self.connect().execute(
+                "SELECT COUNT(*) FROM sessions WHERE evicted IS NULL AND last_used > ?", (deadline,)
+            ).fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            connection = self.connect()
+            sessions, evicted = connection.execute(
+                "SELECT COUNT(*) FILTER (WHERE evicted IS NULL), COUNT(*) FILTER (WHERE evicted IS NOT NULL) FROM sessions"
+            ).fetchone()
+            checkpoint_bytes = connection.execute("SELECT COALESCE(SUM(LENGTH(checkpoint) + LENGTH(metadata)), 0) FROM checkpoints").fetchone()[0]
+            write_bytes = connection.execute("SELECT COALESCE(SUM(LENGTH(value)), 0) FROM writes").fetchone()[0]
+        return {
+            "sessions": sessions,
+            "max_sessions": self.max_sessions,
+            "bytes": checkpoint_bytes + write_bytes,
+            "evicted": evicted,
+        }
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = get_checkpoint_id(config)
+
+        with self.lock:
+            connection = self.transaction()
+            try:
+                self._expire(connection)
+                session = connection.execute("SELECT evicted FROM sessions WHERE thread_id = ?", (thread_id,)).fetchone()
+                if session is not None and session[0] is not None:
+                    raise SessionEvictedError(thread_id, session[0])
+
+                if checkpoint_id:
+                    row = connection.execute(
+                        "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                        "WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                        (thread_id, checkpoint_ns, checkpoint_id),
+                    ).fetchone()
+                else:
+                    row = connection.execute(
+                        "SELECT checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints "
+                        "WHERE thread_id = ? AND checkpoint_ns = ? ORDER BY checkpoint_id DESC LIMIT 1",
+                        (thread_id, checkpoint_ns),
+                    ).fetchone()
+
+                if row is None:
+                    connection.execute("COMMIT")
+                    return None
+
+                writes = self._load_writes(connection, thread_id, checkpoint_ns, row[0])
+                connection.execute("UPDATE sessions SET last_used = ? WHERE thread_id = ?", (time.time(), thread_id))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        return self._to_tuple(thread_id, checkpoint_ns, row, writes)
+
+    def list(self, config: RunnableConfig | None, *, filter: dict[str, Any] | None = None, before: RunnableConfig | None = None, limit: int | None = None) -> Iterator[CheckpointTuple]:
+        query = "SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata FROM checkpoints"
+        conditions, params = [], []
+        if config:
+            conditions.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                conditions.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_checkpoint_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < ?")
+            params.append(before_checkpoint_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY checkpoint_id DESC"
+
+        with self.lock:
+            connection = self.connect()
+            rows = connection.execute(query, params).fetchall()
+
+        for thread_id, checkpoint_ns, *row in rows:
+            if filter:
+                metadata = self.serde.loads_typed((row[4], row[5]))
+                if not all(value == metadata.get(key) for key, value in filter.items()):
+                    continue
+            if limit is not None:
+                if limit <= 0:
+                    break
+                limit -= 1
+            with self.lock:
+                writes = self._load_writes(self.connect(), thread_id, checkpoint_ns, row[0])
+            yield self._to_tuple(thread_id, checkpoint_ns, row, writes)
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"]["checkpoint_ns"]
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+
+        with self.lock:
+            connection = self.transaction()
+            try:
+                connection.execute(
+                    "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint["id"], config["configurable"].get("checkpoint_id"), type_, serialized_checkpoint, metadata_type, serialized_metadata),
+                )
+                if not self.keep_history:
+                    connection.execute(
+                        "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                        (thread_id, checkpoint_ns, checkpoint["id"]),
+                    )
+                    connection.execute(
+                        "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id != ?",
+                        (thread_id, checkpoint_ns, checkpoint["id"]),
+                    )
+                connection.execute(
+                    "INSERT INTO sessions (thread_id, last_used) VALUES (?, ?) "
+                    "ON CONFLICT (thread_id) DO UPDATE SET last_used = excluded.last_used, evicted = NULL",
+                    (thread_id, time.time()),
+                )
+                self._expire(connection)
+                self._evict_overflow(connection)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        # Special channels (errors, interrupts...) overwrite, regular writes are only stored once
+        replace, ignore = [], []
+        for idx, (channel, value) in enumerate(writes):
+            type_, serialized = self.serde.dumps_typed(value)
+            row = (thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx), channel, type_, serialized, task_path)
+            (replace if channel in WRITES_IDX_MAP else ignore).append(row)
+
+        with self.lock:
+            connection = self.transaction()
+            try:
+                connection.executemany("INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", replace)
+                connection.executemany("INSERT OR IGNORE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", ignore)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.lock:
+            connection = self.transaction()
+            try:
+                self._delete_session_data(connection, thread_id)
+                connection.execute("DELETE FROM sessions WHERE thread_id = ?", (thread_id,))
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    # SQLite calls are short and blocking, async callers run them off the event loop
+
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: RunnableConfig | None, *, filter: dict[str, Any] | None = None, before: RunnableConfig | None = None, limit: int | None = None) -> AsyncIterator[CheckpointTuple]:
+        checkpoints = await asyncio.to_thread(lambda: [*self.list(config, filter=filter, before=before, limit=limit)])
+        for checkpoint in checkpoints:
+            yield checkpoint
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    async def aensure_session(self, thread_id: str):
+        # Takes the write lock to expire sessions, which can wait on other workers
+        return await asyncio.to_thread(self.ensure_session, thread_id)
+
+    def _load_writes(self, connection: sqlite3.Connection, thread_id: str, checkpoint_ns: str, checkpoint_id: str):
+        return connection.execute(
+            "SELECT task_id, channel, type, value FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+            (thread_id, checkpoint_ns, checkpoint_id),
+        ).fetchall()
+
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, row, writes) -> CheckpointTuple:
+        checkpoint_id, parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = row
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((value_type, value))) for task_id, channel, value_type, value in writes],
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_checkpoint_id}}
+                if parent_checkpoint_id
+                else None
+            ),
+        )
+
+    def _delete_session_data(self, connection: sqlite3.Connection, thread_id: str):
+        connection.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+        connection.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+
+    def _evict(self, connection: sqlite3.Connection, thread_ids: List[str], reason: str):
+        for thread_id in thread_ids:
+            self._delete_session_data(connection, thread_id)
+        connection.executemany("UPDATE sessions SET evicted = ? WHERE thread_id = ?", [(reason, thread_id) for thread_id in thread_ids])
+
+    def _expire(self, connection: sqlite3.Connection):
+        if not self.ttl_seconds:
+            return
+        deadline = time.time() - self.ttl_seconds
+        expired = [row[0] for row in connection.execute(
+            "SELECT thread_id FROM sessions WHERE evicted IS NULL AND last_used <= ?", (deadline,)
+        )]
+        self._evict(connection, expired, f"expired after {self.ttl_seconds:g}s without activity")
+        # Eviction markers only need to outlive the point where a client could still come back
+        connection.execute(
+            "DELETE FROM sessions WHERE evicted IS NOT NULL AND last_used <= ?",
+            (deadline - self.ttl_seconds * EVICTED_MEMORY_FACTOR,),
+        )
+
+    def _evict_overflow(self, connection: sqlite3.Connection):
+        overflow = connection.execute("SELECT COUNT(*) FROM sessions WHERE evicted IS NULL").fetchone()[0] - self.max_sessions
+        if overflow > 0:
+            oldest = [row[0] for row in connection.execute(
+                "SELECT thread_id FROM sessions WHERE evicted IS NULL ORDER BY last_used LIMIT ?", (overflow,)
+            )]
+            self._evict(connection, oldest, "evicted to make room for newer sessions")
+
+
+def make_checkpointer(backend: str = CHECKPOINT_BACKEND) -> BaseCheckpointSaver:
+    if backend == "memory":
+        return BoundedInMemorySaver()
+    elif backend == "sqlite":
+        return SqliteSessionSaver()
+    else:
+        raise ValueError(f"Unknown checkpoint backend '{backend}', use 'memory' or 'sqlite'.")
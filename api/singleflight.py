@@ -0,0 +1,42 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight():
+    """
+    Coalesces concurrent calls sharing a key into one execution, every caller gets the same result (or exception).
+    The call runs in its own task, so a caller going away (client disconnect) doesn't cancel it for the others.
+    """
+    def __init__(self):
+        self.calls: Dict[str, asyncio.Task] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self.calls[key] = task
+            self.executed += 1
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def in_flight(self, key: str) -> bool:
+        return key in self.calls
+
+    def stats(self):
+        return {
+            "in_flight": len(self.calls),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+        }
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        # Marks the exception as retrieved when every caller was cancelled before it finished
+        if not task.cancelled():
+            task.exception()
@@ -2,14 +2,79 @@ from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
 
 from langgraph.types import Command
-from rich.pretty import pprint as rpprint
-from jsonpickle import dumps
+from pydantic import BaseModel
 
 from api import app
 from api import AnalysisRequest, RankingsRequest
-from api import compiled_graph
+from api import StageEvent, KeywordsEvent, CompaniesEvent, CompletedEvent, ErrorEvent, city_reports
+from api import agent, compiled_graph
 
 from geo_aval import DominanceGraph
+from sessions import SessionNotFoundError, SessionEvictedError
+from usage import usage_report
+from scheduler import llm_priority
+
+
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
+
+
+def print_error(error: Exception):
+    # rich is only imported once something goes wrong, it isn't worth its startup time otherwise
+    from rich.pretty import pprint as rpprint
+    rpprint(error)
+
+
+def sse(event: str, payload: BaseModel) -> str:
+    return f"event: {event}\ndata: {payload.model_dump_json(exclude_none=True)}\n\n"
+
+
+def company_dumps(companies) -> list[dict]:
+    # Sessions that never reached gather_results still hold the initial DominanceGraph
+    if isinstance(companies, DominanceGraph):
+        companies = companies.companies
+    return [company.model_dump() for company in companies or []]
+
+
+async def stream_graph_events(graph_input, config: dict, session_id: str):
+    """
+    Runs the graph and yields SSE frames with only what changed: stage transitions,
+    keywords not sent yet and the companies of each keyword as soon as it is searched.
+    Full state chunks are never serialized.
+    Someone is watching these, so their OpenAI calls are scheduled ahead of REST and batch work.
+    """
+    sent_keywords = set()
+    with llm_priority("interactive", session_id):
+        async for event in _stream_graph_events(graph_input, config, session_id, sent_keywords):
+            yield event
+
+
+async def _stream_graph_events(graph_input, config: dict, session_id: str, sent_keywords: set):
+    async for mode, chunk in compiled_graph.astream(graph_input, config=config, stream_mode=["tasks", "custom"]):
+        if mode == "custom":
+            # Published by gather_results once per keyword
+            yield sse("companies", CompaniesEvent(session_id=session_id, keyword=chunk["keyword"], city=chunk.get("city"), companies=company_dumps(chunk["companies"]), skipped=chunk.get("skipped"), timed_out=chunk.get("timed_out")))
+            continue
+
+        task = chunk
+        if "result" not in task:
+            yield sse("stage", StageEvent(session_id=session_id, stage=task["name"], status="started"))
+            continue
+
+        if task["error"] is not None:
+            raise task["error"]
+
+        for channel, value in task["result"]:
+            if channel == "keywords" and value:
+                new_keywords = [keyword for keyword in value if keyword not in sent_keywords]
+                sent_keywords.update(new_keywords)
+                if new_keywords:
+                    yield sse("keywords", KeywordsEvent(session_id=session_id, keywords=new_keywords))
+
+        yield sse("stage", StageEvent(session_id=session_id, stage=task["name"], status="completed"))
+
 
 @app.post("/stream/analyze/get_keywords", summary="Start Analysis Session")
 async def start_analysis_stream(request: AnalysisRequest):
@@ -21,55 +86,36 @@ async def start_analysis_stream(request: AnalysisRequest):
         try:
             import uuid
             session_id = str(uuid.uuid4())
-            
-            
-            config = {"configurable": {"thread_id": session_id}, "language": request.language, "location": request.city}
-
-            yield dumps({
-                "stage": "initializing",
-                "session_id": session_id,
-                "data": None
-            }, unpicklable=False) + "\n"
-            
-            #(will stop at keyword refinement)  
-            for chunk in compiled_graph.stream({
+
+            config = {"configurable": {"thread_id": session_id, "language": request.language, "location": request.city, "refresh_profile": request.refresh_profile}}
+
+            yield sse("stage", StageEvent(session_id=session_id, stage="initializing", status="started"))
+
+            #(will stop at keyword refinement)
+            async for event in stream_graph_events({
                 "keywords": [],
                 "target": request.brand_name,
                 "graph": DominanceGraph(companies=[]),
                 "messages": []
-            }, config=config):
-                yield dumps({
-                    "stage": "analysys",
-                    "session_id": session_id,
-                    "data": chunk
-                }, unpicklable=False) + "\n"
-            
-            graph_state = compiled_graph.get_state(config)
+            }, config, session_id):
+                yield event
+
+            graph_state = await compiled_graph.aget_state(config)
             values = graph_state.values
             keywords = values.get("keywords")
-            
-            yield dumps({
-                "stage": "completed",
-                "session_id": session_id,
-                "data": {
-                    "keywords": keywords,
-                }
-            }, unpicklable=False) + "\n"
+
+            yield sse("completed", CompletedEvent(session_id=session_id, keywords=keywords))
         except Exception as e:
-            yield dumps({
-                "stage": "error",
-                "session_id": session_id if 'session_id' in locals() else None,
-                "data": f"Failed to start analysis: {str(e)}",
-            }, unpicklable=False) + "\n"
+            print_error(e)
+            yield sse("error", ErrorEvent(
+                session_id=session_id if 'session_id' in locals() else None,
+                detail=f"Failed to start analysis: {str(e)}",
+            ))
 
     return StreamingResponse(
         generate_analysis_stream(),
-        media_type="text/plain",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream",
-        }
+        media_type="text/event-stream",
+        headers=STREAM_HEADERS,
     )
 
 
@@ -77,78 +123,73 @@ async def start_analysis_stream(request: AnalysisRequest):
 async def start_refine_keywords_stream(request: RankingsRequest):
     """
     Gather rankings based on chosen keywords.
+    With `cities`, the companies of each keyword come once per city and the completed event has the results per city.
     """
+    # Checked before streaming starts so an unknown session still gets a proper status code
+    if request.session_id is not None:
+        try:
+            await agent.checkpointer.aensure_session(request.session_id)
+        except SessionEvictedError as e:
+            raise HTTPException(status_code=410, detail=str(e))
+        except SessionNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+
     async def generate_refine_keywords_stream():
         try:
             session_id = request.session_id
             keywords = request.keywords
             language = request.language
-            city = request.city
+            city = request.location()
             brand_name = request.brand_name
 
             if keywords and len(keywords) > 10:
                 raise HTTPException(status_code=400, detail="You can only search for up to 10 keywords.")
 
-            yield dumps({
-                "stage": "initializing",
-                "session_id": session_id,
-                "data": None
-            }, unpicklable=False) + "\n"
-
             if session_id is None:
                 import uuid
-                new_session_id = str(uuid.uuid4())
-                config = {"configurable": {"thread_id": new_session_id, "language": language, "location": city}}
-                
-                for chunk in compiled_graph.stream({
+                session_id = str(uuid.uuid4())
+                config = {"configurable": {"thread_id": session_id, "language": language, "location": city, **request.run_options()}}
+                graph_input = {
                     "keywords": keywords,
                     "target": brand_name,
                     "graph": DominanceGraph(companies=[]),
                     "messages": []
-                }, config=config):
-                    yield dumps({
-                        "stage": "gathering_results",
-                        "session_id": new_session_id,
-                        "data": chunk
-                    }, unpicklable=False) + "\n"
-                
-                values = compiled_graph.get_state(config).values
-                session_id = new_session_id
+                }
             else:
-                config = {"configurable": {"thread_id": session_id}}
-                
-                for chunk in compiled_graph.stream(Command(resume="", update={"keywords": keywords if len(keywords) > 0 else None}), config=config):
-                    yield dumps({
-                        "stage": "gathering_results",
-                        "session_id": session_id,
-                        "data": chunk
-                    }, unpicklable=False) + "\n"
-                
-                values = compiled_graph.get_state(config).values
-            
+                config = {"configurable": {"thread_id": session_id, **request.run_options()}}
+                graph_input = Command(resume="", update={"keywords": keywords} if keywords else None)
+
+            yield sse("stage", StageEvent(session_id=session_id, stage="initializing", status="started"))
+
+            async for event in stream_graph_events(graph_input, config, session_id):
+                yield event
+
+            values = (await compiled_graph.aget_state(config)).values
             graph = values.get("graph")
 
-            yield dumps({
-                "stage": "completed",
-                "session_id": session_id,
-                "data": {
-                    "graph": graph,
-                }
-            }, unpicklable=False) + "\n"   
+            skipped_keywords = values.get("skipped_keywords") or []
+            timed_out_keywords = values.get("timed_out_keywords") or []
+
+            yield sse("completed", CompletedEvent(
+                session_id=session_id,
+                graph=company_dumps(graph),
+                rankings=values.get("rankings"),
+                usage=usage_report(values.get("usage")),
+                partial=len(skipped_keywords) + len(timed_out_keywords) > 0,
+                skipped_keywords=skipped_keywords,
+                timed_out_keywords=timed_out_keywords,
+                cities=city_reports(values.get("city_results")),
+                comparison=values.get("comparison"),
+            ))
         except Exception as e:
-            rpprint(e)
-            yield dumps({
-                "stage": "error",
-                "session_id": session_id if 'session_id' in locals() else None,
-                "data": f"Failed to refine analysis: {str(e)}",
-            }, unpicklable=False) + "\n"
-    
+            print_error(e)
+            yield sse("error", ErrorEvent(
+                session_id=session_id if 'session_id' in locals() else None,
+                detail=f"Failed to refine analysis: {str(e)}",
+            ))
+
     return StreamingResponse(
         generate_refine_keywords_stream(),
-        media_type="text/plain",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream",
-        }
-    )
\ No newline at end of file
+        media_type="text/event-stream",
+        headers=STREAM_HEADERS,
+    )
@@ -17,8 +17,8 @@ async def test_refine_keywords(request):
         config = {"configurable": {"thread_id": "1"}}
 
         # Simulate the refinement process using a predefined state
-        resp = compiled_graph.invoke(keywords_chosen_state)
-        graph_state = compiled_graph.get_state(config)
+        resp = await compiled_graph.ainvoke(keywords_chosen_state)
+        graph_state = await compiled_graph.aget_state(config)
         return {
             "response": resp,
         }
@@ -0,0 +1,146 @@
+"""
+Admission control test for the analysis endpoints, runs fully offline against a stubbed LLM.
+
+Each endpoint class gets a couple of slots and a short queue, then:
+a burst from one client beyond slots plus queue is answered right away with 503 and a Retry-After,
+requests that wait longer than the queue timeout get 503, a second client arriving while the first one
+floods the queue still gets its analyses through (the first client's newest waiters get 429), even when the
+flooding client sends a new X-API-Key with every request, an open stream holds its slot until its last event,
+and the rejections show in /admission/stats and /metrics.
+Clients are told apart by address, or by X-API-Key when the key is trusted (an authenticating proxy in front).
+
+Usage (from the api folder):
+    python tests/admission_test.py --latency 0.5
+"""
+import os
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Runs against stubs aren't worth keeping in the rankings history
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+# Every request does its own research, so each holds its slot for its LLM calls
+os.environ["GEO_BRAND_PROFILE_TTL_SECONDS"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from stub_llm import install_stub_llm
+
+from api import app
+import invoke  # noqa: F401 - registers the /analyze routes
+import streaming  # noqa: F401 - registers the /stream/analyze routes
+from admission import admission_controller, EndpointLimiter
+
+
+def limit(endpoint: str, concurrency: int, queue: int, queue_timeout_seconds: float):
+    admission_controller.limiters[endpoint] = EndpointLimiter(endpoint, concurrency, queue, queue_timeout_seconds)
+
+
+def client_at(address: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app, client=(address, 50000)), base_url="http://admission", timeout=None)
+
+
+async def get_keywords(client: httpx.AsyncClient, index: int, api_key: str | None = None, stream: bool = False):
+    started = time.perf_counter()
+    response = await client.post(
+        f"{'/stream' if stream else ''}/analyze/get_keywords",
+        json={"brand_name": f"brand {index}", "city": "Joinville", "language": "pt_BR"},
+        # A new key for every request unless one is given
+        headers={"X-API-Key": api_key or str(uuid.uuid4())},
+    )
+    return response, time.perf_counter() - started
+
+
+def statuses(results) -> dict:
+    counts = {}
+    for response, _ in results:
+        counts[response.status_code] = counts.get(response.status_code, 0) + 1
+    return counts
+
+
+async def main(latency: float):
+    install_stub_llm(latency=latency)
+    # get_keywords makes two LLM calls
+    analysis = 2 * latency
+
+    async def flood_and_arrive(flood_client, flood_key, arriving_client, arriving_key):
+        "6 requests fill slots and queue, 2 from another client arrive a moment later"
+        limit("analysis", concurrency=2, queue=4, queue_timeout_seconds=20 * analysis)
+        flood = [asyncio.create_task(get_keywords(flood_client, index, flood_key)) for index in range(6)]
+        await asyncio.sleep(latency / 4)
+        arriving = await asyncio.gather(*[get_keywords(arriving_client, index, arriving_key) for index in range(2)])
+        return await asyncio.gather(*flood), arriving
+
+    async with client_at("10.0.0.1") as client, client_at("10.0.0.2") as other_client:
+        # 10 at once from one client: 2 run, 2 wait, 6 are turned away without waiting
+        limit("analysis", concurrency=2, queue=2, queue_timeout_seconds=10 * analysis)
+        burst = await asyncio.gather(*[get_keywords(client, index) for index in range(10)])
+        rejected = [(response, elapsed) for response, elapsed in burst if response.status_code == 503]
+        slowest_rejection = max(elapsed for _, elapsed in rejected)
+        retry_after = {response.headers.get("retry-after") for response, _ in rejected}
+        print(f"burst of 10:         {statuses(burst)}, rejected within {slowest_rejection * 1000:.0f}ms, Retry-After {sorted(retry_after)}")
+        if statuses(burst) != {200: 4, 503: 6} or slowest_rejection > latency / 2 or None in retry_after:
+            raise SystemExit("FAIL: a burst past slots and queue wasn't rejected right away with a Retry-After")
+
+        # Waiting longer than the queue timeout
+        limit("analysis", concurrency=1, queue=4, queue_timeout_seconds=analysis / 2)
+        waited = await asyncio.gather(*[get_keywords(client, index) for index in range(3)])
+        timed_out = [elapsed for response, elapsed in waited if response.status_code == 503]
+        print(f"queue timeout:       {statuses(waited)}, gave up after {min(timed_out):.2f}s")
+        if statuses(waited) != {200: 1, 503: 2} or not analysis / 2 <= min(timed_out) < analysis:
+            raise SystemExit("FAIL: queued requests didn't give up at their queue timeout")
+
+        # Another address gets through ahead of the flood's newest waiters, though the flood rotates its X-API-Key
+        flood, fair = await flood_and_arrive(client, None, other_client, None)
+        print(f"fair share:          rotating keys {statuses(flood)}, other address {statuses(fair)}")
+        if statuses(fair) != {200: 2} or statuses(flood) != {200: 4, 429: 2}:
+            raise SystemExit("FAIL: a client rotating its API key took more than its share")
+        if max(elapsed for _, elapsed in fair) > 4 * analysis:
+            raise SystemExit("FAIL: the second client waited behind the whole flood")
+
+        # Behind an authenticating proxy every request comes from its address, the verified keys tell tenants apart
+        admission_controller.trust_api_key = True
+        try:
+            flood, fair = await flood_and_arrive(client, "tenant-a", client, "tenant-b")
+        finally:
+            admission_controller.trust_api_key = False
+        print(f"trusted keys:        tenant a {statuses(flood)}, tenant b {statuses(fair)}")
+        if statuses(fair) != {200: 2} or statuses(flood) != {200: 4, 429: 2}:
+            raise SystemExit("FAIL: trusted API keys weren't told apart")
+
+        # An open stream holds its slot until its last event
+        limit("stream", concurrency=1, queue=0, queue_timeout_seconds=analysis)
+        first = asyncio.create_task(get_keywords(client, 0, stream=True))
+        await asyncio.sleep(latency / 4)
+        second, _ = await get_keywords(other_client, 1, stream=True)
+        first, _ = await first
+        third, _ = await get_keywords(other_client, 2, stream=True)
+        print(f"streams:             {first.status_code} while {second.status_code}, then {third.status_code}")
+        if (first.status_code, second.status_code, third.status_code) != (200, 503, 200):
+            raise SystemExit("FAIL: a stream didn't hold its slot until it ended")
+
+        stats = (await client.get("/admission/stats")).json()
+        metrics = (await client.get("/metrics")).text
+
+    print(f"last limits' stats: analysis {stats['analysis']['rejected']}, stream {stats['stream']['rejected']}")
+    if stats["analysis"]["running"] or stats["analysis"]["queued"] or stats["stream"]["running"]:
+        raise SystemExit(f"FAIL: slots or waiters left behind: {stats}")
+    for sample in (
+        'geo_admission_rejected_total{endpoint="analysis",reason="queue_full"}',
+        'geo_admission_rejected_total{endpoint="analysis",reason="fair_share"}',
+        'geo_http_request_duration_seconds_count{method="POST",route="/analyze/get_keywords",status="503"}',
+    ):
+        if sample not in metrics:
+            raise SystemExit(f"FAIL: {sample} missing from /metrics")
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Admission control test for the analysis endpoints")
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated seconds per LLM call")
+    args = parser.parse_args()
+    asyncio.run(main(args.latency))
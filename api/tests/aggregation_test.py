@@ -0,0 +1,147 @@
+"""
+Regression checks for how rank_companies merges brands, runs offline in well under a second.
+
+Spelling variants, legal forms and a brand's own website merge; competitors cited through the same news article,
+directory or site builder, or sharing only a kind of business ("Papelaria", "Distribuidora"), stay apart,
+and a generic name matching two brands doesn't bridge them into one.
+Merging 1000 names sharing a kind of business, or 1000 spellings of one brand, takes well under a second.
+
+Usage (from the api folder):
+    python tests/aggregation_test.py
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregation import compare_cities, rank_companies
+
+
+def company(name: str, *urls: str, times_cited: int = 1):
+    return SimpleNamespace(name=name, relevantUrls=list(urls), times_cited=times_cited)
+
+
+def brands(*companies, keyword: str = "papel toalha") -> list[set]:
+    return sorted((set(ranked.aliases) for ranked in rank_companies([(keyword, list(companies))])), key=sorted)
+
+
+CASES = [
+    (
+        "competitors cited through the same news article",
+        [
+            company("Copapel", "https://www.valoresdors.com.br/noticias/distribuidoras-de-joinville"),
+            company("Higiclean", "https://valoresdors.com.br/noticias/distribuidoras-de-joinville"),
+        ],
+        [{"Copapel"}, {"Higiclean"}],
+    ),
+    (
+        "competitors cited through the same site builder",
+        [
+            company("Acme", "https://acmelimpeza.wixsite.com/site"),
+            company("Beta Limpeza", "https://betalimpeza.wixsite.com/site"),
+            company("Gama", "https://gama-joinville.negocio.site/"),
+            company("Delta Papeis", "https://delta.negocio.site/"),
+        ],
+        [{"Acme"}, {"Beta Limpeza"}, {"Delta Papeis"}, {"Gama"}],
+    ),
+    (
+        "a directory listing many brands",
+        [
+            company("Copapel", "https://www.guiamais.com.br/joinville/distribuidoras"),
+            company("Higiclean", "https://www.guiamais.com.br/joinville/distribuidoras"),
+            company("Papel Sul", "https://www.guiamais.com.br/joinville/distribuidoras"),
+        ],
+        [{"Copapel"}, {"Higiclean"}, {"Papel Sul"}],
+    ),
+    (
+        "a generic name can't bridge two brands",
+        [
+            company("Papelaria"),
+            company("Papelaria Vale"),
+            company("Papelaria Catarinense"),
+        ],
+        [{"Papelaria"}, {"Papelaria Catarinense"}, {"Papelaria Vale"}],
+    ),
+    (
+        "names sharing only a kind of business",
+        [
+            company("Distribuidora Sul"),
+            company("Comercial Sul"),
+        ],
+        [{"Comercial Sul"}, {"Distribuidora Sul"}],
+    ),
+    (
+        "a brand whose name matches two others doesn't merge them together",
+        [
+            company("Vale"),
+            company("Vale Papeis"),
+            company("Vale Embalagens Norte"),
+        ],
+        None,
+    ),
+    (
+        "spelling variants, legal forms and the brand's own site",
+        [
+            company("Copapel Distribuidora LTDA", "https://copapel.com.br/"),
+            company("Copapel", "https://www.copapel.com.br/produtos"),
+            company("COPAPELL"),
+            company("Papéis Copapel", "https://copapel.com.br/contato"),
+            company("Higiclean S.A.", "https://higiclean.com.br"),
+            company("Higiclean"),
+        ],
+        [{"Copapel Distribuidora LTDA", "Copapel", "COPAPELL", "Papéis Copapel"}, {"Higiclean S.A.", "Higiclean"}],
+    ),
+]
+
+
+def main():
+    for description, companies, expected in CASES:
+        merged = brands(*companies)
+        if expected is None:
+            # Vale may join either of them, never both
+            if any({"Vale Papeis", "Vale Embalagens Norte"} <= aliases for aliases in merged):
+                raise SystemExit(f"FAIL: {description}: {merged}")
+        elif merged != sorted(expected, key=sorted):
+            raise SystemExit(f"FAIL: {description}: {merged}")
+        print(f"ok  {description}")
+
+    # Domains shared with other brands aren't reported as a brand's own
+    ranked = rank_companies([("papel toalha", [
+        company("Copapel", "https://copapel.com.br", "https://valoresdors.com.br/a"),
+        company("Higiclean", "https://valoresdors.com.br/a"),
+    ])])
+    copapel = next(ranked_company for ranked_company in ranked if ranked_company.name == "Copapel")
+    if copapel.domains != ["copapel.com.br"]:
+        raise SystemExit(f"FAIL: a news domain was reported as Copapel's: {copapel.domains}")
+
+    # Cities are compared with the same rules
+    comparison = compare_cities({
+        "Joinville": rank_companies([("papel", [company("Copapel", "https://valoresdors.com.br/a")])]),
+        "Curitiba": rank_companies([("papel", [company("Higiclean", "https://valoresdors.com.br/a")])]),
+    })
+    if sorted(brand.name for brand in comparison) != ["Copapel", "Higiclean"]:
+        raise SystemExit(f"FAIL: cities merged brands sharing a news article: {comparison}")
+
+    # Names sharing a common first word (or all spelling the same brand) don't make the comparisons quadratic
+    # Any two words differ in a whole syllable, letters included
+    syllables = ["ba", "ce", "di", "fo", "gu", "hy", "jar", "kes", "lin", "mor"]
+    word = lambda number: "".join(syllables[int(digit)] for digit in f"{number:03d}")
+    for description, names, groups in (
+        ("distinct brands", [f"Distribuidora {word(i)} Sul" for i in range(1000)], 1000),
+        ("citations of one brand's spellings", [
+            f"{'Distribuidora ' * (i % 2)}{('Copapel', 'COPAPEL', 'Copapél', 'Copapell')[i % 4]}{('', ' LTDA', ' S.A.')[i % 3]}" for i in range(1000)
+        ], 1),
+    ):
+        started = time.perf_counter()
+        ranked = rank_companies([("papel toalha", [company(name) for name in names])])
+        elapsed = time.perf_counter() - started
+        print(f"ok  1000 {description}: {len(ranked)} brands in {elapsed:.2f}s")
+        if len(ranked) != groups or elapsed > 1:
+            raise SystemExit(f"FAIL: 1000 {description} took {elapsed:.2f}s and gave {len(ranked)} brands, expected {groups}")
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
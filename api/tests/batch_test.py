@@ -0,0 +1,157 @@
+"""
+Checks the batch job endpoints end to end, fully offline against a stubbed LLM.
+
+Submits a job with repeated items (JSON and CSV), follows its progress, downloads the NDJSON results
+while it runs and checks every item got exactly one result line, that repeated items ran once and that
+items of the same city reused each other's keyword searches. Then cancels a job midway.
+Last, two workers share a job store: each answers for and cancels the jobs of the other, and when one goes away
+midway through a job the other takes it over and finishes it.
+
+Usage (from the api folder):
+    python tests/batch_test.py --brands 6 --workers 3 --latency 0.2
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+os.environ["GEO_HISTORY_PATH"] = os.path.join(tempfile.mkdtemp(), "rankings_history.db")
+os.environ["GEO_BATCH_POLL_SECONDS"] = "0.05"
+os.environ["GEO_BATCH_STALE_SECONDS"] = "0.5"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from stub_llm import install_stub_llm
+
+from api import app, agent
+import batch
+from jobs import JobRunner
+import history  # noqa: F401 - registers the /history routes
+
+
+async def wait_for(client: httpx.AsyncClient, job_id: str, statuses: tuple[str, ...], timeout: float = 120):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        progress = (await client.get(f"/batch/jobs/{job_id}")).json()
+        if progress["status"] in statuses:
+            return progress
+        await asyncio.sleep(0.05)
+    raise SystemExit(f"Job {job_id} still {progress['status']} after {timeout}s")
+
+
+async def shared_store(args):
+    "Two workers of a server sharing the job store file"
+    path = os.path.join(tempfile.mkdtemp(), "batch_jobs.db")
+    first, second = (JobRunner(batch.analyze_item, workers=args.workers, store_path=path) for _ in range(2))
+    second.start_workers()
+    items = lambda name: [{"brand_name": f"{name} {i}", "city": "Blumenau", "language": "en_US"} for i in range(args.brands * 2)]
+
+    # Run by the first, followed through the second
+    job = await first.submit(items("Shared"), {})
+    results = [result async for result in await second.results(job.id)]
+    progress = await second.progress(job.id)
+    print(f"followed from another worker: {progress['status']}, {len(results)} of {progress['total']} results")
+    assert progress["status"] == "completed" and sorted(result["index"] for result in results) == list(range(len(job.items)))
+
+    # Cancelled through the second, the first stops it when it next checks in
+    job = await first.submit(items("Cancelled"), {})
+    while not job.results:
+        await asyncio.sleep(0.05)
+    progress = await second.cancel(job.id)
+    await asyncio.sleep(0.2)
+    print(f"cancelled from another worker: {progress['status']}, running on its own worker {len(job.running)}")
+    assert progress["status"] == "cancelled" and job.status == "cancelled" and not job.running
+
+    # The first goes away midway (a restart, a crash), the second takes its job over
+    job = await first.submit(items("Orphan"), {})
+    while not job.results:
+        await asyncio.sleep(0.05)
+    for task in (*first.worker_tasks, first.watch_task):
+        task.cancel()
+    results = [result async for result in await second.results(job.id)]
+    progress = await second.progress(job.id)
+    print(f"taken over: {progress['status']}, {len(job.results)} results before, {len(results)} of {progress['total']} in the end")
+    assert progress["status"] == "completed" and job.id in second.jobs
+    assert sorted(result["index"] for result in results) == list(range(len(job.items))), "every item gets exactly one result line"
+    stats = await second.stats()
+    assert stats["jobs"] == {"queued": 0, "running": 0, "completed": 2, "cancelled": 1}, stats
+
+
+async def main(args):
+    stub = install_stub_llm(latency=args.latency)
+    batch.job_runner.workers = args.workers
+
+    # Every brand in two cities, plus the first brand repeated with different casing
+    items = [{"brand_name": f"Brand {i}", "city": city, "language": "en_US"} for i in range(args.brands) for city in ("Joinville", "Curitiba")]
+    items.append({"brand_name": "  brand 0 ", "city": "joinville", "language": "en_US"})
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", timeout=120) as client:
+        start = time.perf_counter()
+        response = await client.post("/batch/jobs", json={"items": items})
+        assert response.status_code == 200, response.text
+        job = response.json()
+        print(f"submitted {job['total']} items ({job['unique']} unique) in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        # Downloaded while the job runs, the stream ends with the job
+        lines = (await client.get(f"/batch/jobs/{job['job_id']}/results")).text.splitlines()
+        progress = await wait_for(client, job["job_id"], ("completed",))
+        results = [json.loads(line) for line in lines]
+        print(f"completed in {progress['elapsed_seconds']:.2f}s: {progress['completed']} ok, {progress['failed']} failed, {progress['web_searches']} web searches")
+
+        assert sorted(result["index"] for result in results) == list(range(len(items))), "every item gets exactly one result line"
+        assert all(result["status"] == "ok" and result["graph"] for result in results), [result for result in results if result["status"] != "ok"][:1]
+        assert progress["deduplicated"] == 1
+        # 10 stub keywords per brand, the same for every brand, searched once per city
+        cache = (await client.get("/cache/stats")).json()
+        print(f"search cache hits {cache['hits']}, coalesced {cache['single_flight']['coalesced']}, upstream searches {cache['single_flight']['executed']}")
+        assert cache["single_flight"]["executed"] <= 2 * len(stub.keywords), "keyword searches are shared between items of a city"
+        assert agent.checkpointer.session_count() == 0, "batch sessions are dropped once their results are kept"
+
+        # Every analysis is in the rankings history, its companies can be followed over time
+        trend = (await client.get("/history/share-of-voice", params={"city": "Joinville", "language": "en_US", "top": 0})).json()
+        print(f"history: {len(trend['companies'])} companies cited in Joinville on {trend['days']}")
+        assert [company["company"] for company in trend["companies"]] == ["Acme", "Globex"] and len(trend["days"]) == 1
+        changes = (await client.get("/history/rank-changes", params={"city": "joinville", "language": "en_US", "brand": "Brand 1"})).json()
+        assert [company["rank_after"] for company in changes["companies"]] == [1, 2], changes
+        emerging = (await client.get("/history/emerging", params={"city": "Joinville", "language": "en_US"})).json()
+        assert len(emerging["companies"]) == 2
+        assert (await client.get("/history/emerging", params={"city": "Joinville", "language": "en_US", "start": "2030-01-01", "end": "2029-01-01"})).status_code == 400
+
+        csv_body = "brand_name,city,language\n" + "\n".join(f"Brand {i},Blumenau,pt_BR" for i in range(args.brands))
+        response = await client.post("/batch/jobs/csv?use_cache=false&structuring_mode=batched", content=csv_body, headers={"content-type": "text/csv"})
+        assert response.status_code == 200, response.text
+        progress = await wait_for(client, response.json()["job_id"], ("completed",))
+        print(f"csv job: {progress['completed']} ok in {progress['elapsed_seconds']:.2f}s")
+
+        response = await client.post("/batch/jobs/csv", content="brand,city\nx,y", headers={"content-type": "text/csv"})
+        assert response.status_code == 400, response.text
+        response = await client.post("/batch/jobs", json={"items": [{"brand_name": "x", "city": "y", "language": "de_DE"}]})
+        assert response.status_code == 422, response.text
+
+        # Cancelled after the first results, the ones already in stay downloadable
+        response = await client.post("/batch/jobs", json={"items": [{"brand_name": f"Other {i}", "city": "Itajaí", "language": "en_US"} for i in range(args.brands * 2)]})
+        job_id = response.json()["job_id"]
+        while (await client.get(f"/batch/jobs/{job_id}")).json()["completed"] == 0:
+            await asyncio.sleep(0.05)
+        progress = (await client.delete(f"/batch/jobs/{job_id}")).json()
+        lines = (await client.get(f"/batch/jobs/{job_id}/results")).text.splitlines()
+        print(f"cancelled job: {progress['status']} with {len(lines)} of {progress['total']} results")
+        assert progress["status"] == "cancelled" and 0 < len(lines) < progress["total"]
+
+        assert (await client.get("/batch/jobs/missing")).status_code == 404
+        print(f"{stub.calls} stub LLM calls")
+    await shared_store(args)
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--brands", type=int, default=6)
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.2)
+    asyncio.run(main(parser.parse_args()))
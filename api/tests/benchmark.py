@@ -0,0 +1,266 @@
+"""
+Offline benchmark of the analysis endpoints, replaying recorded OpenAI traffic from a cassette.
+
+Runs get_keywords followed by get_rankings through the REST (/analyze) and streaming (/stream/analyze)
+endpoints and reports, per endpoint:
+    end-to-end latency (median and worst), time to the first streamed keywords or companies
+    time spent in each graph node
+    checkpoint serialization time and size, SSE frame encoding time, response size
+    peak Python memory (one extra traced run, tracemalloc slows everything down)
+
+Replayed calls wait --latency seconds (plus --chunk-latency between streamed events) instead of the recorded time,
+so results compare code changes rather than OpenAI's mood on the day of the recording.
+
+Usage (from the api folder):
+    python tests/benchmark.py --runs 5 --latency 0.3
+    python tests/benchmark.py --record                       # re-records the cassette against tests/fake_openai.py
+    python tests/benchmark.py --record --upstream openai     # re-records against the real API, needs GEO_AVAL_API_KEY
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+from contextvars import ContextVar
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+DEFAULT_CASSETTE = os.path.join(FIXTURES_PATH, "benchmark_cassette.json")
+
+BRAND, CITY, LANGUAGE = "copapel", "Joinville", "pt_BR"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds each replayed OpenAI call waits")
+    parser.add_argument("--chunk-latency", type=float, default=0.005, help="Seconds between replayed streamed events")
+    parser.add_argument("--cassette", default=DEFAULT_CASSETTE)
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory", help="Checkpoint backend")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the traced peak memory run")
+    parser.add_argument("--record", action="store_true", help="Record the cassette instead of replaying it")
+    parser.add_argument("--upstream", choices=["fake", "openai"], default="fake", help="What --record talks to")
+    return parser.parse_args()
+
+
+args = parse_args()
+
+# Everything below reads its settings on import
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Every run measures the whole analysis, not a brand profile cache hit
+os.environ.setdefault("GEO_BRAND_PROFILE_TTL_SECONDS", "0")
+os.environ.setdefault("GEO_HISTORY_PATH", os.path.join(tempfile.mkdtemp(), "rankings_history.db"))
+os.environ["GEO_LLM_CASSETTE"] = args.cassette
+os.environ["GEO_LLM_CASSETTE_MODE"] = "record" if args.record else "replay"
+if not args.record:
+    os.environ["GEO_LLM_CASSETTE_LATENCY"] = str(args.latency)
+    os.environ["GEO_LLM_CASSETTE_CHUNK_LATENCY"] = str(args.chunk_latency)
+os.environ["GEO_CHECKPOINT_BACKEND"] = args.backend
+if args.backend == "sqlite":
+    os.environ["GEO_CHECKPOINT_PATH"] = os.path.join(tempfile.mkdtemp(), "benchmark_sessions.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import asyncio
+
+import httpx
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.tracers.context import register_configure_hook
+
+import cassette
+from api import app, agent
+import invoke  # noqa: F401 - registers the /analyze routes
+import streaming  # registers the /stream/analyze routes
+
+
+class NodeTimer(BaseCallbackHandler):
+    "Adds up the wall time of every graph node run"
+    run_inline = True
+
+    def __init__(self):
+        self.started = {}
+        self.seconds = {}
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        # Only the node itself, not the runnables it calls
+        if node is not None and kwargs.get("name") == node:
+            self.started[run_id] = (node, time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        if run_id in self.started:
+            node, start = self.started.pop(run_id)
+            self.seconds[node] = self.seconds.get(node, 0.0) + time.perf_counter() - start
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.on_chain_end(None, run_id=run_id)
+
+
+node_timer_var: ContextVar[NodeTimer | None] = ContextVar("node_timer", default=None)
+register_configure_hook(node_timer_var, inheritable=True)
+
+
+class TimedSerializer():
+    "Wraps the checkpointer serializer to measure what checkpointing costs"
+    def __init__(self, serde):
+        self.serde = serde
+        self.reset()
+
+    def reset(self):
+        self.dumps_seconds = 0.0
+        self.loads_seconds = 0.0
+        self.dumped_bytes = 0
+
+    def dumps_typed(self, obj):
+        start = time.perf_counter()
+        type_, data = self.serde.dumps_typed(obj)
+        self.dumps_seconds += time.perf_counter() - start
+        self.dumped_bytes += len(data)
+        return type_, data
+
+    def loads_typed(self, data):
+        start = time.perf_counter()
+        try:
+            return self.serde.loads_typed(data)
+        finally:
+            self.loads_seconds += time.perf_counter() - start
+
+    def __getattr__(self, name):
+        return getattr(self.serde, name)
+
+
+class TimedSSE():
+    def __init__(self, sse):
+        self.sse = sse
+        self.reset()
+
+    def reset(self):
+        self.seconds = 0.0
+        self.first_at = {}
+
+    def __call__(self, event, payload):
+        start = time.perf_counter()
+        self.first_at.setdefault(event, start)
+        try:
+            return self.sse(event, payload)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+serializer = TimedSerializer(agent.checkpointer.serde)
+agent.checkpointer.serde = serializer
+timed_sse = TimedSSE(streaming.sse)
+streaming.sse = timed_sse
+
+
+async def call(client: httpx.AsyncClient, path: str, body: dict) -> dict:
+    "Posts and measures one request"
+    node_timer = NodeTimer()
+    token = node_timer_var.set(node_timer)
+    serializer.reset()
+    timed_sse.reset()
+    try:
+        start = time.perf_counter()
+        response = await client.post(path, json=body)
+        response.raise_for_status()
+        elapsed = time.perf_counter() - start
+        # The ASGI transport hands the body over once it's complete, so streamed events are timed when encoded
+        first_result = next((timed_sse.first_at[event] - start for event in ("keywords", "companies") if event in timed_sse.first_at), None)
+    finally:
+        node_timer_var.reset(token)
+
+    content = response.content
+    if path.startswith("/stream"):
+        # The last frame is the completed (or error) event
+        event, data = content.decode().strip().split("\n\n")[-1].split("\n", 1)
+        if event != "event: completed":
+            raise Exception(f"{path} failed: {data}")
+        payload = json.loads(data.removeprefix("data: "))
+    else:
+        payload = json.loads(content)
+
+    return {
+        "payload": payload,
+        "seconds": elapsed,
+        "first_result": first_result,
+        "nodes": node_timer.seconds,
+        "checkpoint_dumps": serializer.dumps_seconds,
+        "checkpoint_loads": serializer.loads_seconds,
+        "checkpoint_bytes": serializer.dumped_bytes,
+        "sse_encoding": timed_sse.seconds,
+        "response_bytes": len(content),
+    }
+
+
+async def run_analysis(client: httpx.AsyncClient, stream: bool) -> dict:
+    prefix = "/stream" if stream else ""
+    keywords = await call(client, f"{prefix}/analyze/get_keywords", {"brand_name": BRAND, "city": CITY, "language": LANGUAGE})
+    session_id, chosen = keywords["payload"]["session_id"], keywords["payload"]["keywords"]
+    rankings = await call(client, f"{prefix}/analyze/get_rankings", {"session_id": session_id, "keywords": chosen, "use_cache": False})
+    return {f"{prefix}/get_keywords": keywords, f"{prefix}/get_rankings": rankings}
+
+
+def summarize(name: str, runs: list[dict], peak_bytes: int | None):
+    seconds = [run["seconds"] for run in runs]
+    median = lambda key: statistics.median(run[key] for run in runs)
+    nodes = {node: statistics.median(run["nodes"].get(node, 0.0) for run in runs) for node in dict.fromkeys(n for run in runs for n in run["nodes"])}
+
+    print(f"\n{name}")
+    print(f"  latency         median {statistics.median(seconds) * 1000:8.1f} ms   worst {max(seconds) * 1000:8.1f} ms")
+    if runs[0]["first_result"] is not None:
+        print(f"  first result    median {median('first_result') * 1000:8.1f} ms")
+    for node, node_seconds in nodes.items():
+        print(f"  node {node:<16} {node_seconds * 1000:8.1f} ms")
+    print(f"  checkpoints     dumps {median('checkpoint_dumps') * 1000:6.2f} ms   loads {median('checkpoint_loads') * 1000:6.2f} ms   {median('checkpoint_bytes') / 1024:8.1f} KiB written")
+    if runs[0]["first_result"] is not None:
+        print(f"  sse encoding    {median('sse_encoding') * 1000:6.2f} ms")
+    print(f"  response        {median('response_bytes') / 1024:8.1f} KiB")
+    if peak_bytes is not None:
+        print(f"  peak memory     {peak_bytes / 1024 / 1024:8.2f} MiB")
+
+
+async def main():
+    if args.record:
+        if args.upstream == "fake":
+            from fake_openai import FakeOpenAITransport
+            cassette.cassette_transport.upstream = FakeOpenAITransport()
+        elif os.environ["GEO_AVAL_API_KEY"] == "stub":
+            raise SystemExit("Recording against OpenAI needs GEO_AVAL_API_KEY.")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=300) as client:
+        if args.record:
+            for stream in (False, True):
+                await run_analysis(client, stream)
+            print(f"Recorded {cassette.cassette_transport.recorded} calls to {args.cassette}")
+            return
+
+        # Warm up imports, prompt templates and the first connection before measuring
+        for stream in (False, True):
+            await run_analysis(client, stream)
+
+        results: dict[str, list[dict]] = {}
+        for _ in range(args.runs):
+            for stream in (False, True):
+                for name, result in (await run_analysis(client, stream)).items():
+                    results.setdefault(name, []).append(result)
+
+        peaks = {}
+        if not args.no_memory:
+            for stream in (False, True):
+                prefix = "/stream" if stream else ""
+                tracemalloc.start()
+                keywords = await call(client, f"{prefix}/analyze/get_keywords", {"brand_name": BRAND, "city": CITY, "language": LANGUAGE})
+                peaks[f"{prefix}/get_keywords"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.reset_peak()
+                await call(client, f"{prefix}/analyze/get_rankings", {"session_id": keywords["payload"]["session_id"], "keywords": keywords["payload"]["keywords"], "use_cache": False})
+                peaks[f"{prefix}/get_rankings"] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+    print(f"{args.runs} runs, {args.latency}s per OpenAI call, {args.chunk_latency}s between streamed events, {args.backend} checkpoints")
+    for name, runs in results.items():
+        summarize(name, runs, peaks.get(name))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""
+Measures what compacting the research message saves, fully offline.
+
+Runs sessions up to their keywords against a stubbed LLM that answers the brand research with the real answer
+recorded in tests/example_states.py (a few paragraphs and their url_citation annotations), once keeping that
+message as it came back (the way research_target stored it before) and once compacted. Compares, per session:
+the get_keywords request body sent to OpenAI and its estimated input tokens (characters / CHARS_PER_TOKEN),
+the checkpoint bytes of a session stopped at its keywords, its brand profile cache entry and the web_research
+update a stream of graph updates carries.
+
+Usage (from the api folder):
+    python tests/compaction_benchmark.py --sessions 20
+"""
+import os
+import sys
+import json
+import uuid
+import asyncio
+import argparse
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Runs against stubs aren't worth keeping in the rankings history
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+# Every session does its own research
+os.environ["GEO_BRAND_PROFILE_TTL_SECONDS"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import messages_to_dict
+from langchain_core.runnables import RunnableLambda
+from langchain_openai import ChatOpenAI
+
+import geo_aval
+from geo_aval import Agent, CHARS_PER_TOKEN
+from sessions import make_checkpointer
+from stub_llm import StubLLM
+from example_states import keywords_chosen_state
+
+
+RECORDED_RESEARCH = keywords_chosen_state["messages"][1]
+
+
+class ResearchStubLLM(StubLLM):
+    "Answers every web research with the recorded one, keywords come from StubLLM"
+    def bind_tools(self, tools, **kwargs):
+        async def research(prompt_value):
+            self.calls += 1
+            return RECORDED_RESEARCH.model_copy(update={"id": str(uuid.uuid4())})
+        return RunnableLambda(research, name="StubResearch")
+
+
+def json_bytes(value) -> int:
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode())
+
+
+async def measure(sessions: int, language: str) -> dict:
+    agent = Agent(checkpointer=make_checkpointer("memory"))
+    # Request bodies are built by the real client, nothing is sent
+    openai_client = ChatOpenAI(model=geo_aval.smart_llm.model_name, api_key="stub")
+
+    states = []
+    for index in range(sessions):
+        config = {"configurable": {"thread_id": str(uuid.uuid4()), "language": language, "location": "Joinville"}}
+        await agent.graph.ainvoke({"keywords": [], "target": f"copapel {index}", "messages": []}, config=config)
+        states.append((await agent.graph.aget_state(config)).values)
+
+    state = states[0]
+    prompt = Agent.get_prompt(prompt="keywords_organization_prompt", language=language).format_messages(messages=state["messages"])
+    payload = openai_client._get_request_payload(prompt)
+    return {
+        "get_keywords request bytes": json_bytes(payload),
+        "get_keywords input tokens (est.)": json_bytes(payload["messages"]) // CHARS_PER_TOKEN,
+        "checkpoint bytes per session": agent.checkpointer.stats()["bytes"] // sessions,
+        "brand profile entry bytes": json_bytes({"messages": messages_to_dict(state["messages"]), "keywords": state["keywords"]}),
+        "web_research update bytes": json_bytes(messages_to_dict(state["messages"])),
+    }
+
+
+async def main(args):
+    geo_aval.dumbass_llm = geo_aval.llm = geo_aval.smart_llm = ResearchStubLLM(latency=0)
+
+    compact_research = geo_aval.compact_research
+    geo_aval.compact_research = lambda message: message
+    before = await measure(args.sessions, args.language)
+    geo_aval.compact_research = compact_research
+    after = await measure(args.sessions, args.language)
+
+    print(f"{args.sessions} sessions, research answer of {len(RECORDED_RESEARCH.text())} characters\n")
+    print(f"{'':<34} {'raw':>10} {'compacted':>10} {'saved':>7}")
+    for metric in before:
+        print(f"{metric:<34} {before[metric]:>10} {after[metric]:>10} {1 - after[metric] / before[metric]:>7.0%}")
+
+    assert all(after[metric] < before[metric] for metric in before), "compaction made something bigger"
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--language", choices=["pt_BR", "en_US"], default="pt_BR")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,225 @@
+"""
+Offline stand-in for the OpenAI HTTP API, as an httpx transport.
+
+Answers the two endpoints the agent uses with responses shaped like the real ones:
+    /responses          web searches, from tests/fixtures/web_search_responses.json (synthetic answers) when the search is there
+    /chat/completions   structured outputs (companies, batched companies, keywords), streamed when asked
+
+Used to record the benchmark cassette without network, the real API can be recorded the same way.
+With `rate_limits` it also enforces per model requests/tokens per minute like OpenAI does: every answer
+carries the x-ratelimit-* headers and requests over the limit get a 429 with retry-after-ms.
+"""
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+from typing import List
+
+import httpx
+
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+BRAND_PATTERN = re.compile(r"\*\*(.+?)\*\*")
+LINK_PATTERN = re.compile(r"\]\((https?://[^)\s]+)\)")
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def message_text(content) -> str:
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content if isinstance(block, dict))
+
+
+def extract_companies(text: str) -> List[dict]:
+    # Each numbered item of a search answer is one brand followed by its links
+    companies = []
+    for item in re.split(r"\n(?=\d+\. )", text):
+        if not (brand := BRAND_PATTERN.search(item)):
+            continue
+        urls = [url for url in LINK_PATTERN.findall(item) if "maps.google" not in url]
+        companies.append({"name": brand.group(1), "relevantUrls": urls, "times_cited": 1})
+    return companies
+
+
+class RateLimit():
+    "OpenAI style limit of one model: buckets of requests and tokens refilling continuously over a minute"
+    def __init__(self, rpm: int, tpm: int):
+        self.limits = {"requests": rpm, "tokens": tpm}
+        self.levels = {"requests": float(rpm), "tokens": float(tpm)}
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        for name, limit in self.limits.items():
+            self.levels[name] = min(limit, self.levels[name] + (now - self.updated) * limit / 60)
+        self.updated = now
+
+    def reset_in(self, name: str, amount: float) -> float:
+        return max(0.0, (amount - self.levels[name]) * 60 / self.limits[name])
+
+    def try_take(self, tokens: int) -> float:
+        "0 when the request is allowed (and counted), else the seconds until it would be"
+        self.refill()
+        wait = max(self.reset_in("requests", 1), self.reset_in("tokens", min(tokens, self.limits["tokens"])))
+        if wait == 0:
+            self.levels["requests"] -= 1
+            self.levels["tokens"] -= tokens
+        return wait
+
+    def headers(self) -> dict:
+        headers = {}
+        for name, limit in self.limits.items():
+            headers[f"x-ratelimit-limit-{name}"] = str(limit)
+            headers[f"x-ratelimit-remaining-{name}"] = str(max(0, int(self.levels[name])))
+            headers[f"x-ratelimit-reset-{name}"] = f"{self.reset_in(name, self.limits[name]):.3f}s"
+        return headers
+
+
+class FakeOpenAITransport(httpx.AsyncBaseTransport):
+    """
+    `latency` seconds are awaited before every answer, streamed answers are sent in `chunk_size` character pieces.
+    `rate_limits` maps model names to {"rpm": ..., "tpm": ...}, models not in it are unlimited.
+    """
+    def __init__(self, latency: float = 0.0, chunk_size: int = 12, rate_limits: dict | None = None):
+        self.latency = latency
+        self.chunk_size = chunk_size
+        self.rate_limits = {model: RateLimit(**limits) for model, limits in (rate_limits or {}).items()}
+        self.rate_limited = 0
+        with open(os.path.join(FIXTURES_PATH, "web_search_responses.json"), encoding="utf-8") as fixture:
+            recorded = json.load(fixture)
+        self.searches = recorded["responses"]
+        self.keywords = [search.removesuffix(f" {recorded['city']}") for search in self.searches]
+        self.calls = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        body = json.loads(request.content)
+        self.calls += 1
+
+        # Counted when the request arrives, like OpenAI does, with the prompt size plus the output cap
+        rate_limit = self.rate_limits.get(body.get("model"))
+        if rate_limit is not None:
+            tokens = estimate_tokens(request.content.decode()) + (body.get("max_completion_tokens") or body.get("max_output_tokens") or 0)
+            if (wait := rate_limit.try_take(tokens)) > 0:
+                self.rate_limited += 1
+                return httpx.Response(429, headers={**rate_limit.headers(), "retry-after-ms": str(int(wait * 1000) + 1)}, json={"error": {
+                    "message": f"Rate limit reached for {body['model']}. Please try again in {int(wait * 1000) + 1}ms.",
+                    "type": "requests", "param": None, "code": "rate_limit_exceeded",
+                }}, request=request)
+
+        await asyncio.sleep(self.latency)
+        if request.url.path.endswith("/responses"):
+            response = self.json_response(request, self.web_search(body))
+        elif request.url.path.endswith("/chat/completions"):
+            response = self.chat_completion(request, body)
+        else:
+            return self.json_response(request, {"error": {"message": f"Unknown endpoint {request.url.path}"}}, status=404)
+        if rate_limit is not None:
+            response.headers.update(rate_limit.headers())
+        return response
+
+    @staticmethod
+    def json_response(request: httpx.Request, payload: dict, status: int = 200) -> httpx.Response:
+        return httpx.Response(status, json=payload, request=request)
+
+    def web_search(self, body: dict) -> dict:
+        messages = body["input"] if isinstance(body["input"], list) else [{"role": "user", "content": body["input"]}]
+        query = message_text(messages[-1]["content"])
+        researching = any(message.get("role") in ("system", "developer") for message in messages)
+
+        if query in self.searches:
+            text = self.searches[query]
+        elif researching:
+            text = (
+                f"**{query}** é uma empresa brasileira de distribuição de produtos de higiene e limpeza profissional, "
+                f"com foco em soluções sustentáveis. ([{query}.com.br](https://{query}.com.br/institucional?utm_source=openai))\n\n"
+                "**Produtos**: papel toalha, papel higiênico, químicos concentrados, dispensers e equipamentos de limpeza.\n\n"
+                "**Mercado-alvo**: indústrias, hospitais, redes de supermercados, escritórios e lavanderias do Sul do Brasil.\n\n"
+                "**Proposta de valor**: economia de água e produtos químicos, logística própria e atendimento consultivo."
+            )
+        else:
+            # Unknown searches get a stable made up answer, so any keyword can be benchmarked
+            seed = int(hashlib.sha256(query.encode()).hexdigest(), 16)
+            brands = [f"Marca {(seed >> (8 * i)) % 40}" for i in range(4)]
+            text = f"Opções para {query}:\n\n" + "\n".join(
+                f"{i}. **{brand}**\n   Atende a região. Mais em [{brand}](https://www.{brand.replace(' ', '').lower()}.com.br?utm_source=openai).\n"
+                for i, brand in enumerate(dict.fromkeys(brands), 1)
+            )
+
+        input_tokens = sum(estimate_tokens(message_text(message["content"])) for message in messages)
+        output_tokens = estimate_tokens(text)
+        return {
+            "id": f"resp_{self.calls}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "status": "completed",
+            "model": body["model"],
+            "output": [
+                {"type": "web_search_call", "id": f"ws_{self.calls}", "status": "completed", "action": {"type": "search", "query": query}},
+                {
+                    "type": "message", "id": f"msg_{self.calls}", "role": "assistant", "status": "completed",
+                    "content": [{"type": "output_text", "text": text, "annotations": []}],
+                },
+            ],
+            "parallel_tool_calls": True,
+            "tool_choice": "auto",
+            "tools": body.get("tools", []),
+            "usage": {
+                "input_tokens": input_tokens,
+                "input_tokens_details": {"cached_tokens": 0},
+                "output_tokens": output_tokens,
+                "output_tokens_details": {"reasoning_tokens": 0},
+                "total_tokens": input_tokens + output_tokens,
+            },
+        }
+
+    def structured_output(self, schema_name: str, messages: List[dict]) -> dict:
+        if schema_name == "Keywords":
+            return {"keywords": self.keywords}
+        if schema_name == "BatchedDominanceGraph":
+            results = []
+            for message in messages:
+                header, _, text = message_text(message["content"]).partition("\n")
+                if header.startswith("## Search: "):
+                    results.append({"keyword": header.removeprefix("## Search: "), "companies": extract_companies(text)})
+            return {"results": results}
+        # DominanceGraph, the search answer is the last message
+        return {"companies": extract_companies(message_text(messages[-1]["content"]))}
+
+    def chat_completion(self, request: httpx.Request, body: dict) -> httpx.Response:
+        schema_name = body.get("response_format", {}).get("json_schema", {}).get("name", "")
+        content = json.dumps(self.structured_output(schema_name, body["messages"]), ensure_ascii=False)
+        usage = {
+            "prompt_tokens": sum(estimate_tokens(message_text(message["content"])) for message in body["messages"]),
+            "completion_tokens": estimate_tokens(content),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion = {"id": f"chatcmpl-{self.calls}", "created": int(time.time()), "model": body["model"]}
+
+        if not body.get("stream"):
+            return self.json_response(request, {
+                **completion,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content, "refusal": None}, "finish_reason": "stop", "logprobs": None}],
+                "usage": usage,
+            })
+
+        def chunk(delta: dict, finish_reason: str | None = None, usage: dict | None = None) -> str:
+            choices = [{"index": 0, "delta": delta, "finish_reason": finish_reason, "logprobs": None}] if delta is not None else []
+            return f"data: {json.dumps({**completion, 'object': 'chat.completion.chunk', 'choices': choices, 'usage': usage}, ensure_ascii=False)}\n\n"
+
+        events = [chunk({"role": "assistant", "content": ""})]
+        events += [chunk({"content": content[i:i + self.chunk_size]}) for i in range(0, len(content), self.chunk_size)]
+        events.append(chunk({}, finish_reason="stop"))
+        if body.get("stream_options", {}).get("include_usage"):
+            events.append(chunk(None, usage=usage))
+        events.append("data: [DONE]\n\n")
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content="".join(events).encode(), request=request)
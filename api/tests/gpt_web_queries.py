@@ -1,4 +1,5 @@
 import os
+import sys
 from dotenv import load_dotenv
 
 from langgraph.graph import MessagesState, StateGraph, END
@@ -8,9 +9,12 @@ from langchain_core.messages import HumanMessage, SystemMessage, ToolMessage, AI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
 from rich.pretty import pprint as rpprint
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from openai_http import OPENAI_TIMEOUT, shared_sync_http_client
 load_dotenv()
 
-llm = ChatOpenAI(model="gpt-4o-mini", output_version="responses/v1", api_key=os.getenv("GEO_AVAL_API_KEY")).bind_tools([{"type": "web_search_preview", "user_location": {
+llm = ChatOpenAI(model="gpt-4o-mini", output_version="responses/v1", api_key=os.getenv("GEO_AVAL_API_KEY"), timeout=OPENAI_TIMEOUT, http_client=shared_sync_http_client()).bind_tools([{"type": "web_search_preview", "user_location": {
     "type": "approximate",
     "country": "BR",
     "city": "Joinville",
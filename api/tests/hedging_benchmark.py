@@ -0,0 +1,141 @@
+"""
+Measures what hedging and request deadlines do to the tail latency of gather_results, fully offline.
+
+Web searches are answered by a stub whose latency has a long tail: most take `--latency` seconds,
+a `--slow-fraction` of them take `--slow-latency`. One slow keyword holds back its whole request,
+a hedge sent after the p95 of recent searches usually comes back long before it.
+The run fails unless hedging cuts the p95, no request spends more than its hedge_cost_budget_usd on
+hedges, and the deadline run reports exactly the keywords whose search was too slow as timed out.
+
+Usage (from the api folder):
+    python tests/hedging_benchmark.py --requests 30 --slow-fraction 0.05
+"""
+import os
+import sys
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import statistics
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Runs against stubs aren't worth keeping in the rankings history
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+import geo_aval
+from geo_aval import Agent, DominanceGraph
+from search_cache import SearchCache
+from hedging import DEFAULT_HEDGE_COST_BUDGET_USD, HedgePolicy
+from metrics import HEDGES_SENT, HEDGES_WON
+from stub_llm import StubLLM, input_messages, install_stub_llm
+
+
+class LongTailStubLLM(StubLLM):
+    def __init__(self, latency: float, slow_latency: float, slow_fraction: float, seed: int):
+        super().__init__(latency=latency)
+        self.slow_latency = slow_latency
+        self.slow_fraction = slow_fraction
+        self.random = random.Random(seed)
+        self.slow_queries = []
+
+    def bind_tools(self, tools, **kwargs):
+        async def web_search(model_input):
+            self.calls += 1
+            slow = self.random.random() < self.slow_fraction
+            query = input_messages(model_input)[-1].content
+            if slow:
+                self.slow_queries.append(query)
+            await asyncio.sleep(self.slow_latency if slow else self.latency * self.random.uniform(0.8, 1.2))
+            return AIMessage(
+                content=f"Best results for {query}: Acme ({query}), Globex.",
+                additional_kwargs={"tool_outputs": [{"type": "web_search_call", "status": "completed"}]},
+            )
+        return RunnableLambda(web_search, name="LongTailWebSearch")
+
+
+def counter_total(counter) -> float:
+    return sum(counter.values.values())
+
+
+async def run_requests(agent: Agent, stub: LongTailStubLLM, args, **options):
+    durations, partial, request_hedges, missed = [], 0, [], []
+    hedges_sent, hedges_won = counter_total(HEDGES_SENT), counter_total(HEDGES_WON)
+    for _ in range(args.requests):
+        config = {"configurable": {"thread_id": str(uuid.uuid4()), "language": "en_US", "location": "Joinville", "use_cache": False, **options}}
+        keywords = [f"keyword {uuid.uuid4().hex[:6]}" for _ in range(args.keywords)]
+        sent, slow = counter_total(HEDGES_SENT), len(stub.slow_queries)
+        start = time.perf_counter()
+        result = await agent.graph.ainvoke({"keywords": keywords, "target": "benchmark", "graph": DominanceGraph(companies=[]), "messages": []}, config=config)
+        durations.append(time.perf_counter() - start)
+        partial += bool(result.get("timed_out_keywords"))
+        request_hedges.append(counter_total(HEDGES_SENT) - sent)
+        # Keywords whose search was slow, and the ones the request said it left out
+        slow_keywords = {keyword for keyword in keywords if any(keyword in query for query in stub.slow_queries[slow:])}
+        missed.append((slow_keywords, set(result.get("timed_out_keywords") or [])))
+    ordered = sorted(durations)
+    return {
+        "p50": statistics.median(durations),
+        "p95": ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))],
+        "max": ordered[-1],
+        "hedges": counter_total(HEDGES_SENT) - hedges_sent,
+        "won": counter_total(HEDGES_WON) - hedges_won,
+        "partial": partial,
+        "most_hedges": max(request_hedges),
+        "missed": missed,
+    }
+
+
+async def main(args):
+    install_stub_llm()
+    stub = LongTailStubLLM(args.latency, args.slow_latency, args.slow_fraction, args.seed)
+    geo_aval.llm = stub
+    agent = Agent(search_cache=SearchCache(path=None))
+
+    # Fills the latency window the hedge delay is computed from
+    await run_requests(agent, stub, argparse.Namespace(**{**vars(args), "requests": 5}))
+    print(f"{args.requests} requests of {args.keywords} keywords, {args.slow_fraction:.0%} of searches take {args.slow_latency}s")
+    print(f"hedge delay (p95 of recent searches): {agent.search_calls.delay():.2f}s\n")
+
+    print(f"{'run':<22} {'p50 s':>7} {'p95 s':>7} {'max s':>7} {'hedges':>7} {'won':>5} {'partial':>8}")
+    hedge_cost = HedgePolicy(stub.model_name).hedge_cost
+    runs = {
+        "plain": {},
+        "hedged": {"hedge": True},
+        # Room for a single hedge per request
+        "hedged, 1 hedge budget": {"hedge": True, "hedge_cost_budget_usd": hedge_cost * 1.5},
+        f"deadline {args.deadline}s": {"deadline_seconds": args.deadline},
+    }
+    results = {}
+    for name, options in runs.items():
+        result = results[name] = await run_requests(agent, stub, args, **options)
+        print(f"{name:<22} {result['p50']:>7.2f} {result['p95']:>7.2f} {result['max']:>7.2f} {result['hedges']:>7.0f} {result['won']:>5.0f} {result['partial']:>8}")
+
+    if results["plain"]["p95"] < args.slow_latency:
+        raise SystemExit("FAIL: no slow search held a request back, nothing to compare (raise --requests or --slow-fraction)")
+    if results["hedged"]["p95"] >= results["plain"]["p95"]:
+        raise SystemExit("FAIL: hedging didn't cut the p95")
+    for name, options in runs.items():
+        budget = options.get("hedge_cost_budget_usd", DEFAULT_HEDGE_COST_BUDGET_USD)
+        if options.get("hedge") and results[name]["most_hedges"] * hedge_cost > budget + 1e-9:
+            raise SystemExit(f"FAIL: {name} spent {results[name]['most_hedges'] * hedge_cost:.4f} USD on one request's hedges, over {budget}")
+    deadline = results[f"deadline {args.deadline}s"]
+    if deadline["partial"] == 0 or any(slow != timed_out for slow, timed_out in deadline["missed"]):
+        raise SystemExit(f"FAIL: the deadline run didn't report exactly the keywords it missed: {deadline['missed']}")
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--keywords", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per usual web search (and per structuring call)")
+    parser.add_argument("--slow-latency", type=float, default=2.0, help="Seconds per slow web search")
+    parser.add_argument("--slow-fraction", type=float, default=0.03)
+    parser.add_argument("--deadline", type=float, default=1.0, help="deadline_seconds of the deadline run")
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,103 @@
+"""
+Measures the rankings history store on months of simulated nightly runs, fully offline.
+
+Records `--days` nights of `--brands` brands in `--cities` cities (10 keywords, ~20 companies cited each) into
+a temporary database, then times the trend queries the /history endpoints run. A competitor appears halfway
+through and another one climbs steadily, the queries must find both.
+
+Usage (from the api folder):
+    python tests/history_benchmark.py --days 90 --brands 50 --cities 5
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import statistics
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aggregation import RankedCompany
+from rankings_history import RankingsHistory
+
+
+def simulated_rankings(rng: random.Random, night: int, nights: int, keywords: list) -> list:
+    # Citations of each company across the keywords of one run, with "Climber" gaining ground every night
+    weights = {f"Company {i}": 30 - i for i in range(20)}
+    weights["Climber"] = 1 + 40 * night / nights
+    if night >= nights // 2:
+        weights["Newcomer"] = 8
+    rankings = []
+    for name, weight in weights.items():
+        cited = {keyword: max(1, int(rng.gauss(weight / 10, 1))) for keyword in keywords if rng.random() < 0.6}
+        if cited:
+            rankings.append(RankedCompany(
+                name=name, aliases=[name], domains=[], relevantUrls=[f"https://{name.replace(' ', '').lower()}.example"],
+                times_cited=sum(cited.values()), share_of_voice=0.0, keywords=cited,
+            ))
+    return rankings
+
+
+async def timed(runs: int, query):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = await query()
+        durations.append((time.perf_counter() - start) * 1000)
+    return result, statistics.median(durations)
+
+
+async def main(args):
+    history = RankingsHistory(os.path.join(tempfile.mkdtemp(), "rankings_history.db"))
+    rng = random.Random(args.seed)
+    keywords = [f"keyword {i}" for i in range(10)]
+    cities = [f"City {i}" for i in range(args.cities)]
+    first_night = datetime(2026, 1, 1, 3, tzinfo=timezone.utc)
+
+    start = time.perf_counter()
+    for night in range(args.days):
+        recorded_at = (first_night + timedelta(days=night)).timestamp()
+        for city in cities:
+            for brand in range(args.brands):
+                await history.record(f"Brand {brand}", city, "pt_BR", simulated_rankings(rng, night, args.days, keywords), recorded_at=recorded_at)
+    elapsed = time.perf_counter() - start
+    runs = args.days * args.brands * args.cities
+    rows = history.query("SELECT COUNT(*) AS rows FROM citations", ())[0]["rows"]
+    size = os.path.getsize(history.path) / 1024 / 1024
+    print(f"recorded {runs} runs ({rows} citation rows, {size:.1f} MiB) in {elapsed:.1f}s, {elapsed / runs * 1000:.2f}ms per run\n")
+
+    first_day = first_night.date().isoformat()
+    last_day = (first_night + timedelta(days=args.days - 1)).date().isoformat()
+    halfway = (first_night + timedelta(days=args.days // 2)).date().isoformat()
+    city = cities[0]
+
+    sov, sov_ms = await timed(args.runs, lambda: history.share_of_voice(city, "pt_BR", first_day, last_day))
+    brand_sov, brand_sov_ms = await timed(args.runs, lambda: history.share_of_voice(city, "pt_BR", first_day, last_day, brand="Brand 0"))
+    changes, changes_ms = await timed(args.runs, lambda: history.rank_changes(city, "pt_BR", first_day, last_day))
+    emerging, emerging_ms = await timed(args.runs, lambda: history.emerging(city, "pt_BR", halfway, last_day))
+
+    print(f"{'query':<38} {'median ms':>10} {'rows':>6}")
+    print(f"{f'share of voice, {args.days} days, every brand':<38} {sov_ms:>10.2f} {len(sov):>6}")
+    print(f"{f'share of voice, {args.days} days, one brand':<38} {brand_sov_ms:>10.2f} {len(brand_sov):>6}")
+    print(f"{'rank changes, first vs last day':<38} {changes_ms:>10.2f} {len(changes['companies']):>6}")
+    print(f"{'emerging since halfway':<38} {emerging_ms:>10.2f} {len(emerging):>6}")
+
+    climber = next(company for company in changes["companies"] if company["company"] == "Climber")
+    print(f"\nClimber: rank {climber['rank_before']} -> {climber['rank_after']}, emerging: {[company['company'] for company in emerging]}")
+    assert climber["rank_change"] > 0
+    assert [company["company"] for company in emerging] == ["Newcomer"]
+    assert len({row["day"] for row in sov}) == args.days
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--brands", type=int, default=50)
+    parser.add_argument("--cities", type=int, default=5)
+    parser.add_argument("--runs", type=int, default=5, help="Times each query is timed")
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,177 @@
+"""
+Load test for the analysis endpoints, runs fully offline against a stubbed LLM.
+
+Starts N analyses at once (get_keywords followed by get_rankings, REST and streaming)
+while polling the health check, then compares wall time with running them back to back.
+A blocking event loop shows up as a wall time close to the sequential one and health checks
+that take as long as a whole analysis. Then checks a session's keywords searched in several
+cities at once cost only their searches, that a request's search_concurrency holds,
+and that a new session given only cities researches the first one.
+
+Usage (from the api folder):
+    python tests/load_test.py --sessions 20 --latency 0.5
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Runs against stubs aren't worth keeping in the rankings history
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+from stub_llm import install_stub_llm
+
+from api import app
+import invoke  # noqa: F401 - registers the /analyze routes
+import streaming  # noqa: F401 - registers the /stream/analyze routes
+
+
+def parse_sse(body: str):
+    events = []
+    for frame in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in frame.splitlines() if ": " in line)
+        if "event" in fields:
+            events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+async def run_analysis(client: httpx.AsyncClient, index: int, stream: bool):
+    prefix = "/stream" if stream else ""
+    body = {"brand_name": f"brand {index}", "city": "Joinville", "language": "pt_BR"}
+
+    if stream:
+        response = await client.post(f"{prefix}/analyze/get_keywords", json=body)
+        response.raise_for_status()
+        # The session id is announced on the first event of the stream
+        event, data = parse_sse(response.text)[-1]
+        session_id, keywords = data["session_id"], data["keywords"]
+        response = await client.post(f"{prefix}/analyze/get_rankings", json={"session_id": session_id, "keywords": keywords, "use_cache": False})
+        response.raise_for_status()
+        if parse_sse(response.text)[-1][0] != "completed":
+            raise Exception(f"Streaming analysis {index} failed: {response.text}")
+    else:
+        response = await client.post(f"{prefix}/analyze/get_keywords", json=body)
+        response.raise_for_status()
+        session_id, keywords = response.json()["session_id"], response.json()["keywords"]
+        response = await client.post(f"{prefix}/analyze/get_rankings", json={"session_id": session_id, "keywords": keywords, "use_cache": False})
+        response.raise_for_status()
+
+
+async def poll_health(client: httpx.AsyncClient, stop: asyncio.Event, latencies: list):
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.get("/")
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.05)
+
+
+async def main(sessions: int, latency: float):
+    stub = install_stub_llm(latency=latency)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=None) as client:
+        # One analysis alone gives the baseline round trip
+        started = time.perf_counter()
+        await run_analysis(client, -1, stream=False)
+        single = time.perf_counter() - started
+
+        stop = asyncio.Event()
+        health_latencies = []
+        health = asyncio.create_task(poll_health(client, stop, health_latencies))
+
+        started = time.perf_counter()
+        await asyncio.gather(*[run_analysis(client, i, stream=i % 2 == 1) for i in range(sessions)])
+        concurrent = time.perf_counter() - started
+
+        stop.set()
+        await health
+
+        # Research and keywords of a brand analysed a moment ago come from the brand profile cache
+        body = {"brand_name": " Brand 0", "city": "joinville", "language": "pt_BR"}
+        calls = stub.calls
+        started = time.perf_counter()
+        response = await client.post("/analyze/get_keywords", json=body)
+        repeat = time.perf_counter() - started
+        response.raise_for_status()
+        cached_calls = stub.calls - calls
+        response = await client.post("/analyze/get_rankings", json={"session_id": response.json()["session_id"], "keywords": response.json()["keywords"]})
+        response.raise_for_status()
+        calls = stub.calls
+        response = await client.post("/analyze/get_keywords", json={**body, "refresh_profile": True})
+        response.raise_for_status()
+        refreshed_calls = stub.calls - calls
+
+        # The same session searched in three cities, its research and keywords aren't redone
+        cities = ["Joinville", "Curitiba", " curitiba ", "Blumenau"]
+        session_id, keywords = response.json()["session_id"], response.json()["keywords"]
+        calls = stub.calls
+        started = time.perf_counter()
+        response = await client.post("/analyze/get_rankings", json={"session_id": session_id, "cities": cities, "use_cache": False})
+        multi_city = time.perf_counter() - started
+        response.raise_for_status()
+        multi_city_calls = stub.calls - calls
+        results = response.json()
+        response = await client.post("/stream/analyze/get_rankings", json={"brand_name": "Brand 0", "language": "pt_BR", "keywords": keywords, "cities": cities[:2]})
+        events = parse_sse(response.text)
+        streamed_cities = {data["city"] for event, data in events if event == "companies"}
+        if events[-1][0] != "completed" or list(events[-1][1]["cities"]) != ["Joinville", "Curitiba"]:
+            raise SystemExit(f"FAIL: streamed multi-city analysis failed: {events[-1]}")
+
+        # A request's own search_concurrency: one at a time, three keywords take three searches and structurings in a row
+        started = time.perf_counter()
+        response = await client.post("/analyze/get_rankings", json={
+            "brand_name": "Brand 0", "city": "Joinville", "language": "pt_BR", "keywords": keywords[:3], "use_cache": False, "search_concurrency": 1,
+        })
+        one_at_a_time = time.perf_counter() - started
+        response.raise_for_status()
+
+        # A new session given only cities does its research for the first one, the next analysis there reuses it
+        body = {"brand_name": "Brand Cities", "language": "pt_BR"}
+        response = await client.post("/analyze/get_rankings", json={**body, "cities": cities[:2]})
+        response.raise_for_status()
+        calls = stub.calls
+        response = await client.post("/analyze/get_keywords", json={**body, "city": "Joinville"})
+        response.raise_for_status()
+        first_city_calls = stub.calls - calls
+
+    sequential = single * sessions
+    worst_health = max(health_latencies)
+    print(f"single analysis:          {single:.2f}s")
+    print(f"{sessions} analyses concurrently: {concurrent:.2f}s (sequential would be ~{sequential:.2f}s)")
+    print(f"health checks:            {len(health_latencies)} served, worst {worst_health * 1000:.1f}ms")
+    print(f"repeated get_keywords:    {repeat * 1000:.1f}ms with {cached_calls} LLM calls ({refreshed_calls} with refresh_profile)")
+    print(f"3 cities x {len(keywords)} keywords:   {multi_city:.2f}s with {multi_city_calls} LLM calls")
+    print(f"3 keywords one at a time: {one_at_a_time:.2f}s")
+    print(f"cities-only new session:  research reused in the first city with {first_city_calls} LLM calls")
+
+    if concurrent > sequential / 2:
+        raise SystemExit("FAIL: analyses did not run concurrently")
+    if worst_health > latency:
+        raise SystemExit("FAIL: health check was blocked by running analyses")
+    if cached_calls != 0 or refreshed_calls != 2:
+        raise SystemExit("FAIL: a repeated analysis didn't reuse the brand profile, or refresh_profile didn't redo it")
+    if multi_city_calls != 3 * len(keywords) * 2 or list(results["cities"]) != ["Joinville", "Curitiba", "Blumenau"]:
+        raise SystemExit("FAIL: a multi-city analysis redid more than the searches of each city")
+    acme = next(company for company in results["comparison"] if company["name"] == "Acme")
+    if acme["cities_present"] != 3 or acme["cities"]["Curitiba"]["rank"] != 1 or streamed_cities != {"Joinville", "Curitiba"}:
+        raise SystemExit(f"FAIL: cities weren't compared or streamed: {results['comparison']}")
+    if one_at_a_time < 3 * 2 * latency:
+        raise SystemExit("FAIL: search_concurrency 1 still searched keywords at once")
+    if first_city_calls != 0:
+        raise SystemExit("FAIL: a new session given only cities didn't research its first city")
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent load test for the analysis endpoints")
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated seconds per LLM call")
+    args = parser.parse_args()
+    asyncio.run(main(args.sessions, args.latency))
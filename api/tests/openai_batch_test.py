@@ -0,0 +1,162 @@
+"""
+Checks batch jobs run with execution "openai_batch" end to end, fully offline.
+
+The agent's realtime calls and the batch files both go to tests/fake_openai.py, the files through the local
+stand-in of the Batch API (openai_batch.LocalBatchTransport) which keeps them in a temporary folder. Checks that
+only research and keywords ran in realtime, that the searches of every item went out in one batch file and their
+structuring in a second one, deduplicated, that the results match a realtime job of the same items at a lower
+cost, that a second job is served from the search cache and that cancelling a job cancels its batch.
+Last, a job whose worker goes away while its batch runs is taken over by another worker sharing the job store,
+which waits for the batch already sent instead of asking for keywords or sending the searches again.
+
+Usage (from the api folder):
+    python tests/openai_batch_test.py --brands 4
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Runs against stubs aren't worth keeping in the rankings history
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+os.environ["GEO_OPENAI_BATCH_TRANSPORT"] = "local"
+os.environ["GEO_OPENAI_BATCH_DIR"] = tempfile.mkdtemp(prefix="openai_batches_")
+os.environ["GEO_BATCH_POLL_SECONDS"] = "0.05"
+os.environ["GEO_BATCH_STALE_SECONDS"] = "0.5"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+import geo_aval
+from fake_openai import FakeOpenAITransport
+from openai_batch import LocalBatchTransport
+from jobs import JobRunner
+
+from api import app
+import batch
+
+
+def install_fake_openai(fake: FakeOpenAITransport):
+    client = httpx.AsyncClient(transport=fake)
+    geo_aval.dumbass_llm = ChatOpenAI(model="gpt-4.1-nano", api_key="stub", http_async_client=client)
+    geo_aval.llm = ChatOpenAI(model="gpt-4.1-mini", api_key="stub", http_async_client=client)
+    geo_aval.smart_llm = ChatOpenAI(model="gpt-4.1", api_key="stub", http_async_client=client)
+
+
+async def run_job(client: httpx.AsyncClient, items: list, **options) -> tuple[dict, list]:
+    response = await client.post("/batch/jobs", json={"items": items, **options})
+    assert response.status_code == 200, response.text
+    job_id = response.json()["job_id"]
+    results = [json.loads(line) for line in (await client.get(f"/batch/jobs/{job_id}/results")).text.splitlines()]
+    return (await client.get(f"/batch/jobs/{job_id}")).json(), sorted(results, key=lambda result: result["index"])
+
+
+def batch_files(directory: str) -> dict:
+    files = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".input.jsonl"):
+            with open(os.path.join(directory, name), encoding="utf-8") as batch_file:
+                lines = [json.loads(line) for line in batch_file]
+            files[name] = (lines[0]["url"], len(lines))
+    return files
+
+
+def rankings(result: dict) -> list:
+    return [(company["name"], company["keywords"]) for company in result["rankings"]]
+
+
+async def taken_over(items: list, realtime: FakeOpenAITransport, offline: FakeOpenAITransport, directory: str):
+    "Two workers sharing the job store file, the first goes away while its job waits for its searches"
+    path = os.path.join(tempfile.mkdtemp(), "batch_jobs.db")
+    first, second = (JobRunner(batch.analyze_item, {"openai_batch": batch.analyze_in_openai_batch}, store_path=path) for _ in range(2))
+    second.start_workers()
+    offline.latency = 1
+    files = batch_files(directory)
+
+    job = await first.submit(items, {"use_cache": False}, "openai_batch")
+    while "/v1/responses" not in job.openai_batches:
+        await asyncio.sleep(0.05)
+    calls = realtime.calls
+    for task in (job.task, *first.worker_tasks, first.watch_task):
+        task.cancel()
+
+    results = [result async for result in await second.results(job.id)]
+    progress = await second.progress(job.id)
+    new_files = sorted(endpoint for name, (endpoint, _) in batch_files(directory).items() if name not in files)
+    print(f"taken over: {progress['status']}, {progress['completed']} ok, {realtime.calls - calls} realtime calls and files {new_files} sent in all")
+    assert progress["status"] == "completed" and progress["completed"] == len(items)
+    assert all(result["status"] == "ok" and not result["partial"] for result in results), results[0]
+    assert realtime.calls == calls and new_files == ["/v1/chat/completions", "/v1/responses"], "keywords and searches aren't asked for again"
+    assert batch.agent.checkpointer.session_count() == 0
+
+
+async def main(args):
+    realtime = FakeOpenAITransport()
+    install_fake_openai(realtime)
+    directory = os.environ["GEO_OPENAI_BATCH_DIR"]
+    offline = FakeOpenAITransport()
+    batch.openai_batch_transport = LocalBatchTransport(directory, offline)
+
+    items = [{"brand_name": f"Brand {i}", "city": city, "language": "pt_BR"} for i in range(args.brands) for city in ("Joinville", "Curitiba")]
+    items.append({"brand_name": "brand 0", "city": "joinville", "language": "pt_BR"})
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", timeout=120) as client:
+        start = time.perf_counter()
+        progress, results = await run_job(client, items, execution="openai_batch", use_cache=False)
+        print(f"openai_batch job: {progress['completed']} ok, {progress['failed']} failed in {time.perf_counter() - start:.2f}s, cost ${progress['cost_usd']:.4f}")
+        assert progress["status"] == "completed" and progress["completed"] == len(items), progress
+        assert all(result["status"] == "ok" and result["graph"] and not result["partial"] for result in results), results[0]
+
+        # Research and keywords of each distinct item are the only realtime calls
+        unique = progress["unique"]
+        print(f"realtime calls {realtime.calls} for {unique} distinct items, batch file requests {offline.calls}")
+        assert realtime.calls == 2 * unique
+        files = batch_files(directory)
+        for name, (endpoint, lines) in files.items():
+            print(f"  {name}: {lines} requests to {endpoint}")
+        searches = len(set(results[0]["keywords"])) * 2
+        assert sorted(files.values()) == [("/v1/chat/completions", searches), ("/v1/responses", searches)], "one search per keyword and city for the whole job"
+        models = results[0]["usage"]["models"]
+        assert any(model.endswith(":batch") for model in models), models
+
+        # Same items in realtime: same rankings, full price
+        batched_cost = progress["cost_usd"]
+        progress, realtime_results = await run_job(client, items, use_cache=False)
+        print(f"realtime job of the same items: cost ${progress['cost_usd']:.4f}")
+        assert [rankings(result) for result in results] == [rankings(result) for result in realtime_results]
+        assert batched_cost < progress["cost_usd"]
+
+        # Everything is cached now, nothing is sent
+        progress, _ = await run_job(client, items, execution="openai_batch")
+        assert progress["completed"] == len(items) and len(batch_files(directory)) == len(files), "cached searches aren't batched again"
+        print(f"cached openai_batch job: {progress['completed']} ok, {progress['web_searches']} web searches")
+
+        # Cancelled while its batch runs, the batch is cancelled too
+        offline.latency = 5
+        response = await client.post("/batch/jobs", json={"items": items[:2], "execution": "openai_batch", "use_cache": False})
+        job_id = response.json()["job_id"]
+        while (await client.get(f"/batch/jobs/{job_id}")).json()["phase"] != "openai_batch":
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        progress = (await client.delete(f"/batch/jobs/{job_id}")).json()
+        await asyncio.sleep(0.05)
+        statuses = [await batch.openai_batch_transport.status(batch_id) for batch_id in batch.openai_batch_transport.tasks]
+        print(f"cancelled job: {progress['status']}, batch statuses {statuses}")
+        assert progress["status"] == "cancelled" and statuses[-1] == "cancelled"
+        assert batch.agent.checkpointer.session_count() == 0, "batch sessions are dropped"
+
+        response = await client.post("/batch/jobs", json={"items": items, "execution": "overnight"})
+        assert response.status_code == 422, response.text
+    await taken_over(items, realtime, offline, directory)
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--brands", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
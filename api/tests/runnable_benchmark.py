@@ -0,0 +1,88 @@
+"""
+Microbenchmark of the per-call overhead of getting the chains the agent runs, fully offline (nothing is sent).
+
+Compares building them on every call, the way the nodes used to (prompt | client.bind_tools(...) or
+client.with_structured_output(...), plus a ChatPromptTemplate per keyword search), with getting them from the
+agent's runnable cache. The clients are the real ChatOpenAI ones, so tool binding and JSON schema generation
+cost what they cost in production.
+
+Usage (from the api folder):
+    python tests/runnable_benchmark.py --calls 2000
+"""
+import os
+import sys
+import time
+import argparse
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+import geo_aval
+from geo_aval import Agent, BatchedDominanceGraph, DominanceGraph, Keywords, get_llm
+
+
+LANGUAGE = "pt_BR"
+
+
+def rebuilt(agent: Agent, city: str, keyword: str) -> dict:
+    "Each chain the way it was built before the cache, once per call"
+    tool = agent.get_openai_web_research_tool(city)
+    return {
+        "web research": lambda: agent.get_prompt("web_info_gathering_prompt", LANGUAGE) | get_llm("llm").bind_tools([tool]),
+        "keywords": lambda: agent.get_prompt("keywords_organization_prompt", LANGUAGE) | get_llm("smart_llm").with_structured_output(Keywords),
+        "keyword search": lambda: (ChatPromptTemplate([HumanMessage(keyword)]) | get_llm("llm").bind_tools([tool])).first.invoke({}),
+        "structuring": lambda: agent.get_prompt("structure_brands_dominance_prompt", LANGUAGE) | get_llm("llm").with_structured_output(DominanceGraph),
+        "batched structuring": lambda: agent.get_prompt("structure_batched_brands_dominance_prompt", LANGUAGE) | get_llm("llm").with_structured_output(BatchedDominanceGraph),
+    }
+
+
+def cached(agent: Agent, city: str, keyword: str) -> dict:
+    return {
+        "web research": lambda: agent.get_web_search_chain("web_info_gathering_prompt", LANGUAGE, city),
+        "keywords": lambda: agent.get_chain("keywords_organization_prompt", LANGUAGE, "smart_llm", Keywords),
+        "keyword search": lambda: (agent.get_search_agents(LANGUAGE, city)[0], [HumanMessage(keyword)]),
+        "structuring": lambda: agent.get_search_agents(LANGUAGE, city)[1],
+        "batched structuring": lambda: agent.get_batched_structurer_agent(LANGUAGE),
+    }
+
+
+def per_call_us(get, calls: int) -> float:
+    get()
+    start = time.perf_counter()
+    for _ in range(calls):
+        get()
+    return (time.perf_counter() - start) / calls * 1_000_000
+
+
+def main(args):
+    agent = Agent()
+    city, keyword = "Joinville", "distribuidora de papel toalha"
+    before = {name: per_call_us(get, args.calls) for name, get in rebuilt(agent, city, keyword).items()}
+    after = {name: per_call_us(get, args.calls) for name, get in cached(agent, city, keyword).items()}
+
+    print(f"{'per call, microseconds':<24} {'rebuilt':>10} {'cached':>10} {'speedup':>8}")
+    for name in before:
+        print(f"{name:<24} {before[name]:>10.1f} {after[name]:>10.1f} {before[name] / after[name]:>7.0f}x")
+
+    # One analysis: research, keywords, then 10 keywords searched and structured one by one
+    def analysis(costs):
+        return costs["web research"] + costs["keywords"] + 10 * (costs["keyword search"] + costs["structuring"])
+    print(f"\none analysis of 10 keywords: {analysis(before) / 1000:.2f}ms rebuilt, {analysis(after) / 1000:.3f}ms cached")
+    print(f"runnable cache: {agent.runnables.stats()}")
+
+    assert all(after[name] < before[name] for name in before)
+    # A replaced tier client gets chains of its own
+    structurer = agent.get_search_agents(LANGUAGE, city)[1]
+    geo_aval.llm = None
+    assert agent.get_search_agents(LANGUAGE, city)[1] is not structurer
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=2000)
+    main(parser.parse_args())
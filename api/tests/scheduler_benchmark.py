@@ -0,0 +1,111 @@
+"""
+Compares OpenAI calls sent through the rate limit scheduler with calls sent straight out, fully offline.
+
+The upstream is tests/fake_openai.py enforcing one model's requests per minute, answering 429s with
+retry-after-ms like OpenAI. Batch sessions fire a burst big enough to drain the limit, then interactive
+sessions arrive behind them. Calls go through the official client with its default retries, as in the app.
+Without the scheduler everyone hammers the API and shares the 429s, with it nothing is sent over the limit
+and the interactive calls are served ahead of the batch backlog: the run fails if the scheduler lets a 429 through
+or batch calls queued before the interactive ones all finish first ("batch left" is how many were still waiting).
+
+Usage (from the api folder):
+    python tests/scheduler_benchmark.py --rpm 600 --batch-sessions 10 --batch-calls 70
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import statistics
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Runs against stubs aren't worth keeping in the rankings history
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from scheduler import OpenAIScheduler, ScheduledTransport, llm_priority
+from fake_openai import FakeOpenAITransport
+
+
+MODEL = "gpt-4.1-mini"
+
+
+async def session_calls(client: AsyncOpenAI, priority: str, session: str, calls: int, results: dict, run_start: float):
+    with llm_priority(priority, session):
+        for index in range(calls):
+            start = time.perf_counter()
+            try:
+                await client.chat.completions.create(model=MODEL, messages=[{"role": "user", "content": f"{session} call {index}"}])
+                results[priority].append(time.perf_counter() - start)
+                results["finished"][priority].append(time.perf_counter() - run_start)
+            except Exception:
+                results["failed"][priority] = results["failed"].get(priority, 0) + 1
+
+
+async def run(args, scheduled: bool):
+    fake = FakeOpenAITransport(latency=args.latency, rate_limits={MODEL: {"rpm": args.rpm, "tpm": 10_000_000}})
+    scheduler = OpenAIScheduler({MODEL: {"rpm": args.rpm, "tpm": 10_000_000}})
+    transport = ScheduledTransport(scheduler, fake) if scheduled else fake
+    client = AsyncOpenAI(api_key="stub", http_client=DefaultAsyncHttpxClient(transport=transport))
+
+    results = {"interactive": [], "batch": [], "failed": {}, "finished": {"interactive": [], "batch": []}}
+    start = time.perf_counter()
+    # Each batch session sends its calls concurrently, like gather_results does with its keywords
+    batch = [
+        asyncio.create_task(session_calls(client, "batch", f"batch-{session}", 1, results, start))
+        for session in range(args.batch_sessions) for _ in range(args.batch_calls)
+    ]
+    await asyncio.sleep(0.05)
+    interactive = [
+        asyncio.create_task(session_calls(client, "interactive", f"interactive-{session}", args.interactive_calls, results, start))
+        for session in range(args.interactive_sessions)
+    ]
+    await asyncio.gather(*interactive)
+    interactive_done = time.perf_counter() - start
+    await asyncio.gather(*batch)
+    await client.close()
+    return {
+        "wall": time.perf_counter() - start,
+        "interactive_done": interactive_done,
+        "interactive_p50": statistics.median(results["interactive"]) if results["interactive"] else float("nan"),
+        "batch_p50": statistics.median(results["batch"]) if results["batch"] else float("nan"),
+        "failed": f"{results['failed'].get('interactive', 0)}/{results['failed'].get('batch', 0)}",
+        # Batch calls queued before the interactive ones arrived that were still waiting when the last of them was answered
+        "batch_after_interactive": sum(finished > interactive_done for finished in results["finished"]["batch"]),
+        "rate_limited": fake.rate_limited,
+        "sent": fake.calls,
+    }
+
+
+async def main(args):
+    total = args.batch_sessions * args.batch_calls + args.interactive_sessions * args.interactive_calls
+    print(f"{total} calls, limit {args.rpm} requests/min\n")
+    print(f"{'scheduler':<10} {'wall s':>7} {'interactive done s':>19} {'interactive p50 s':>18} {'batch p50 s':>12} {'batch left':>11} {'429s':>6} {'sent':>6} {'failed i/b':>11}")
+    results = {}
+    for scheduled in (False, True):
+        result = results[scheduled] = await run(args, scheduled)
+        print(
+            f"{'on' if scheduled else 'off':<10} {result['wall']:>7.2f} {result['interactive_done']:>19.2f} {result['interactive_p50']:>18.3f} "
+            f"{result['batch_p50']:>12.3f} {result['batch_after_interactive']:>11} {result['rate_limited']:>6} {result['sent']:>6} {result['failed']:>11}"
+        )
+
+    if results[False]["rate_limited"] == 0:
+        raise SystemExit("FAIL: the burst never went over the limit, nothing to compare (raise --batch-calls)")
+    if results[True]["rate_limited"] != 0 or results[True]["failed"] != "0/0":
+        raise SystemExit(f"FAIL: the scheduler sent calls over the limit: {results[True]['rate_limited']} 429s")
+    if results[True]["batch_after_interactive"] == 0:
+        raise SystemExit("FAIL: the interactive calls waited for the whole batch backlog")
+    print("OK")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rpm", type=int, default=600)
+    parser.add_argument("--batch-sessions", type=int, default=10)
+    parser.add_argument("--batch-calls", type=int, default=70, help="Concurrent calls per batch session")
+    parser.add_argument("--interactive-sessions", type=int, default=5)
+    parser.add_argument("--interactive-calls", type=int, default=4, help="Calls per interactive session, one after the other")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per fake OpenAI answer")
+    asyncio.run(main(parser.parse_args()))
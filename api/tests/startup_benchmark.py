@@ -0,0 +1,79 @@
+"""
+Measures how long a fresh worker takes to become ready, fully offline.
+
+Each run starts a new Python process that imports the app with all its routes and serves its first health check,
+the way a restarted container or a new autoscaled worker does, then builds the OpenAI clients of the three model
+tiers the first analysis needs. Times are medians, from the start of the process's own code (interpreter startup
+not included). A warm up run compiles the bytecode first.
+
+With --compare REV the same runs are made on a checkout of another revision (a temporary git worktree).
+
+Usage (from the api folder):
+    python tests/startup_benchmark.py --runs 10 --compare HEAD~1
+"""
+import os
+import sys
+import json
+import tempfile
+import argparse
+import statistics
+import subprocess
+
+API_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORKER = r"""
+import os, sys, json, time, asyncio
+started = time.perf_counter()
+sys.path.insert(0, os.getcwd())
+
+import api, invoke, streaming, batch, history
+imported = time.perf_counter()
+
+import httpx
+async def health_check():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.app), base_url="http://startup") as client:
+        (await client.get("/")).raise_for_status()
+asyncio.run(health_check())
+ready = time.perf_counter()
+
+import geo_aval
+for tier in ("dumbass_llm", "llm", "smart_llm"):
+    getattr(geo_aval, tier)
+clients = time.perf_counter()
+
+print(json.dumps({"import": imported - started, "ready": ready - started, "llm clients": clients - ready, "first analysis ready": clients - started}))
+"""
+
+
+def measure(api_path: str, runs: int) -> dict:
+    env = {**os.environ, "GEO_AVAL_API_KEY": "stub", "GEO_HISTORY_PATH": "", "GEO_BRAND_PROFILE_CACHE_PATH": ""}
+    samples = []
+    for _ in range(runs + 1):
+        output = subprocess.run([sys.executable, "-c", WORKER], cwd=api_path, env=env, capture_output=True, text=True, check=True)
+        samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    # The first one compiled the bytecode
+    return {metric: statistics.median(sample[metric] for sample in samples[1:]) for metric in samples[0]}
+
+
+def main(args):
+    results = {"current": measure(API_PATH, args.runs)}
+    if args.compare:
+        worktree = os.path.join(tempfile.mkdtemp(), "compare")
+        subprocess.run(["git", "worktree", "add", "--detach", worktree, args.compare], cwd=API_PATH, check=True, capture_output=True)
+        try:
+            results[args.compare] = measure(os.path.join(worktree, "api"), args.runs)
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=API_PATH, check=True)
+
+    columns = list(reversed(results))
+    print(f"median of {args.runs} cold starts, seconds\n")
+    print(f"{'':<22}" + "".join(f"{column:>12}" for column in columns))
+    for metric in results["current"]:
+        print(f"{metric:<22}" + "".join(f"{results[column][metric]:>12.3f}" for column in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--compare", help="git revision to measure too")
+    main(parser.parse_args())
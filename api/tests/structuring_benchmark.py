@@ -0,0 +1,165 @@
+"""
+Compares the per-keyword and batched structuring modes of gather_results, fully offline.
+
+Web searches are answered from tests/fixtures/web_search_responses.json, which is synthetic: templated answers
+in the shape of web search responses, not recorded OpenAI traffic. Structuring calls are answered by a simulated
+model whose latency grows with the tokens it reads and writes:
+    latency = base + input_tokens * input_rate + output_tokens * output_rate
+Tokens are estimated the same way the batch packing does (characters / CHARS_PER_TOKEN).
+Both the data and the model are simulated, so the numbers compare the two modes with each other;
+they aren't measurements of real traffic.
+
+Usage (from the api folder):
+    python tests/structuring_benchmark.py --runs 3 --token-budget 12000
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import statistics
+
+os.environ.setdefault("GEO_AVAL_API_KEY", "stub")
+# Runs against stubs aren't worth keeping in the rankings history
+os.environ.setdefault("GEO_HISTORY_PATH", "")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+import geo_aval
+from geo_aval import Agent, Company, DominanceGraph, KeywordDominance, BatchedDominanceGraph, CHARS_PER_TOKEN
+from search_cache import SearchCache
+from fake_openai import extract_companies
+from stub_llm import input_messages
+
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "web_search_responses.json")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def companies_in(text: str) -> list[Company]:
+    return [Company(**company) for company in extract_companies(text)]
+
+
+class ReplayLLM():
+    """
+    Answers web searches from the synthetic fixture and simulates the structuring model.
+    Counts calls and estimated tokens per kind of call.
+    """
+    def __init__(self, responses: dict[str, str], search_latency: float, base_latency: float, input_rate: float, output_rate: float):
+        self.responses = responses
+        self.search_latency = search_latency
+        self.base_latency = base_latency
+        self.input_rate = input_rate
+        self.output_rate = output_rate
+        self.model_name = "replay"
+        self.reset()
+
+    def reset(self):
+        self.structuring_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def bind_tools(self, tools, **kwargs):
+        async def web_search(model_input):
+            await asyncio.sleep(self.search_latency)
+            query = input_messages(model_input)[-1].content
+            return AIMessage(
+                content=self.responses[query],
+                additional_kwargs={"tool_outputs": [{"type": "web_search_call", "status": "completed"}]},
+            )
+        return RunnableLambda(web_search, name="ReplayWebSearch")
+
+    async def simulate(self, prompt_value, result):
+        input_tokens = sum(estimate_tokens(message.text()) for message in prompt_value.to_messages())
+        output_tokens = estimate_tokens(result.model_dump_json())
+        self.structuring_calls += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        await asyncio.sleep(self.base_latency + input_tokens * self.input_rate + output_tokens * self.output_rate)
+        return result
+
+    def with_structured_output(self, schema, **kwargs):
+        if schema is DominanceGraph:
+            async def structure(prompt_value):
+                return await self.simulate(prompt_value, DominanceGraph(companies=companies_in(prompt_value.to_messages()[-1].text())))
+            return RunnableLambda(structure, name="ReplayStructurer")
+
+        async def structure_batch(prompt_value):
+            results = []
+            for message in prompt_value.to_messages()[1:]:
+                header, _, body = message.text().partition("\n")
+                results.append(KeywordDominance(keyword=header.removeprefix("## Search: "), companies=companies_in(body)))
+            return await self.simulate(prompt_value, BatchedDominanceGraph(results=results))
+        return RunnableLambda(structure_batch, name="ReplayBatchedStructurer")
+
+
+async def run_mode(agent: Agent, replay: ReplayLLM, keywords: list[str], city: str, language: str, mode: str, token_budget: int):
+    replay.reset()
+    config = {"configurable": {
+        "thread_id": str(uuid.uuid4()),
+        "language": language,
+        "location": city,
+        "use_cache": False,
+        "structuring_mode": mode,
+        "structuring_token_budget": token_budget,
+    }}
+    start = time.perf_counter()
+    result = await agent.graph.ainvoke({"keywords": keywords, "target": "benchmark", "graph": DominanceGraph(companies=[]), "messages": []}, config=config)
+    elapsed = time.perf_counter() - start
+    return {
+        "seconds": elapsed,
+        "calls": replay.structuring_calls,
+        "input_tokens": replay.input_tokens,
+        "output_tokens": replay.output_tokens,
+        "companies": len(result["graph"]),
+    }
+
+
+async def main(args):
+    with open(FIXTURE_PATH, encoding="utf-8") as fixture:
+        searches = json.load(fixture)
+    city, language = searches["city"], searches["language"]
+    keywords = [search.removesuffix(f" {city}") for search in searches["responses"]][:args.keywords]
+
+    replay = ReplayLLM(searches["responses"], args.search_latency, args.base_latency, args.input_rate, args.output_rate)
+    geo_aval.llm = replay
+    agent = Agent(search_cache=SearchCache(path=None))
+
+    print("SIMULATED: synthetic web search answers (not recorded traffic) and a simulated structuring model,")
+    print("compare the modes with each other, the absolute numbers don't measure real traffic\n")
+    print(f"{len(keywords)} keywords, {args.runs} runs per mode, token budget {args.token_budget}\n")
+    print(f"{'mode':<12} {'wall s':>8} {'calls':>6} {'input tok':>10} {'output tok':>11} {'companies':>10}")
+    summaries = {}
+    for mode in geo_aval.STRUCTURING_MODES:
+        runs = [await run_mode(agent, replay, keywords, city, language, mode, args.token_budget) for _ in range(args.runs)]
+        summary = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        summaries[mode] = summary
+        print(f"{mode:<12} {summary['seconds']:>8.2f} {summary['calls']:>6} {summary['input_tokens']:>10} {summary['output_tokens']:>11} {summary['companies']:>10}")
+
+    per_keyword, batched = summaries["per_keyword"], summaries["batched"]
+    print(
+        f"\nbatched: {batched['calls'] / per_keyword['calls']:.0%} of the calls, "
+        f"{batched['input_tokens'] / per_keyword['input_tokens']:.0%} of the input tokens, "
+        f"{batched['seconds'] / per_keyword['seconds']:.0%} of the wall time (simulated)"
+    )
+    if batched["companies"] != per_keyword["companies"]:
+        raise SystemExit(f"Modes disagree on the companies found: {per_keyword['companies']} vs {batched['companies']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--keywords", type=int, default=10)
+    parser.add_argument("--token-budget", type=int, default=geo_aval.DEFAULT_STRUCTURING_TOKEN_BUDGET)
+    parser.add_argument("--search-latency", type=float, default=0.2, help="Seconds per replayed web search")
+    parser.add_argument("--base-latency", type=float, default=0.4, help="Seconds per structuring call before any token")
+    parser.add_argument("--input-rate", type=float, default=0.00005, help="Seconds per input token")
+    parser.add_argument("--output-rate", type=float, default=0.002, help="Seconds per output token")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,84 @@
+import re
+import asyncio
+from typing import AsyncIterator, List
+
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import RunnableLambda, RunnableGenerator
+
+import geo_aval
+from geo_aval import Company, DominanceGraph, KeywordDominance, BatchedDominanceGraph
+
+
+def input_messages(model_input: PromptValue | List[BaseMessage]) -> List[BaseMessage]:
+    "What a chat model was called with: the prompt value of a chain, or the messages keyword searches send directly"
+    return model_input.to_messages() if isinstance(model_input, PromptValue) else list(model_input)
+
+
+class StubLLM():
+    """
+    Offline stand-in for the ChatOpenAI clients in geo_aval.
+    Every call awaits `latency` seconds, the way a real request waits on OpenAI without holding the worker.
+    """
+    def __init__(self, latency: float = 1.0, keywords: List[str] | None = None):
+        self.latency = latency
+        self.keywords = keywords or [f"keyword {i}" for i in range(10)]
+        self.model_name = "stub"
+        self.calls = 0
+
+    def bind_tools(self, tools: List[dict], **kwargs):
+        async def web_search(model_input):
+            self.calls += 1
+            await asyncio.sleep(self.latency)
+            query = input_messages(model_input)[-1].content
+            return AIMessage(
+                content=f"Best results for {query}: Acme ({query}), Globex.",
+                additional_kwargs={"tool_outputs": [{"type": "web_search_call", "status": "completed"}]},
+            )
+        return RunnableLambda(web_search, name="StubWebSearch")
+
+    def with_structured_output(self, schema, **kwargs):
+        if schema is DominanceGraph:
+            async def structure(prompt_value):
+                self.calls += 1
+                await asyncio.sleep(self.latency)
+                return DominanceGraph(companies=[
+                    Company(name="Acme", relevantUrls=["https://acme.example"], times_cited=2),
+                    Company(name="Globex", relevantUrls=["https://globex.example"], times_cited=1),
+                ])
+            return RunnableLambda(structure, name="StubStructurer")
+
+        if schema is BatchedDominanceGraph:
+            async def structure_batch(prompt_value):
+                self.calls += 1
+                await asyncio.sleep(self.latency)
+                searches = [
+                    match.group(1) for message in prompt_value.to_messages()
+                    if (match := re.match(r"## Search: (.+)", message.content))
+                ]
+                return BatchedDominanceGraph(results=[
+                    KeywordDominance(keyword=search, companies=[
+                        Company(name="Acme", relevantUrls=["https://acme.example"], times_cited=2),
+                        Company(name="Globex", relevantUrls=["https://globex.example"], times_cited=1),
+                    ])
+                    for search in searches
+                ])
+            return RunnableLambda(structure_batch, name="StubBatchedStructurer")
+
+        # Keywords are streamed as a growing list, like the partial JSON chunks OpenAI sends back
+        async def stream_keywords(inputs: AsyncIterator) -> AsyncIterator[dict]:
+            async for _ in inputs:
+                pass
+            self.calls += 1
+            await asyncio.sleep(self.latency)
+            for i in range(1, len(self.keywords) + 1):
+                yield {"keywords": self.keywords[:i]}
+        return RunnableGenerator(stream_keywords, name="StubKeywords")
+
+
+def install_stub_llm(latency: float = 1.0) -> StubLLM:
+    stub = StubLLM(latency=latency)
+    geo_aval.dumbass_llm = stub
+    geo_aval.llm = stub
+    geo_aval.smart_llm = stub
+    return stub
@@ -0,0 +1,199 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.tracers.context import register_configure_hook
+
+
+# USD list prices per 1M tokens (input, output), update when OpenAI's pricing changes
+MODEL_PRICES = {
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1-nano": (0.10, 0.40),
+}
+# USD per web_search_preview call at the default (medium) search context size
+WEB_SEARCH_PRICES = {
+    "gpt-4.1": 0.035,
+    "gpt-4.1-mini": 0.0275,
+}
+
+# Calls sent through the OpenAI Batch API are counted under "<model>:batch", their tokens at this fraction of the price
+BATCH_MODEL_SUFFIX = ":batch"
+BATCH_TOKEN_PRICE_RATIO = 0.5
+
+# Tokens a keyword search is assumed to cost until one has finished and the real average is known
+ESTIMATED_TOKENS_PER_SEARCH = 4000
+
+USAGE_FIELDS = ("calls", "input_tokens", "output_tokens", "web_searches")
+
+
+def merge_usage(current: Dict | None, update: Dict | None) -> Dict:
+    """
+    State reducer summing {node: {model: {field: count}}} usage trees,
+    so every node run (and every request of a session) adds to what's already there.
+    """
+    merged = {node: {model: dict(counts) for model, counts in models.items()} for node, models in (current or {}).items()}
+    for node, models in (update or {}).items():
+        # A node that made no LLM call still shows up, with nothing spent
+        node_usage = merged.setdefault(node, {})
+        for model, counts in models.items():
+            target = node_usage.setdefault(model, dict.fromkeys(USAGE_FIELDS, 0))
+            for field in USAGE_FIELDS:
+                target[field] = target.get(field, 0) + counts.get(field, 0)
+    return merged
+
+
+def batch_model(model: str) -> str:
+    return f"{model}{BATCH_MODEL_SUFFIX}"
+
+
+def cost(model: str, counts: Dict) -> float:
+    # The web search fee is the same either way
+    token_ratio = BATCH_TOKEN_PRICE_RATIO if model.endswith(BATCH_MODEL_SUFFIX) else 1.0
+    model = model.removesuffix(BATCH_MODEL_SUFFIX)
+    input_price, output_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (
+        counts.get("input_tokens", 0) * input_price * token_ratio / 1_000_000
+        + counts.get("output_tokens", 0) * output_price * token_ratio / 1_000_000
+        + counts.get("web_searches", 0) * WEB_SEARCH_PRICES.get(model, 0.0)
+    )
+
+
+def usage_report(usage: Dict | None) -> Dict:
+    "Session usage per node and per model with totals and estimated USD cost (models without a known price count as free)"
+    usage = usage or {}
+    models = {}
+    for node_models in usage.values():
+        models = merge_usage({"all": models}, {"all": node_models})["all"]
+
+    return {
+        "nodes": {node: {**sum_models(node_models), "cost_usd": total_cost(node_models)} for node, node_models in usage.items()},
+        "models": {model: {**counts, "cost_usd": cost(model, counts)} for model, counts in models.items()},
+        "total": {**sum_models(models), "cost_usd": total_cost(models)},
+    }
+
+
+def sum_models(models: Dict) -> Dict:
+    return {field: sum(counts.get(field, 0) for counts in models.values()) for field in USAGE_FIELDS}
+
+
+def total_cost(models: Dict) -> float:
+    return sum(cost(model, counts) for model, counts in models.items())
+
+
+class UsageTracker():
+    "Usage of the LLM calls made inside one node run, fed by UsageCallbackHandler"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models: Dict[str, Dict[str, int]] = {}
+
+    def add(self, model: str, **counts: int):
+        with self.lock:
+            target = self.models.setdefault(model, dict.fromkeys(USAGE_FIELDS, 0))
+            for field, count in counts.items():
+                target[field] += count
+
+    @property
+    def total_tokens(self) -> int:
+        with self.lock:
+            return sum(counts["input_tokens"] + counts["output_tokens"] for counts in self.models.values())
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {model: dict(counts) for model, counts in self.models.items()}
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    run_inline = True
+
+    def __init__(self, tracker: UsageTracker):
+        self.tracker = tracker
+        self.models: Dict[object, str] = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self.models[run_id] = (metadata or {}).get("ls_model_name") or kwargs.get("invocation_params", {}).get("model", "unknown")
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        model = self.models.pop(run_id, "unknown")
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if message is None:
+                    continue
+                usage = getattr(message, "usage_metadata", None) or {}
+                searches = sum(1 for output in message.additional_kwargs.get("tool_outputs", []) if output.get("type") == "web_search_call")
+                self.tracker.add(
+                    model,
+                    calls=1,
+                    input_tokens=usage.get("input_tokens", 0),
+                    output_tokens=usage.get("output_tokens", 0),
+                    web_searches=searches,
+                )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.models.pop(run_id, None)
+
+
+usage_handler_var: ContextVar[UsageCallbackHandler | None] = ContextVar("geo_usage_handler", default=None)
+register_configure_hook(usage_handler_var, inheritable=True)
+
+
+@contextmanager
+def track_usage() -> Iterator[UsageTracker]:
+    """
+    Collects the usage of every LLM call started inside the block, tasks spawned from it included.
+    A search shared by concurrent sessions (single flight) is only billed to the session that started it.
+    """
+    tracker = UsageTracker()
+    token = usage_handler_var.set(UsageCallbackHandler(tracker))
+    try:
+        yield tracker
+    finally:
+        usage_handler_var.reset(token)
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+class SearchBudget():
+    """
+    Per-request caps on tokens and upstream keyword searches.
+    A search is only started when the tokens already used, plus the expected cost of the searches still running
+    and of the new one, fit in the token budget. Cached and coalesced results are free and never refused.
+    """
+    def __init__(self, tracker: UsageTracker, max_tokens: int | None = None, max_searches: int | None = None):
+        self.tracker = tracker
+        self.max_tokens = max_tokens
+        self.max_searches = max_searches
+        self.lock = threading.Lock()
+        self.started = 0
+        self.finished = 0
+        self.refused = 0
+
+    def tokens_per_search(self) -> float:
+        return self.tracker.total_tokens / self.finished if self.finished else ESTIMATED_TOKENS_PER_SEARCH
+
+    def try_start(self) -> bool:
+        with self.lock:
+            if self.max_searches is not None and self.started >= self.max_searches:
+                self.refused += 1
+                return False
+            if self.max_tokens is not None:
+                running = self.started - self.finished
+                if self.tracker.total_tokens + (running + 1) * self.tokens_per_search() > self.max_tokens:
+                    self.refused += 1
+                    return False
+            self.started += 1
+            return True
+
+    def finish(self):
+        with self.lock:
+            self.finished += 1
+
+    @property
+    def exhausted(self) -> bool:
+        return self.refused > 0
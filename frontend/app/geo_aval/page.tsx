@@ -14,7 +14,7 @@ import { Input } from "@/components/ui/input"
 import { Label } from "@/components/ui/label"
 import { Badge } from "@/components/ui/badge"
 import { Loader2, X, Plus, Search, BarChart3, Globe, MapPin, TrendingUp } from "lucide-react"
-import { getStageName } from '@/lib/utils'
+import { getStageName, readEventStream } from '@/lib/utils'
 import AnalysisLoading from '@/components/ui/analysis-loading'
 import { Pie, PieChart, Sector, Cell } from "recharts"
 import { PieSectorDataItem } from "recharts/types/polar/Pie"
@@ -49,6 +49,11 @@ interface AnalysisState {
 }
 
 const maxKeywords = 10
+const toChartCompany = (company: any): Company => ({
+    company: company.name,
+    times_cited: company.times_cited,
+    relevantUrls: company.relevantUrls
+})
 const sortAndGroupCompanies = (companies: Company[]) => {
     const sortedCompanies = [...companies].sort((a, b) => b.times_cited - a.times_cited)
 
@@ -139,59 +144,46 @@ const GeoEvaluator = () => {
                 throw new Error('Response body is null')
             }
 
-            setState(prev => ({ ...prev, currentAnalysysStage: 'starting', step: 'keywords' }))
-
-            const reader = response.body.getReader()
-            const decoder = new TextDecoder()
+            setState(prev => ({ ...prev, currentAnalysysStage: 'starting', step: 'keywords', keywords: [], editedKeywords: [] }))
 
             try {
-                while (true) {
-                    const { done, value } = await reader.read()
-                    if (done) break
-
-                    const chunk = decoder.decode(value, { stream: true })
-                    const lines = chunk.split('\n').filter(line => line.trim())
-                    for (const line of lines) {
-                        const data = JSON.parse(line)
-
-
-                        switch (data.stage) {
-                            case 'initializing':
+                await readEventStream(response.body, ({ event, data }) => {
+                    switch (event) {
+                        case 'stage':
+                            if (data.status === 'started') {
                                 setState(prev => ({
                                     ...prev,
-                                    currentAnalysysStage: "Setting up the language model and preparing the analysis environment...",
+                                    currentAnalysysStage: getStageName(data.stage),
                                     sessionId: data.session_id
                                 }))
-                                break
-
-                            case 'analysys':
-                                const operationName = Object.keys(data.data)[0]
-                                const template = getStageName(operationName)
-                                setState(prev => ({
-                                    ...prev,
-                                    currentAnalysysStage: template,
-                                }))
-                                break
-
-                            case 'completed':
-                                setState(prev => ({
-                                    ...prev,
-                                    loading: false,
-                                    step: 'keywords',
-                                    currentAnalysysStage: null,
-                                    sessionId: data.session_id,
-                                    keywords: data.data.keywords || [],
-                                    editedKeywords: data.data.keywords || []
-                                }))
-                                console.log('✅ Analysis completed!')
-                                break
-
-                            case 'error':
-                                throw new Error(data.data)
-                        }
+                            }
+                            break
+
+                        case 'keywords':
+                            setState(prev => ({
+                                ...prev,
+                                keywords: [...prev.keywords, ...data.keywords],
+                                editedKeywords: [...prev.editedKeywords, ...data.keywords]
+                            }))
+                            break
+
+                        case 'completed':
+                            setState(prev => ({
+                                ...prev,
+                                loading: false,
+                                step: 'keywords',
+                                currentAnalysysStage: null,
+                                sessionId: data.session_id,
+                                keywords: data.keywords || [],
+                                editedKeywords: data.keywords || []
+                            }))
+                            console.log('✅ Analysis completed!')
+                            break
+
+                        case 'error':
+                            throw new Error(data.detail)
                     }
-
-                }
+                })
             } catch (error: any) {
                 setState(prev => ({
                     ...prev,
@@ -234,64 +226,47 @@ const GeoEvaluator = () => {
                 throw new Error('Response body is null')
             }
 
-            setState(prev => ({ ...prev, step: 'results' }))
-
-            const reader = response.body.getReader()
-            const decoder = new TextDecoder()
+            setState(prev => ({ ...prev, step: 'results', results: [] }))
 
             try {
-                while (true) {
-                    const { done, value } = await reader.read()
-                    if (done) break
-
-                    const chunk = decoder.decode(value, { stream: true })
-                    const lines = chunk.split('\n').filter(line => line.trim())
-                    for (const line of lines) {
-                        const data = JSON.parse(line)
-                        console.log(data)
-
-                        switch (data.stage) {
-                            case 'initializing':
-                                break;
-                            case 'gathering_results':
-                                const progressGraphData = data.data.gather_results.graph || []
-                                const graphPieChartDataProgress = progressGraphData.map((company: any) => ({
-                                    company: company.__dict__.name,
-                                    times_cited: company.__dict__.times_cited,
-                                    relevantUrls: company.__dict__.relevantUrls
-                                }))
-
+                await readEventStream(response.body, ({ event, data }) => {
+                    switch (event) {
+                        case 'stage':
+                            if (data.status === 'started') {
                                 setState(prev => ({
                                     ...prev,
-                                    results: graphPieChartDataProgress
+                                    currentAnalysysStage: getStageName(data.stage)
                                 }))
-                                break
-
-                            case 'completed':
-                                const rawGraphData = data.data.graph || []
-
-                                const graphPieChartData = rawGraphData.map((company: any) => ({
-                                    company: company.__dict__.name,
-                                    times_cited: company.__dict__.times_cited,
-                                    relevantUrls: company.__dict__.relevantUrls
-                                }))
-
-                                const sortedResults = sortAndGroupCompanies(graphPieChartData)
-
-
-                                setState(prev => ({
-                                    ...prev,
-                                    loading: false,
-                                    results: sortedResults,
-                                    currentAnalysysStage: null
-                                }))
-                                break
-                            case 'error':
-                                throw new Error(data.data)
-                        }
+                            }
+                            break
+
+                        case 'companies':
+                            // One event per keyword, the chart grows as each search finishes
+                            const newCompanies = data.companies.map(toChartCompany)
+                            setState(prev => ({
+                                ...prev,
+                                results: sortAndGroupCompanies([...prev.results, ...newCompanies])
+                            }))
+                            break
+
+                        case 'completed':
+                            // Rankings are already merged and sorted by the API
+                            const sortedResults = data.rankings
+                                ? data.rankings.map(toChartCompany)
+                                : sortAndGroupCompanies((data.graph || []).map(toChartCompany))
+
+                            setState(prev => ({
+                                ...prev,
+                                loading: false,
+                                results: sortedResults,
+                                currentAnalysysStage: null
+                            }))
+                            break
+
+                        case 'error':
+                            throw new Error(data.detail)
                     }
-
-                }
+                })
             } catch (error: any) {
                 setState(prev => ({
                     ...prev,
@@ -5,14 +5,51 @@ export function cn(...inputs: ClassValue[]) {
   return twMerge(clsx(inputs))
 }
 
+export interface StreamEvent {
+  event: string
+  data: any
+}
+
+// Reads a text/event-stream body, calling onEvent for every complete `event:` / `data:` frame
+export async function readEventStream(body: ReadableStream<Uint8Array>, onEvent: (event: StreamEvent) => void) {
+  const reader = body.getReader()
+  const decoder = new TextDecoder()
+  let buffer = ''
+
+  while (true) {
+    const { done, value } = await reader.read()
+    if (done) break
+
+    buffer += decoder.decode(value, { stream: true })
+    const frames = buffer.split('\n\n')
+    buffer = frames.pop() || ''
+
+    for (const frame of frames) {
+      let event = 'message'
+      const data: string[] = []
+      for (const line of frame.split('\n')) {
+        if (line.startsWith('event:')) event = line.slice(6).trim()
+        else if (line.startsWith('data:')) data.push(line.slice(5).trim())
+      }
+      if (data.length > 0) {
+        onEvent({ event, data: JSON.parse(data.join('\n')) })
+      }
+    }
+  }
+}
+
 export function getStageName(stageName: string): string {
   switch (stageName) {
+    case "initializing":
+      return "Setting up the language model and preparing the analysis environment..."
     case "web_research":
       return "Researching web for company data"
     case "get_keywords":
       return "Extracting relevant keywords from your company information..."
     case "refine_keywords":
       return "Refining chosen keywords"
+    case "gather_results":
+      return "Searching each keyword and gathering cited companies..."
     default:
       return stageName
   }